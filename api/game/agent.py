@@ -1,43 +1,68 @@
-import ai21
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from api.game.ai21_client import ai21_clients
+from api.game.maestro import run_maestro, MaestroRunManager
+from api.game.metrics import fallbacks
+
+# Said when Maestro fails, by trust: at least 60, at least 30, below 30
+FALLBACK_RESPONSES = (
+    "I think that's a wise choice. Let us proceed carefully.",
+    "Very well. I shall follow your lead, though I have my reservations.",
+    "I question your judgment, but I will accompany you nonetheless."
+)
+
+def describe_trust(trust_level: int) -> str:
+    """How the character feels about the player at a trust level (five buckets)"""
+    if trust_level >= 80:
+        return "very trusting and friendly"
+    elif trust_level >= 60:
+        return "generally trusting"
+    elif trust_level >= 40:
+        return "neutral"
+    elif trust_level >= 20:
+        return "somewhat suspicious"
+    else:
+        return "distrustful and guarded"
 
 class MaestroCharacterAgent:
-    def __init__(self, character_profile: Dict[str, Any], api_key: str):
-        # Initialize the AI21 client with the API key
-        self.client = ai21.AI21Client(api_key=api_key)
+    def __init__(self, character_profile: Dict[str, Any], api_key: str, client=None):
+        # The process-wide AI21 client for this key (see api/game/ai21_client.py)
+        self.client = client or ai21_clients.get(api_key)
         self.character_profile = character_profile
-        self.memory = {
-            "name": character_profile["name"],
-            "alignment": character_profile["alignment"],
+        # Default memory, used when callers don't pass a session's memory
+        self.memory = self.new_memory()
+        
+    def new_memory(self) -> Dict[str, Any]:
+        """Initial memory of this character for a new player"""
+        return {
+            "name": self.character_profile["name"],
+            "alignment": self.character_profile["alignment"],
             "trust_in_player": 50,
             "recent_actions": [],
             "mood": "neutral"
         }
         
-    def _format_prompt(self, scene_context: str, player_action: str, historical_context: List[Dict[str, Any]]) -> str:
+    def apply_mood(self, memory: Dict[str, Any]) -> str:
+        """Set the memory's mood from its trust level; returns the mood description used in prompts"""
+        mood_description = describe_trust(memory["trust_in_player"])
+        memory["mood"] = mood_description.split()[0]  # Set the first word as the mood
+        return mood_description
+    
+    def _format_prompt(self, scene_context: str, player_action: str, historical_context: List[Dict[str, Any]],
+                       memory: Optional[Dict[str, Any]] = None) -> str:
         """Format the prompt for the LLM with all context"""
+        if memory is None:
+            memory = self.memory
+        
         # Extract historical facts
         historical_facts = "\n".join([f"- {item['text']}" for item in historical_context])
         
         # Format recent actions
-        recent_actions = "\n".join([f"- {action}" for action in self.memory["recent_actions"]])
+        recent_actions = "\n".join([f"- {action}" for action in memory["recent_actions"]])
         if not recent_actions:
             recent_actions = "- This is your first interaction with the player."
         
         # Determine mood description based on trust level
-        trust_level = self.memory["trust_in_player"]
-        if trust_level >= 80:
-            mood_description = "very trusting and friendly"
-        elif trust_level >= 60:
-            mood_description = "generally trusting"
-        elif trust_level >= 40:
-            mood_description = "neutral"
-        elif trust_level >= 20:
-            mood_description = "somewhat suspicious"
-        else:
-            mood_description = "distrustful and guarded"
-        
-        self.memory["mood"] = mood_description.split()[0]  # Set the first word as the mood
+        mood_description = self.apply_mood(memory)
         
         # Construct the full prompt
         prompt = f"""You are {self.character_profile['name']}, a {self.character_profile['alignment']} character in a medieval RPG set in 13th century England.
@@ -60,79 +85,116 @@ Respond as {self.character_profile['name']}, providing your reaction to the play
         
         return prompt
         
-    def generate_response(self, scene_context: str, player_action: str, historical_context: List[Dict[str, Any]]) -> str:
+    def _requirements(self, memory: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Maestro requirements for a reply"""
+        return [
+            {
+                "name": "character_consistency",
+                "description": f"Response must be consistent with character profile: {self.character_profile['name']}, a {self.character_profile['alignment']} character",
+                "is_mandatory": True
+            },
+            {
+                "name": "historical_accuracy",
+                "description": "Response must incorporate at least one historical fact from the provided historical context",
+                "is_mandatory": True
+            },
+            {
+                "name": "emotional_response",
+                "description": f"Response should reflect character's current mood: {memory['mood']}",
+                "is_mandatory": True
+            },
+            {
+                "name": "first_person",
+                "description": "Response must be in first person as if the character is speaking directly",
+                "is_mandatory": True
+            },
+            {
+                "name": "length",
+                "description": "Response should be 2-3 sentences long",
+                "is_mandatory": True
+            }
+        ]
+    
+    def _fallback_response(self, error: Exception, memory: Dict[str, Any]) -> str:
+        print(f"Error generating character response: {error}")
+        # Fallback response if Maestro fails
+        fallbacks.inc(component="reply")
+        trust_level = memory["trust_in_player"]
+        if trust_level >= 60:
+            return FALLBACK_RESPONSES[0]
+        elif trust_level >= 30:
+            return FALLBACK_RESPONSES[1]
+        else:
+            return FALLBACK_RESPONSES[2]
+        
+    def generate_response(self, scene_context: str, player_action: str, historical_context: List[Dict[str, Any]],
+                          memory: Optional[Dict[str, Any]] = None) -> str:
         """Generate a character response using Maestro with requirements"""
+        if memory is None:
+            memory = self.memory
+        
         # Format prompt with all context
-        prompt = self._format_prompt(scene_context, player_action, historical_context)
+        prompt = self._format_prompt(scene_context, player_action, historical_context, memory)
         
         try:
             # Generate response with Maestro requirements
-            run_result = self.client.beta.maestro.runs.create_and_poll(
+            run_result = run_maestro(
+                self.client,
+                operation="reply",
                 input=prompt,
-                requirements=[
-                    {
-                        "name": "character_consistency",
-                        "description": f"Response must be consistent with character profile: {self.character_profile['name']}, a {self.character_profile['alignment']} character",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "historical_accuracy",
-                        "description": "Response must incorporate at least one historical fact from the provided historical context",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "emotional_response",
-                        "description": f"Response should reflect character's current mood: {self.memory['mood']}",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "first_person",
-                        "description": "Response must be in first person as if the character is speaking directly",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "length",
-                        "description": "Response should be 2-3 sentences long",
-                        "is_mandatory": True
-                    }
-                ]
+                requirements=self._requirements(memory)
             )
             
             return run_result.result
             
         except Exception as e:
-            print(f"Error generating character response: {e}")
-            # Fallback response if Maestro fails
-            trust_level = self.memory["trust_in_player"]
-            if trust_level >= 60:
-                return f"I think that's a wise choice. Let us proceed carefully."
-            elif trust_level >= 30:
-                return f"Very well. I shall follow your lead, though I have my reservations."
-            else:
-                return f"I question your judgment, but I will accompany you nonetheless."
+            return self._fallback_response(e, memory)
+    
+    async def generate_response_async(self, scene_context: str, player_action: str,
+                                      historical_context: List[Dict[str, Any]], runs: MaestroRunManager,
+                                      memory: Optional[Dict[str, Any]] = None) -> str:
+        """generate_response, waiting for the Maestro run on the shared run manager instead of a thread"""
+        if memory is None:
+            memory = self.memory
+        
+        prompt = self._format_prompt(scene_context, player_action, historical_context, memory)
+        
+        try:
+            run_result = await runs.run(
+                self.client,
+                operation="reply",
+                input=prompt,
+                requirements=self._requirements(memory)
+            )
+            return run_result.result
+        except Exception as e:
+            return self._fallback_response(e, memory)
                 
-    def update_memory(self, player_action: str, trust_change: int) -> None:
+    def update_memory(self, player_action: str, trust_change: int, memory: Optional[Dict[str, Any]] = None) -> None:
         """Update the agent's memory based on player actions"""
+        if memory is None:
+            memory = self.memory
+        
         # Add to recent actions
-        self.memory["recent_actions"].append(player_action)
+        memory["recent_actions"].append(player_action)
         
         # Keep only the 5 most recent actions
-        if len(self.memory["recent_actions"]) > 5:
-            self.memory["recent_actions"] = self.memory["recent_actions"][-5:]
+        if len(memory["recent_actions"]) > 5:
+            memory["recent_actions"] = memory["recent_actions"][-5:]
             
         # Update trust level
-        self.memory["trust_in_player"] += trust_change
-        self.memory["trust_in_player"] = max(0, min(100, self.memory["trust_in_player"]))
+        memory["trust_in_player"] += trust_change
+        memory["trust_in_player"] = max(0, min(100, memory["trust_in_player"]))
         
         # Update mood based on trust level
-        trust_level = self.memory["trust_in_player"]
+        trust_level = memory["trust_in_player"]
         if trust_level >= 80:
-            self.memory["mood"] = "trusting"
+            memory["mood"] = "trusting"
         elif trust_level >= 60:
-            self.memory["mood"] = "friendly"
+            memory["mood"] = "friendly"
         elif trust_level >= 40:
-            self.memory["mood"] = "neutral"
+            memory["mood"] = "neutral"
         elif trust_level >= 20:
-            self.memory["mood"] = "suspicious"
+            memory["mood"] = "suspicious"
         else:
-            self.memory["mood"] = "distrustful"
+            memory["mood"] = "distrustful"
@@ -0,0 +1,146 @@
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from api.game.metrics import metrics
+
+ai21_requests = metrics.counter("rpg_ai21_requests_total", "HTTP requests sent to AI21")
+ai21_connections_opened = metrics.counter("rpg_ai21_connections_opened_total", "New TCP connections opened to AI21")
+
+
+class _PoolStats:
+    """Counts requests and new connections on one httpx transport"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.requests = 0
+        self.connections_opened = 0
+
+    def started(self) -> None:
+        with self._lock:
+            self.active += 1
+            self.requests += 1
+        ai21_requests.inc()
+
+    def finished(self) -> None:
+        with self._lock:
+            self.active -= 1
+
+    def trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        # httpcore reports each stage of a request; a TCP connect means the pool had nothing to reuse
+        if event_name == "connection.connect_tcp.started":
+            with self._lock:
+                self.connections_opened += 1
+            ai21_connections_opened.inc()
+
+
+class AI21ClientProvider:
+    """
+    One AI21 client per API key, shared by every component that calls AI21
+    (the orchestrator, the scoring agent, the companion and any other NPC
+    agents), so they share one keep-alive connection pool instead of each
+    opening their own.
+
+    The pool holds up to max_connections connections, at most
+    max_keepalive of them idle. A request that finds every connection busy
+    waits for one (within the request's timeout), which also caps how
+    many requests are sent to AI21 at once. Clients are built on first use.
+    """
+
+    def __init__(self, max_connections: int = 32, max_keepalive: int = 16, keepalive_expiry: float = 60.0,
+                 timeout_sec: Optional[float] = None, connect_retries: int = 2):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout_sec = timeout_sec
+        self.connect_retries = connect_retries
+        self._lock = threading.Lock()
+        # api key -> (AI21Client, its httpx transport)
+        self._clients: Dict[Optional[str], Any] = {}
+        self._stats = _PoolStats()
+
+    @classmethod
+    def from_env(cls) -> "AI21ClientProvider":
+        """Configured from AI21_MAX_CONNECTIONS, AI21_MAX_KEEPALIVE, AI21_KEEPALIVE_EXPIRY_SEC and AI21_TIMEOUT_SEC"""
+        timeout_sec = os.getenv("AI21_TIMEOUT_SEC")
+        return cls(
+            max_connections=int(os.getenv("AI21_MAX_CONNECTIONS", "32")),
+            max_keepalive=int(os.getenv("AI21_MAX_KEEPALIVE", "16")),
+            keepalive_expiry=float(os.getenv("AI21_KEEPALIVE_EXPIRY_SEC", "60")),
+            timeout_sec=float(timeout_sec) if timeout_sec else None,
+        )
+
+    def _build(self, api_key: Optional[str]):
+        # Imported here so the API process can start without loading the SDK
+        import ai21
+        import httpx
+
+        stats = self._stats
+
+        class CountingTransport(httpx.HTTPTransport):
+            def handle_request(self, request):
+                request.extensions["trace"] = stats.trace
+                stats.started()
+                try:
+                    return super().handle_request(request)
+                finally:
+                    stats.finished()
+
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        # Retries here only cover failing to connect; the SDK retries failed responses itself
+        transport = CountingTransport(limits=limits, retries=self.connect_retries)
+        http_client = httpx.Client(transport=transport)
+        client = ai21.AI21Client(api_key=api_key, http_client=http_client, timeout_sec=self.timeout_sec)
+        return client, transport
+
+    def get(self, api_key: Optional[str]):
+        """The shared ai21.AI21Client for api_key"""
+        entry = self._clients.get(api_key)
+        if entry is None:
+            with self._lock:
+                entry = self._clients.get(api_key)
+                if entry is None:
+                    entry = self._build(api_key)
+                    self._clients[api_key] = entry
+        return entry[0]
+
+    def connections(self) -> Dict[str, int]:
+        """Open connections across all clients, split into in use and idle"""
+        busy = idle = 0
+        for _, transport in list(self._clients.values()):
+            # httpcore's pool; not part of httpx's public API, so tolerate it changing
+            pool = getattr(transport, "_pool", None)
+            for connection in list(getattr(pool, "connections", ())):
+                if connection.is_idle():
+                    idle += 1
+                else:
+                    busy += 1
+        return {"busy": busy, "idle": idle}
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self._stats.requests
+        opened = self._stats.connections_opened
+        return {
+            "clients": len(self._clients),
+            "max_connections": self.max_connections,
+            "active_requests": self._stats.active,
+            "requests": requests,
+            "connections_opened": opened,
+            "connection_reuse_ratio": round(1 - opened / requests, 3) if requests else 0.0,
+            **self.connections(),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            for client, transport in self._clients.values():
+                transport.close()
+            self._clients.clear()
+
+
+# Shared by every component in the process
+ai21_clients = AI21ClientProvider.from_env()
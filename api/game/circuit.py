@@ -0,0 +1,256 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Tuple
+
+from api.game.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Exported as the rpg_circuit_state gauge
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# A call slower than this counts as a failure; vendors differ a lot in normal latency
+DEFAULT_SLOW_CALL_SEC = {
+    "maestro": 60.0,
+    "replicate": 60.0,
+    "sesame": 15.0,
+}
+
+circuit_transitions = metrics.counter("rpg_circuit_transitions_total", "Circuit breaker state changes")
+circuit_rejections = metrics.counter("rpg_circuit_rejections_total", "Calls sent straight to the fallback by an open circuit")
+
+
+class CircuitOpenError(Exception):
+    """The vendor's circuit is open, so the call was not attempted"""
+
+
+class _Call:
+    """Handle for one guarded call; fail() marks it failed without raising"""
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self) -> None:
+        self.failed = True
+
+
+class CircuitBreaker:
+    """
+    Stops calling a vendor that is failing or hanging, so requests get the
+    component's fallback right away instead of after a timeout.
+
+    Closed: calls go through and their outcomes are kept for window_sec.
+    Once there are at least min_calls, a failure rate of failure_rate or
+    more trips the circuit. Calls slower than slow_call_sec count as
+    failures, including ones still running, so a vendor that hangs trips
+    it too. Open: calls are rejected with CircuitOpenError for open_sec.
+    Half-open: up to half_open_probes calls are let through; if they all
+    succeed the circuit closes, and any failure opens it again.
+    """
+
+    def __init__(self, name: str, window_sec: float = 60.0, min_calls: int = 10, failure_rate: float = 0.5,
+                 slow_call_sec: float = 30.0, open_sec: float = 30.0, half_open_probes: int = 2):
+        self.name = name
+        self.window_sec = window_sec
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_sec = slow_call_sec
+        self.open_sec = open_sec
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # (finished_at, failed) of recent calls, oldest first
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        # call id -> started_at, for calls still running
+        self._running: Dict[int, float] = {}
+        self._ids = itertools.count()
+        # call id -> started_at, for half-open probes still running
+        self._probing: Dict[int, float] = {}
+        self._probes = 0
+        self._probe_successes = 0
+        self.counts = {"succeeded": 0, "failed": 0, "rejected": 0, "opened": 0}
+
+    @classmethod
+    def from_env(cls, name: str) -> "CircuitBreaker":
+        """
+        Configured from CIRCUIT_WINDOW_SEC, CIRCUIT_MIN_CALLS, CIRCUIT_FAILURE_RATE,
+        CIRCUIT_OPEN_SEC, CIRCUIT_HALF_OPEN_PROBES and CIRCUIT_<NAME>_SLOW_SEC
+        """
+        slow_call_sec = DEFAULT_SLOW_CALL_SEC.get(name, 30.0)
+        return cls(
+            name,
+            window_sec=float(os.getenv("CIRCUIT_WINDOW_SEC", "60")),
+            min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", "10")),
+            failure_rate=float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5")),
+            slow_call_sec=float(os.getenv(f"CIRCUIT_{name.upper()}_SLOW_SEC", str(slow_call_sec))),
+            open_sec=float(os.getenv("CIRCUIT_OPEN_SEC", "30")),
+            half_open_probes=int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "2")),
+        )
+
+    def _transition(self, state: str, now: float) -> None:
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now
+            self.counts["opened"] += 1
+        if state != CLOSED:
+            self._probes = 0
+            self._probe_successes = 0
+            self._probing.clear()
+        else:
+            self._outcomes.clear()
+            self._failures = 0
+        circuit_transitions.inc(vendor=self.name, state=state)
+        print(f"Circuit for {self.name} is now {state}")
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - self.window_sec
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+
+    def _should_trip(self, now: float) -> bool:
+        self._expire(now)
+        hung = sum(1 for started_at in self._running.values() if now - started_at > self.slow_call_sec)
+        calls = len(self._outcomes) + hung
+        return calls >= self.min_calls and (self._failures + hung) >= self.failure_rate * calls
+
+    def _admit(self, now: float) -> bool:
+        if self.state == CLOSED:
+            if self._should_trip(now):
+                self._transition(OPEN, now)
+                return False
+            return True
+        if self.state == OPEN:
+            if now - self.opened_at < self.open_sec:
+                return False
+            self._transition(HALF_OPEN, now)
+        if any(now - started_at > self.slow_call_sec for started_at in self._probing.values()):
+            # A probe is hanging; that's a failure too
+            self._transition(OPEN, now)
+            return False
+        if self._probes >= self.half_open_probes:
+            return False
+        self._probes += 1
+        return True
+
+    def rejecting(self) -> bool:
+        """True if a call made now would be rejected; doesn't use up a half-open probe"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                return now - self.opened_at < self.open_sec
+            if self.state == HALF_OPEN:
+                return self._probes >= self.half_open_probes
+            return False
+
+    def _record(self, call_id: int, failed: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            started_at = self._running.pop(call_id)
+            probe = self._probing.pop(call_id, None) is not None
+            failed = failed or now - started_at > self.slow_call_sec
+            self.counts["failed" if failed else "succeeded"] += 1
+            if probe:
+                if failed:
+                    self._transition(OPEN, now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        self._transition(CLOSED, now)
+            elif self.state == CLOSED:
+                self._outcomes.append((now, failed))
+                self._failures += failed
+                if failed and self._should_trip(now):
+                    self._transition(OPEN, now)
+            # Calls that finish while the circuit is open don't change anything
+
+    def _release(self, call_id: int) -> None:
+        # A cancelled call says nothing about the vendor; hand back its probe slot
+        with self._lock:
+            self._running.pop(call_id, None)
+            if self._probing.pop(call_id, None) is not None and self._probes > 0:
+                self._probes -= 1
+
+    @contextmanager
+    def guard(self) -> Iterator[_Call]:
+        """
+        Wrap one upstream call. Raises CircuitOpenError without running the
+        body if the circuit is open; otherwise records whether the body
+        raised (or called fail()) and how long it took.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not self._admit(now):
+                self.counts["rejected"] += 1
+                circuit_rejections.inc(vendor=self.name)
+                raise CircuitOpenError(f"{self.name} circuit is {self.state}")
+            call_id = next(self._ids)
+            self._running[call_id] = now
+            if self.state == HALF_OPEN:
+                self._probing[call_id] = now
+
+        call = _Call()
+        try:
+            yield call
+        except (asyncio.CancelledError, GeneratorExit):
+            self._release(call_id)
+            raise
+        except BaseException:
+            self._record(call_id, failed=True)
+            raise
+        self._record(call_id, failed=call.failed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._expire(time.monotonic())
+            return dict(
+                self.counts,
+                state=self.state,
+                window_calls=len(self._outcomes),
+                window_failures=self._failures,
+                running=len(self._running),
+            )
+
+
+class CircuitBreakers:
+    """One CircuitBreaker per vendor, created from the environment on first use"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.enabled = os.getenv("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+
+    def get(self, vendor: str) -> CircuitBreaker:
+        breaker = self._breakers.get(vendor)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(vendor)
+                if breaker is None:
+                    breaker = CircuitBreaker.from_env(vendor)
+                    if not self.enabled:
+                        # Never enough calls to trip
+                        breaker.min_calls = float("inf")
+                    self._breakers[vendor] = breaker
+        return breaker
+
+    def rejecting(self, vendor: str) -> bool:
+        return self.get(vendor).rejecting()
+
+    def states(self) -> Dict[str, str]:
+        return {vendor: breaker.state for vendor, breaker in list(self._breakers.items())}
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {vendor: breaker.stats() for vendor, breaker in list(self._breakers.items())}
+
+
+# Shared by every component in the process
+circuits = CircuitBreakers()
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import re
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from api.game.metrics import cache_hits, cache_misses
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase and collapse whitespace so trivially different inputs share a key"""
+    return _WHITESPACE.sub(" ", text or "").strip().lower()
+
+
+def coalesce_key(operation: str, **inputs) -> str:
+    """Stable key for an upstream call from its operation name and inputs"""
+    return json.dumps([operation, inputs], sort_keys=True, separators=(",", ":"), default=str)
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls.
+
+    The first caller for a key starts the upstream call; callers arriving
+    with the same key while it is still running wait for that call instead
+    of starting their own, and all of them receive its result (or its
+    exception). Nothing is kept once the call finishes, so this is not a
+    cache: it only collapses concurrent duplicates, e.g. every player
+    loading the intro scene at launch.
+
+    One caller going away doesn't cancel the call for the others, but once
+    every caller has been cancelled the call is cancelled too.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # key -> callers waiting on the call in progress
+        self._waiters: Dict[Hashable, int] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is None:
+            self.leaders += 1
+            cache_misses.inc(cache="coalesce")
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+        else:
+            self.followers += 1
+            cache_hits.inc(cache="coalesce")
+        # Shield the shared call so one caller going away doesn't cancel it for the others
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key) is future:
+                self._waiters[key] -= 1
+                if not self._waiters[key] and not future.done():
+                    future.cancel()
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self._waiters.pop(key, None)
+        # Mark the exception as retrieved if every caller went away before it finished
+        if not future.cancelled():
+            future.exception()
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> Dict[str, int]:
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "followers": self.followers}
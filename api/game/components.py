@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class Components:
+    """
+    Lazily built game components.
+
+    Each component is constructed by its factory on first access (at most
+    once, even when several threads ask at the same time), so the API can
+    start accepting connections before the vendor SDKs, clients and indexes
+    are loaded. warm_up() builds everything ahead of time in the background;
+    ready reports whether that has finished.
+
+        components = Components({"rag": build_rag})
+        components.rag.retrieve(...)
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]]):
+        self._factories = dict(factories)
+        self._instances: Dict[str, Any] = {}
+        self._locks = {name: threading.Lock() for name in factories}
+        self._build_times: Dict[str, float] = {}
+        self._errors: Dict[str, str] = {}
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        if name not in self._factories:
+            raise AttributeError(f"Unknown component {name}")
+        with self._locks[name]:
+            instance = self._instances.get(name)
+            if instance is None:
+                started_at = time.perf_counter()
+                try:
+                    instance = self._factories[name]()
+                except Exception as e:
+                    # Not cached: the next access tries again
+                    self._errors[name] = str(e)
+                    raise
+                self._build_times[name] = time.perf_counter() - started_at
+                self._errors.pop(name, None)
+                self._instances[name] = instance
+        return instance
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get(name)
+
+    def is_built(self, name: str) -> bool:
+        return name in self._instances
+
+    @property
+    def ready(self) -> bool:
+        return all(name in self._instances for name in self._factories)
+
+    def warm_up(self) -> Dict[str, Optional[str]]:
+        """Build every component; returns the error message for any that failed"""
+        results: Dict[str, Optional[str]] = {}
+        for name in self._factories:
+            try:
+                self.get(name)
+                results[name] = None
+            except Exception as e:
+                print(f"Error initializing {name}: {e}")
+                results[name] = str(e)
+        return results
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "built": name in self._instances,
+                "build_ms": round(1000 * self._build_times[name], 1) if name in self._build_times else None,
+                "error": self._errors.get(name),
+            }
+            for name in self._factories
+        }
@@ -0,0 +1,54 @@
+import json
+import mmap
+import os
+from typing import Any, Dict, Iterable, Iterator
+
+import numpy as np
+
+
+class DocumentStore:
+    """
+    Documents stored as JSON lines in one file, with an offset table giving
+    where each one starts. The file is memory-mapped, so opening a store
+    costs the same at any size, a lookup only reads the document it returns,
+    and every process that opens it shares the pages.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self._file = open(os.path.join(directory, "documents.jsonl"), "rb")
+        # An empty file can't be mapped
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @staticmethod
+    def write(directory: str, documents: Iterable[Dict[str, Any]]) -> int:
+        """Write documents to a new store in directory; returns how many were written"""
+        os.makedirs(directory, exist_ok=True)
+        offsets = [0]
+        with open(os.path.join(directory, "documents.jsonl"), "wb") as f:
+            for doc in documents:
+                line = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(os.path.join(directory, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        return len(offsets) - 1
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return json.loads(self._data[start:end])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
@@ -0,0 +1,98 @@
+import math
+import os
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# Too common to say anything about a passage
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from had has have he her his in into is it its of on or she that the "
+    "their them they this to was were which who with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, without stop words"""
+    return [word for word in TOKEN_PATTERN.findall(text.lower()) if word not in STOP_WORDS]
+
+
+class Embedder:
+    """
+    Turns texts into unit-length float32 vectors. `signature` identifies the
+    model and its settings; an index built with a different signature is
+    rebuilt rather than searched.
+    """
+
+    dim: int
+    signature: str
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """(len(texts), dim) array of L2-normalized vectors"""
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """
+    Local embedder with no model to download: words and the character
+    trigrams inside them are hashed into `dim` signed buckets, weighted
+    by log(1 + term frequency). It captures lexical overlap (including
+    plural and other word-form variants through the trigrams), not
+    meaning, but it's deterministic, fast and works offline.
+    """
+
+    def __init__(self, dim: int = 384, trigram_weight: float = 0.5):
+        self.dim = dim
+        self.trigram_weight = trigram_weight
+        self.signature = f"hashing-v1:dim={dim}:trigrams={trigram_weight}"
+
+    def _features(self, text: str) -> Dict[str, float]:
+        counts: Dict[str, float] = {}
+        for word in tokenize(text):
+            counts[word] = counts.get(word, 0.0) + 1.0
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                trigram = "#" + padded[i:i + 3]
+                counts[trigram] = counts.get(trigram, 0.0) + self.trigram_weight
+        return counts
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                # crc32 rather than hash(): it must be the same in every process
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                vectors[row, h % self.dim] += sign * math.log1p(count)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """Embeddings from a sentence-transformers model (optional dependency)"""
+
+    def __init__(self, model_name: str):
+        # Imported here so the package is only needed when this embedder is chosen
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.signature = f"sentence-transformers:{model_name}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def create_embedder(name: Optional[str] = None) -> Embedder:
+    """
+    Build the embedder selected by RAG_EMBEDDER: "hashing" (the default,
+    RAG_EMBEDDING_DIM sets its size) or "sentence-transformers:<model>"
+    """
+    name = name or os.getenv("RAG_EMBEDDER", "hashing")
+    if name == "hashing":
+        return HashingEmbedder(dim=int(os.getenv("RAG_EMBEDDING_DIM", "384")))
+    if name.startswith("sentence-transformers:"):
+        return SentenceTransformerEmbedder(name.split(":", 1)[1])
+    raise ValueError(f"Unknown embedder {name}")
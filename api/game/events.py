@@ -0,0 +1,83 @@
+import json
+from typing import Any, Dict, Optional
+
+# How much history the live state keeps; older entries only live in the event log
+RECENT_ACTIONS_KEPT = 5
+FEEDBACK_KEPT = 10
+
+# Event types
+TURN = "turn"    # a choice was made: its impact, experience, score and feedback
+SCENE = "scene"  # the player moved to a scene
+MOOD = "mood"    # the companion's mood changed
+
+
+def turn_event(scene_id: str, choice_index: int, action: Optional[str], impact: Optional[Dict[str, int]],
+               experience: int) -> Dict[str, Any]:
+    """
+    A choice and everything needed to replay its effect without calling any
+    vendor. score and feedback are filled in once the choice has been
+    scored, before apply_score.
+    """
+    return {
+        "type": TURN,
+        "scene_id": scene_id,
+        "choice_index": choice_index,
+        # Remembered by the companion (only when the choice had an impact)
+        "action": action,
+        "impact": [impact["law_chaos"], impact["good_evil"], impact["trust"]] if impact is not None else None,
+        "experience": experience,
+        "score": 0,
+        "feedback": None,
+    }
+
+
+def apply_choice(player_state: Dict[str, Any], agent_state: Dict[str, Any], event: Dict[str, Any]) -> None:
+    """Alignment, trust, the companion's recent actions and experience from a turn event"""
+    if event["impact"] is not None:
+        law_chaos, good_evil, trust = event["impact"]
+        alignment = player_state["alignment"]
+        alignment["law_chaos"] = max(-100, min(100, alignment["law_chaos"] + law_chaos))
+        alignment["good_evil"] = max(-100, min(100, alignment["good_evil"] + good_evil))
+        agent_state["trust"] = max(0, min(100, agent_state["trust"] + trust))
+        remember_action(agent_state, event["action"])
+
+    player_state["experience"] += event["experience"]
+
+
+def remember_action(agent_state: Dict[str, Any], action: str) -> None:
+    """Add an action to the companion's recent actions, keeping the last RECENT_ACTIONS_KEPT"""
+    agent_state["recent_actions"].append(action)
+    if len(agent_state["recent_actions"]) > RECENT_ACTIONS_KEPT:
+        agent_state["recent_actions"] = agent_state["recent_actions"][-RECENT_ACTIONS_KEPT:]
+
+
+def apply_score(player_state: Dict[str, Any], event: Dict[str, Any]) -> None:
+    """Score and feedback history from a turn event"""
+    player_state["score"] += event["score"]
+
+    if event["feedback"] is not None:
+        player_state["feedback_history"].append(event["feedback"])
+        if len(player_state["feedback_history"]) > FEEDBACK_KEPT:
+            player_state["feedback_history"] = player_state["feedback_history"][-FEEDBACK_KEPT:]
+
+
+def apply_event(session, event: Dict[str, Any]) -> None:
+    """Replay one event onto a GameSession"""
+    event_type = event["type"]
+    if event_type == TURN:
+        apply_choice(session.player_state, session.agent_state, event)
+        apply_score(session.player_state, event)
+    elif event_type == SCENE:
+        session.current_scene = event["scene_id"]
+    elif event_type == MOOD:
+        session.agent_memory["mood"] = event["mood"]
+    else:
+        raise ValueError(f"Unknown event type {event_type}")
+
+
+def encode_event(event: Dict[str, Any]) -> str:
+    return json.dumps(event, separators=(",", ":"))
+
+
+def decode_event(data: str) -> Dict[str, Any]:
+    return json.loads(data)
@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# Default worker counts per vendor. Each can be overridden with an
+# EXECUTOR_<VENDOR>_WORKERS environment variable (e.g. EXECUTOR_MAESTRO_WORKERS=32).
+DEFAULT_POOL_SIZES = {
+    "maestro": 16,    # AI21 Maestro create/retrieve calls (runs are polled by MaestroRunManager)
+    "replicate": 8,   # Replicate image predictions
+    "sesame": 8,      # Sesame text-to-speech requests
+    "rag": 4,         # Local retrieval work
+    "default": 4,     # Anything without a dedicated pool
+}
+
+
+class VendorPool:
+    """A bounded thread pool for one upstream vendor, with queue-depth accounting"""
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.peak_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    def _submitted(self) -> float:
+        with self._lock:
+            self.queued += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.queued)
+        return time.perf_counter()
+
+    def _wrap(self, fn: Callable[..., Any], submitted_at: float) -> Callable[[], Any]:
+        def run():
+            started_at = time.perf_counter()
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.total_wait_time += started_at - submitted_at
+            failed = False
+            try:
+                return fn()
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.total_run_time += time.perf_counter() - started_at
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+        return run
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking callable on this pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        # Carry the caller's context (e.g. the request trace) into the worker thread
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, fn, *args, **kwargs)
+        submitted_at = self._submitted()
+        future = self.executor.submit(self._wrap(call, submitted_at))
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def _done(self, future) -> None:
+        if future.cancelled():
+            # Cancelled before a worker took it, so it never left the queue
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "peak_queue_depth": self.peak_queue_depth,
+                "avg_wait_ms": round(1000 * self.total_wait_time / finished, 2) if finished else 0.0,
+                "avg_run_ms": round(1000 * self.total_run_time / finished, 2) if finished else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class VendorExecutor:
+    """
+    Execution layer for the blocking vendor SDK calls (AI21 Maestro, Replicate, Sesame).
+
+    Each vendor gets its own bounded thread pool so a slow vendor can only
+    exhaust its own workers, and the asyncio event loop stays free to serve
+    other players while those calls are in flight.
+    """
+
+    def __init__(self, pool_sizes: Optional[Dict[str, int]] = None):
+        sizes = dict(DEFAULT_POOL_SIZES)
+        for vendor in sizes:
+            env_value = os.getenv(f"EXECUTOR_{vendor.upper()}_WORKERS")
+            if env_value:
+                sizes[vendor] = int(env_value)
+        if pool_sizes:
+            sizes.update(pool_sizes)
+
+        self.pools = {name: VendorPool(name, max(1, size)) for name, size in sizes.items()}
+
+    def pool(self, vendor: str) -> VendorPool:
+        """Return the pool for a vendor, falling back to the default pool"""
+        return self.pools.get(vendor, self.pools["default"])
+
+    async def run(self, vendor: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking vendor call on that vendor's pool"""
+        return await self.pool(vendor).run(fn, *args, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Queue depth and throughput counters for every pool"""
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    def shutdown(self) -> None:
+        for pool in self.pools.values():
+            pool.shutdown()
@@ -0,0 +1,120 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from api.game.scene_graph import SceneGraph
+
+# Columns of the state arrays, with the range each value is clamped to
+IMPACT_FIELDS = ("law_chaos", "good_evil", "trust")
+LOWER_BOUNDS = np.array([-100, -100, 0], dtype=np.int32)
+UPPER_BOUNDS = np.array([100, 100, 100], dtype=np.int32)
+
+
+class ImpactTable:
+    """
+    Every choice's effect on alignment and companion trust, compiled once
+    per campaign into flat arrays.
+
+    Row offsets[s] + c of `deltas` holds the (law_chaos, good_evil, trust)
+    change for choice c of scene s (the scene's index in the SceneGraph),
+    and `has_impact` says whether the campaign defined one. apply_batch()
+    updates a whole array of states with a handful of NumPy operations; a
+    normal turn looks up impact() and applies it through a turn event.
+    """
+
+    def __init__(self, scene_graph: SceneGraph):
+        self.scene_graph = scene_graph
+        scene_ids = scene_graph.scene_ids
+
+        counts = np.array([len(scene_graph.choices(scene_id)) for scene_id in scene_ids], dtype=np.int32)
+        self.choice_counts = counts
+        self.offsets = np.zeros(len(scene_ids), dtype=np.int32)
+        if len(scene_ids) > 1:
+            self.offsets[1:] = np.cumsum(counts)[:-1]
+
+        # At least one row so invalid choices can always be pointed at row 0
+        total = max(1, int(counts.sum()))
+        self.deltas = np.zeros((total, len(IMPACT_FIELDS)), dtype=np.int32)
+        self.has_impact = np.zeros(total, dtype=bool)
+        # Plain tuples for the per-request path, where NumPy's call overhead dominates
+        self._impacts: Dict[str, Tuple[Optional[Tuple[int, ...]], ...]] = {}
+
+        for scene_index, scene_id in enumerate(scene_ids):
+            impacts = scene_graph.scene(scene_id).get("impacts")
+            rows: List[Optional[Tuple[int, ...]]] = [None] * int(counts[scene_index])
+            if impacts:
+                offset = int(self.offsets[scene_index])
+                for choice_index, impact in enumerate(impacts):
+                    row = tuple(int(impact.get(field, 0)) for field in IMPACT_FIELDS)
+                    self.deltas[offset + choice_index] = row
+                    self.has_impact[offset + choice_index] = True
+                    rows[choice_index] = row
+            self._impacts[scene_id] = tuple(rows)
+
+        self.deltas.setflags(write=False)
+        self.has_impact.setflags(write=False)
+
+    def impact(self, scene_id: str, choice_index: int) -> Optional[Dict[str, int]]:
+        """The effect of one choice, or None if the campaign doesn't define one"""
+        rows = self._impacts.get(scene_id, ())
+        if not 0 <= choice_index < len(rows) or rows[choice_index] is None:
+            return None
+        return dict(zip(IMPACT_FIELDS, rows[choice_index]))
+
+    def scene_indices(self, scene_ids: Sequence[str]) -> np.ndarray:
+        """Map scene IDs to the integer indices apply_batch() takes"""
+        index_of = self.scene_graph.index_of
+        return np.fromiter((index_of(scene_id) for scene_id in scene_ids), dtype=np.int32, count=len(scene_ids))
+
+    def apply_batch(self, states: np.ndarray, scenes: Union[np.ndarray, Sequence[str]],
+                    choices: Union[np.ndarray, Sequence[int]], out: Optional[np.ndarray] = None
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply one transition to each row of an (n, 3) array of
+        (law_chaos, good_evil, trust) states and clamp the results.
+
+        scenes holds scene indices (see scene_indices()) or scene IDs and
+        choices the choice made in each. Choices that are out of range or
+        have no defined impact leave their row unchanged. Each row gets a
+        single transition, so a player making several moves needs one call
+        per move. Writes into `out` when given (which may be `states`
+        itself) and returns (new_states, applied_mask).
+        """
+        states = np.asarray(states)
+        if states.ndim != 2 or states.shape[1] != len(IMPACT_FIELDS):
+            raise ValueError(f"states must have shape (n, {len(IMPACT_FIELDS)})")
+        if len(scenes) and not isinstance(scenes, np.ndarray) and isinstance(scenes[0], str):
+            scenes = self.scene_indices(scenes)
+        scenes = np.asarray(scenes, dtype=np.int32)
+        choices = np.asarray(choices, dtype=np.int32)
+        if not len(scenes) == len(choices) == len(states):
+            raise ValueError("states, scenes and choices must have the same length")
+
+        valid = (choices >= 0) & (choices < self.choice_counts[scenes])
+        rows = np.where(valid, self.offsets[scenes] + choices, 0)
+        applied = valid & self.has_impact[rows]
+        deltas = self.deltas[rows] * applied[:, None]
+
+        if out is None:
+            out = np.empty(states.shape, dtype=np.result_type(states.dtype, np.int32))
+        np.add(states, deltas, out=out, casting="unsafe")
+        np.clip(out, LOWER_BOUNDS, UPPER_BOUNDS, out=out)
+        return out, applied
+
+
+def pack_states(player_states: Sequence[Dict[str, Any]], agent_states: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """(law_chaos, good_evil, trust) rows for a list of player/agent states"""
+    return np.array(
+        [(player["alignment"]["law_chaos"], player["alignment"]["good_evil"], agent["trust"])
+         for player, agent in zip(player_states, agent_states)],
+        dtype=np.int32
+    ).reshape(-1, len(IMPACT_FIELDS))
+
+
+def unpack_states(states: np.ndarray, player_states: Sequence[Dict[str, Any]],
+                  agent_states: Sequence[Dict[str, Any]]) -> None:
+    """Write rows produced by apply_batch() back into the state dicts"""
+    for (law_chaos, good_evil, trust), player, agent in zip(states.tolist(), player_states, agent_states):
+        player["alignment"]["law_chaos"] = law_chaos
+        player["alignment"]["good_evil"] = good_evil
+        agent["trust"] = trust
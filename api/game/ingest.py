@@ -0,0 +1,565 @@
+"""
+Streaming ingestion of lore documents into the retrieval index.
+
+Reads JSON arrays or JSON lines of {"id", "title", "text", "metadata"}
+documents without loading the whole file, splits long texts into
+overlapping passages, drops passages already in the index (by content
+hash), embeds them in batches on a process pool and writes the result as
+index segments of about --segment-passages passages each. Progress is
+checkpointed after every segment, so an interrupted run picks up where it
+stopped. The source's segments replace its previous ones in the manifest
+once the whole file is in; running servers pick them up within
+RAG_RELOAD_INTERVAL_SEC.
+
+Documents added, updated or deleted through the API (Ingester.upsert and
+delete) win over the files: a re-ingested file skips their ids.
+
+    python -m api.game.ingest lore/northern_kingdoms.jsonl --workers 4
+    python -m api.game.ingest dump.json --index data/faiss_index --restart
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from api.game.coalesce import normalize_text
+from api.game.embeddings import Embedder, create_embedder
+from api.game.segment import (
+    LIVE_SOURCE, PASSAGE_OVERLAP, PASSAGE_WORDS, Segment, index_lock, index_settings, manifest_segments,
+    publish_segment, read_manifest, remove_unused_segments, segment_path, stage_segment, write_manifest,
+)
+
+# Bytes read at a time from a JSON array
+READ_CHUNK = 1 << 20
+# A source's small segments are merged once it has this many
+MERGE_FACTOR = 8
+# A segment with this share of its documents deleted is rewritten without them
+MERGE_DELETED_RATIO = 0.2
+
+
+def split_passages(text: str, words: int = PASSAGE_WORDS, overlap: int = PASSAGE_OVERLAP) -> List[str]:
+    tokens = text.split()
+    if len(tokens) <= words:
+        return [text]
+    step = words - overlap
+    return [" ".join(tokens[start:start + words]) for start in range(0, len(tokens) - overlap, step)]
+
+
+def passage_hash(text: str) -> int:
+    """64-bit content hash; passages that differ only in case or spacing collide on purpose"""
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _iter_json_array(f) -> Iterator[Any]:
+    """The elements of a top-level JSON array, decoded one at a time"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace and separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array of documents")
+            started = True
+            position += 1
+            continue
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError("need more data")
+            item, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                if buffer[position:].strip():
+                    raise ValueError("Truncated JSON array")
+                return
+            chunk = f.read(READ_CHUNK)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        position = end
+
+
+def iter_documents(path: str) -> Iterator[Dict[str, Any]]:
+    """Documents from a .jsonl/.ndjson file (one per line) or a JSON array, streamed"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f)
+
+
+def file_fingerprint(path: str, settings: str) -> str:
+    digest = hashlib.sha256(settings.encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_stat(path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Embedder of each pool worker process
+_worker_embedder: Optional[Embedder] = None
+
+
+def _init_worker(embedder: Embedder) -> None:
+    global _worker_embedder
+    _worker_embedder = embedder
+
+
+def _embed(passages: List[str]) -> np.ndarray:
+    return _worker_embedder.embed(passages)
+
+
+class Ingester:
+    """
+    Ingests document files into the index at index_path, one source file
+    at a time (see the module docstring). workers > 0 embeds on that many
+    processes, batch_size passages per task.
+
+    upsert() and delete() change single documents while the index is in
+    use: an upsert appends a small segment to the live source and a delete
+    tombstones the document in the manifest. merge() folds the small
+    segments back together and drops tombstoned documents.
+    """
+
+    def __init__(self, index_path: str, embedder: Optional[Embedder] = None, vector_dtype: Optional[str] = None,
+                 workers: int = 0, batch_size: int = 256, segment_passages: int = 20000,
+                 merge_factor: int = MERGE_FACTOR):
+        self.index_path = index_path
+        self.embedder = embedder or create_embedder()
+        self.vector_dtype = vector_dtype or os.getenv("RAG_VECTOR_DTYPE", "float32")
+        self.settings = index_settings(self.embedder.signature, self.vector_dtype)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.segment_passages = segment_passages
+        self.merge_factor = merge_factor
+
+    def is_current(self, source: str, manifest: Optional[Dict[str, Any]] = None) -> bool:
+        """Whether source is in the index, built with these settings from an unchanged file (by size and mtime)"""
+        source = os.path.normpath(source)
+        manifest = manifest if manifest is not None else read_manifest(self.index_path)
+        entry = manifest.get("sources", {}).get(source)
+        return (manifest.get("settings") == self.settings and entry is not None
+                and entry.get("stat") == file_stat(source))
+
+    def _checkpoint_path(self, source: str) -> str:
+        slug = re.sub(r"[^a-z0-9]+", "-", source.lower()).strip("-")
+        return os.path.join(self.index_path, "ingest", f"{slug}.json")
+
+    def _save_checkpoint(self, source: str, checkpoint: Dict[str, Any]) -> None:
+        path = self._checkpoint_path(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _load_checkpoint(self, source: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._checkpoint_path(source)) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get("fingerprint") != fingerprint:
+            return None
+        if not all(os.path.isdir(segment_path(self.index_path, name)) for name in checkpoint["segments"]):
+            return None
+        return checkpoint
+
+    def _seen_hashes(self, manifest: Dict[str, Any], source: str, segments: List[str]) -> Set[int]:
+        """Passage hashes already in the index, other than in the segments this ingestion replaces"""
+        names = [name for other, entry in manifest.get("sources", {}).items() if other != source
+                 for name in entry["segments"]] + segments
+        seen: Set[int] = set()
+        for name in names:
+            hashes = np.load(os.path.join(segment_path(self.index_path, name), "passage_hashes.npy"), mmap_mode="r")
+            seen.update(hashes.tolist())
+        return seen
+
+    def ingest(self, source: str, resume: bool = True) -> Dict[str, Any]:
+        """Ingest one file; returns counts of what was read, skipped and written"""
+        source = os.path.normpath(source)
+        started_at = time.perf_counter()
+        with index_lock(self.index_path, name=f"ingest-{hashlib.sha1(source.encode()).hexdigest()[:12]}"):
+            stat = file_stat(source)
+            fingerprint = file_fingerprint(source, self.settings)
+            manifest = read_manifest(self.index_path)
+            entry = manifest.get("sources", {}).get(source)
+            if manifest.get("settings") == self.settings and entry and entry["fingerprint"] == fingerprint:
+                if entry.get("stat") != stat:
+                    self._commit(source, {**entry, "stat": stat})
+                return {"source": source, "status": "unchanged", "segments": len(entry["segments"])}
+            if manifest.get("settings") not in (None, self.settings):
+                # Vectors from another embedder (or other settings) can't be searched together
+                manifest = {}
+
+            checkpoint = self._load_checkpoint(source, fingerprint) if resume else None
+            if checkpoint is None:
+                checkpoint = {"fingerprint": fingerprint, "records": 0, "segments": [], "documents": 0,
+                              "passages": 0, "duplicates": 0, "skipped": 0}
+            resumed_from = checkpoint["records"]
+            seen = self._seen_hashes(manifest, source, checkpoint["segments"])
+            edited = set(manifest.get("edited", []))
+
+            pool = None
+            if self.workers > 0:
+                pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"),
+                                           initializer=_init_worker, initargs=(self.embedder,))
+            try:
+                self._run(source, checkpoint, seen, edited, pool)
+            finally:
+                if pool:
+                    pool.shutdown()
+
+            self._commit(source, {
+                "fingerprint": fingerprint,
+                "stat": stat,
+                "segments": checkpoint["segments"],
+                "documents": checkpoint["documents"],
+                "passages": checkpoint["passages"],
+            })
+            os.remove(self._checkpoint_path(source))
+            with index_lock(self.index_path):
+                remove_unused_segments(self.index_path, manifest_segments(read_manifest(self.index_path)))
+
+        return {
+            "source": source,
+            "status": "ingested",
+            "resumed_from_record": resumed_from,
+            "records": checkpoint["records"],
+            "documents": checkpoint["documents"],
+            "passages": checkpoint["passages"],
+            "duplicate_passages": checkpoint["duplicates"],
+            "skipped_records": checkpoint["skipped"],
+            "segments": len(checkpoint["segments"]),
+            "seconds": round(time.perf_counter() - started_at, 1),
+        }
+
+    @staticmethod
+    def _passages(doc: Dict[str, Any]) -> Iterator[Tuple[int, str]]:
+        """(body hash, indexed text) of each passage of a document"""
+        for passage in split_passages(doc["text"]):
+            # Dedup on the body alone, so text republished under another title is caught
+            yield passage_hash(passage), f"{doc['title']}. {passage}" if doc["title"] else passage
+
+    def _run(self, source: str, checkpoint: Dict[str, Any], seen: Set[int], edited: Set[Any], pool) -> None:
+        documents: List[Dict[str, Any]] = []
+        passage_counts: List[int] = []
+        passages: List[str] = []
+        hashes: List[int] = []
+        records = checkpoint["records"]
+
+        for doc in itertools.islice(iter_documents(source), records, None):
+            records += 1
+            if not isinstance(doc, dict) or not isinstance(doc.get("text"), str):
+                checkpoint["skipped"] += 1
+                continue
+            doc.setdefault("id", f"{source}#{records - 1}")
+            doc.setdefault("title", "")
+            if doc["id"] in edited:
+                # Changed or deleted through the API since; that version stands
+                checkpoint["skipped"] += 1
+                continue
+            count = 0
+            for digest, text in self._passages(doc):
+                if digest in seen:
+                    checkpoint["duplicates"] += 1
+                    continue
+                seen.add(digest)
+                passages.append(text)
+                hashes.append(digest)
+                count += 1
+            if count:
+                documents.append(doc)
+                passage_counts.append(count)
+            if len(passages) >= self.segment_passages:
+                self._write_segment(source, checkpoint, records, documents, passage_counts, passages, hashes, pool)
+                documents, passage_counts, passages, hashes = [], [], [], []
+
+        if documents or records > checkpoint["records"]:
+            self._write_segment(source, checkpoint, records, documents, passage_counts, passages, hashes, pool)
+
+    def _embed(self, passages: List[str], pool) -> np.ndarray:
+        if not passages:
+            return np.zeros((0, self.embedder.dim), dtype=np.float32)
+        batches = [passages[start:start + self.batch_size] for start in range(0, len(passages), self.batch_size)]
+        if pool is None:
+            return np.concatenate([self.embedder.embed(batch) for batch in batches])
+        return np.concatenate(list(pool.map(_embed, batches)))
+
+    def _write_segment(self, source: str, checkpoint: Dict[str, Any], records: int, documents: List[Dict[str, Any]],
+                       passage_counts: List[int], passages: List[str], hashes: List[int], pool) -> None:
+        staged = None
+        if documents:
+            name = f"{checkpoint['fingerprint'][:12]}-{len(checkpoint['segments']):05d}"
+            staged = stage_segment(self.index_path, Segment.build(
+                name, documents, passage_counts, passages, self._embed(passages, pool),
+                np.array(hashes, dtype=np.uint64), self.vector_dtype))
+        try:
+            # Under the lock, so a concurrent cleanup sees the segment in the checkpoint
+            with index_lock(self.index_path):
+                if staged:
+                    shutil.rmtree(segment_path(self.index_path, name), ignore_errors=True)
+                    publish_segment(self.index_path, staged, name)
+                    staged = None
+                    checkpoint["segments"].append(name)
+                    checkpoint["documents"] += len(documents)
+                    checkpoint["passages"] += len(passages)
+                checkpoint["records"] = records
+                self._save_checkpoint(source, checkpoint)
+        finally:
+            if staged:
+                shutil.rmtree(staged, ignore_errors=True)
+        print(f"{source}: {records} records, {checkpoint['documents']} documents, "
+              f"{checkpoint['passages']} passages in {len(checkpoint['segments'])} segments")
+
+    def _read_manifest(self, source: str) -> Dict[str, Any]:
+        """The manifest to update with source's segments; call with the manifest lock held"""
+        manifest = read_manifest(self.index_path)
+        if manifest.get("settings") != self.settings:
+            dropped = [other for other in manifest.get("sources", {}) if other != source]
+            if dropped:
+                print(f"Index settings changed; re-ingest {', '.join(dropped)}")
+            manifest = {"settings": self.settings, "sources": {}}
+        return manifest
+
+    def _commit(self, source: str, entry: Dict[str, Any]) -> None:
+        """Point the manifest at the source's new segments"""
+        with index_lock(self.index_path):
+            manifest = self._read_manifest(source)
+            manifest["sources"][source] = entry
+            write_manifest(self.index_path, manifest)
+
+    def upsert(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Add documents to the live source as one new segment, replacing any
+        document with the same id wherever it is. Every document needs an
+        id and a text. Returns counts of what was written.
+        """
+        latest: Dict[Any, Dict[str, Any]] = {}
+        for doc in documents:
+            if not isinstance(doc, dict) or not isinstance(doc.get("text"), str) or doc.get("id") is None:
+                raise ValueError("Every document needs an id and a text")
+            # The last version of an id in the batch wins
+            latest.pop(doc["id"], None)
+            latest[doc["id"]] = {**doc, "title": doc.get("title") or ""}
+
+        passage_counts: List[int] = []
+        passages: List[str] = []
+        hashes: List[int] = []
+        for doc in latest.values():
+            # No dedup against the index: an update may repeat its old text
+            doc_passages = list(self._passages(doc))
+            passage_counts.append(len(doc_passages))
+            hashes.extend(digest for digest, _ in doc_passages)
+            passages.extend(text for _, text in doc_passages)
+        name = f"{LIVE_SOURCE}-{uuid.uuid4().hex[:12]}"
+        staged = None
+        if latest:
+            staged = stage_segment(self.index_path, Segment.build(
+                name, list(latest.values()), passage_counts, passages, self._embed(passages, None),
+                np.array(hashes, dtype=np.uint64), self.vector_dtype))
+
+        try:
+            with index_lock(self.index_path):
+                manifest = self._read_manifest(LIVE_SOURCE)
+                replaced = self._tombstone(manifest, latest)
+                if staged:
+                    publish_segment(self.index_path, staged, name)
+                    staged = None
+                    entry = manifest["sources"].setdefault(LIVE_SOURCE, {"segments": [], "documents": 0, "passages": 0})
+                    entry["segments"].append(name)
+                    entry["documents"] += len(latest)
+                    entry["passages"] += len(passages)
+                self._mark_edited(manifest, latest)
+                write_manifest(self.index_path, manifest)
+        finally:
+            if staged:
+                shutil.rmtree(staged, ignore_errors=True)
+        return {"documents": len(latest), "replaced": replaced, "passages": len(passages)}
+
+    def delete(self, doc_ids: Iterable[Any]) -> int:
+        """Tombstone the documents with these ids; returns how many were found"""
+        doc_ids = list(dict.fromkeys(doc_ids))
+        with index_lock(self.index_path):
+            manifest = read_manifest(self.index_path)
+            if manifest.get("settings") != self.settings:
+                return 0
+            deleted = self._tombstone(manifest, doc_ids)
+            if deleted:
+                self._mark_edited(manifest, doc_ids)
+                write_manifest(self.index_path, manifest)
+        return deleted
+
+    def _tombstone(self, manifest: Dict[str, Any], doc_ids: Iterable[Any]) -> int:
+        """Record the live documents with these ids as deleted in the manifest; returns how many there were"""
+        doc_ids = list(doc_ids)
+        tombstones = manifest.setdefault("deleted", {})
+        count = 0
+        for name in manifest_segments(manifest):
+            segment = Segment.open(segment_path(self.index_path, name), tombstones.get(name, ()))
+            found = [doc_index for doc_id in doc_ids for doc_index in segment.find(doc_id)]
+            segment.close()
+            if found:
+                tombstones[name] = sorted(set(tombstones.get(name, [])).union(found))
+                count += len(found)
+        return count
+
+    @staticmethod
+    def _mark_edited(manifest: Dict[str, Any], doc_ids: Iterable[Any]) -> None:
+        manifest["edited"] = sorted(set(manifest.get("edited", [])).union(doc_ids), key=str)
+
+    def merge(self) -> int:
+        """
+        Merge segments in the background of a running index: per source,
+        once merge_factor of its segments are smaller than segment_passages,
+        or any has MERGE_DELETED_RATIO of its documents deleted, those are
+        rewritten as one segment without the deleted documents. Passages
+        and vectors are copied, not re-embedded. Readers keep using the old
+        segments until the manifest points at the new one. Returns the
+        number of merges.
+        """
+        merged = 0
+        # One merge at a time across processes
+        with index_lock(self.index_path, name="merge"):
+            manifest = read_manifest(self.index_path)
+            if manifest.get("settings") != self.settings:
+                return merged
+            for source, entry in manifest["sources"].items():
+                segments = self._merge_candidates(entry["segments"], manifest.get("deleted", {}))
+                if segments and self._merge(source, segments):
+                    merged += 1
+            if merged:
+                with index_lock(self.index_path):
+                    remove_unused_segments(self.index_path, manifest_segments(read_manifest(self.index_path)))
+        return merged
+
+    def _merge_candidates(self, names: List[str], tombstones: Dict[str, List[int]]) -> List[Segment]:
+        segments = [Segment.open(segment_path(self.index_path, name), tombstones.get(name, ())) for name in names]
+        small = [segment for segment in segments
+                 if (len(segment) if segment.live is None else len(segment.live)) < self.segment_passages]
+        if len(small) < self.merge_factor:
+            small = []
+        chosen = {segment.name for segment in small}
+        chosen.update(segment.name for segment in segments
+                      if len(segment.deleted) and len(segment.deleted) >= MERGE_DELETED_RATIO * len(segment.documents))
+        for segment in segments:
+            if segment.name not in chosen:
+                segment.close()
+        return [segment for segment in segments if segment.name in chosen]
+
+    def _merge(self, source: str, segments: List[Segment]) -> bool:
+        documents: List[Dict[str, Any]] = []
+        passage_counts: List[int] = []
+        passages: List[str] = []
+        hashes: List[int] = []
+        vectors = []
+        # (segment, document index) -> document index in the merged segment
+        positions: Dict[Tuple[str, int], int] = {}
+        for segment in segments:
+            deleted = set(segment.deleted.tolist())
+            for doc_index in range(len(segment.documents)):
+                if doc_index in deleted:
+                    continue
+                start, end = int(segment.passage_offsets[doc_index]), int(segment.passage_offsets[doc_index + 1])
+                doc = segment.documents[doc_index]
+                doc_hashes = segment.passage_hashes[start:end].tolist()
+                # The indexed passages are those of the document whose hashes were kept, in order
+                texts = []
+                for digest, text in self._passages(doc):
+                    if len(texts) < len(doc_hashes) and digest == doc_hashes[len(texts)]:
+                        texts.append(text)
+                if len(texts) != len(doc_hashes):
+                    raise ValueError(f"Segment {segment.name} doesn't match its documents")
+                positions[segment.name, doc_index] = len(documents)
+                documents.append(doc)
+                passage_counts.append(end - start)
+                passages.extend(texts)
+                hashes.extend(doc_hashes)
+            live_ids = np.arange(len(segment)) if segment.live is None else segment.live
+            vectors.append(segment.index.reconstruct(live_ids))
+            segment.close()
+
+        name = f"merged-{uuid.uuid4().hex[:12]}"
+        staged = None
+        if documents:
+            staged = stage_segment(self.index_path, Segment.build(
+                name, documents, passage_counts, passages, np.concatenate(vectors),
+                np.array(hashes, dtype=np.uint64), self.vector_dtype))
+
+        names = [segment.name for segment in segments]
+        try:
+            with index_lock(self.index_path):
+                manifest = read_manifest(self.index_path)
+                entry = manifest.get("sources", {}).get(source)
+                if (manifest.get("settings") != self.settings or entry is None
+                        or not set(names) <= set(entry["segments"])):
+                    # The source was re-ingested meanwhile
+                    return False
+                tombstones = manifest.setdefault("deleted", {})
+                # Documents deleted while this merge ran
+                late = [positions[old_name, doc_index]
+                        for old_name in names for doc_index in tombstones.get(old_name, [])
+                        if (old_name, doc_index) in positions]
+                remaining = [other for other in entry["segments"] if other not in names]
+                if staged:
+                    publish_segment(self.index_path, staged, name)
+                    staged = None
+                    remaining.insert(entry["segments"].index(names[0]), name)
+                    if late:
+                        tombstones[name] = sorted(late)
+                entry["segments"] = remaining
+                write_manifest(self.index_path, manifest)
+        finally:
+            if staged:
+                shutil.rmtree(staged, ignore_errors=True)
+        print(f"Merged {len(names)} segments of {source}: {len(documents)} documents, {len(passages)} passages")
+        return True
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Ingest lore documents into the retrieval index")
+    parser.add_argument("sources", nargs="+", help="JSON array or JSON lines files of documents")
+    parser.add_argument("--index", default="data/faiss_index", help="Index directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Embedding processes (0: inline)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Passages per embedding task")
+    parser.add_argument("--segment-passages", type=int, default=20000, help="Passages per index segment")
+    parser.add_argument("--restart", action="store_true", help="Ignore checkpoints and start each file over")
+    args = parser.parse_args(argv)
+
+    ingester = Ingester(args.index, workers=args.workers, batch_size=args.batch_size,
+                        segment_passages=args.segment_passages)
+    for source in args.sources:
+        print(json.dumps(ingester.ingest(source, resume=not args.restart)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
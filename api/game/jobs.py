@@ -0,0 +1,332 @@
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from api.game.metrics import cache_hits, cache_misses
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+UNFINISHED_STATUSES = (QUEUED, RUNNING)
+FINISHED_STATUSES = (COMPLETED, FAILED)
+# Columns added after the first release, created on existing databases at startup
+LEASE_COLUMNS = (("owner", "TEXT"), ("lease_until", "REAL"))
+
+
+def job_id_for(kind: str, params: Dict[str, Any]) -> str:
+    """
+    Jobs are identified by a hash of their inputs, so submitting the same
+    image or speech request twice returns the job that already exists.
+    """
+    payload = json.dumps([kind, params], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class JobStore:
+    """
+    SQLite persistence for media jobs, shared by every worker on the host.
+
+    An unfinished job is owned by the worker running it until its lease
+    expires; the owner renews the lease while it works, so another worker
+    only takes over (claim) jobs whose owner has stopped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, "
+                "status TEXT NOT NULL, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT, lease_until REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in LEASE_COLUMNS:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_to_job(row) -> Dict[str, Any]:
+        return {
+            "job_id": row[0],
+            "kind": row[1],
+            "params": json.loads(row[2]),
+            "status": row[3],
+            "result": row[4],
+            "error": row[5],
+            "created_at": row[6],
+            "updated_at": row[7],
+        }
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT job_id, kind, params, status, result, error, created_at, updated_at FROM jobs WHERE job_id = ?",
+            (job_id,)
+        ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def create(self, job_id: str, kind: str, params: Dict[str, Any], owner: str, lease: float,
+               result_ttl: Optional[float] = None) -> bool:
+        """
+        Insert a queued job owned by `owner` for `lease` seconds. A failed job
+        with the same ID, or one that completed more than `result_ttl`
+        seconds ago, is reset so it runs again; returns False if the job
+        already exists and is unfinished or has a fresh result.
+        """
+        now = time.time()
+        # With no TTL nothing completed before the epoch, so results never expire
+        expired_before = now - result_ttl if result_ttl is not None else 0.0
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (job_id, kind, params, status, created_at, updated_at, owner, lease_until) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET status = excluded.status, result = NULL, error = NULL, "
+                "updated_at = excluded.updated_at, owner = excluded.owner, lease_until = excluded.lease_until "
+                "WHERE jobs.status = ? OR (jobs.status = ? AND jobs.updated_at < ?)",
+                (job_id, kind, json.dumps(params), QUEUED, now, now, owner, now + lease, FAILED, COMPLETED,
+                 expired_before)
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, job_id: str, owner: str, lease: float) -> bool:
+        """Take over an unfinished job that has no owner or whose lease expired; False if another worker holds it"""
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ?, updated_at = ? "
+                "WHERE job_id = ? AND status IN (?, ?) AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?)",
+                (owner, now + lease, now, job_id, *UNFINISHED_STATUSES, now)
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, job_id: str, owner: str, lease: float) -> bool:
+        """Extend the owner's lease on a job; False if the job is no longer theirs"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ?",
+                (time.time() + lease, job_id, owner)
+            )
+        return cursor.rowcount == 1
+
+    def update(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None,
+               owner: Optional[str] = None) -> None:
+        """Set a job's status; given an owner, only if the job is still theirs"""
+        conn = self._connection()
+        with conn:
+            if owner is None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                    (status, result, error, time.time(), job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ? AND owner = ?",
+                    (status, result, error, time.time(), job_id, owner)
+                )
+
+    def release(self, owner: str) -> int:
+        """Give up an owner's unfinished jobs so any worker can claim them straight away"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET owner = NULL, lease_until = NULL WHERE owner = ? AND status IN (?, ?)",
+                (owner, *UNFINISHED_STATUSES)
+            )
+        return cursor.rowcount
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs last updated more than `older_than` seconds ago; returns how many"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (*FINISHED_STATUSES, time.time() - older_than)
+            )
+        return cursor.rowcount
+
+    def stale(self) -> List[Dict[str, Any]]:
+        """Unfinished jobs that no live worker holds: no owner, or the owner's lease expired"""
+        rows = self._connection().execute(
+            "SELECT job_id, kind, params, status, result, error, created_at, updated_at FROM jobs "
+            "WHERE status IN (?, ?) AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?) ORDER BY created_at",
+            (*UNFINISHED_STATUSES, time.time())
+        ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+
+class MediaJobQueue:
+    """
+    Runs image and speech generation in the background.
+
+    submit() returns a job ID straight away; the work runs on the vendor's
+    executor pool with at most max_concurrency jobs in flight, and the job's
+    status and result are persisted so they survive an API worker restart.
+
+    Each queue owns the jobs it runs for a lease of `lease` seconds
+    (MEDIA_JOB_LEASE_SEC), renewed every lease / 3 while the job waits or
+    runs. resume() only claims jobs whose owner's lease has expired, so a
+    worker starting up doesn't rerun jobs other live workers are running.
+    watch() calls it every lease seconds, so the jobs of a worker that died
+    are picked up once its leases run out; shutdown() releases this queue's
+    jobs so they are picked up at once.
+
+    Results are reused for `result_ttl` seconds (MEDIA_JOB_RESULT_TTL_SEC):
+    Replicate's output URLs expire after an hour, so an identical request
+    after that runs the job again, and watch() purges finished jobs older
+    than that from the store.
+    """
+
+    def __init__(self, store: JobStore, executor, max_concurrency: Optional[int] = None,
+                 lease: Optional[float] = None, result_ttl: Optional[float] = None):
+        self.store = store
+        self.executor = executor
+        self.max_concurrency = max_concurrency or int(os.getenv("MEDIA_JOB_CONCURRENCY", "8"))
+        self.lease = lease or float(os.getenv("MEDIA_JOB_LEASE_SEC", "30"))
+        self.result_ttl = result_ttl or float(os.getenv("MEDIA_JOB_RESULT_TTL_SEC", "3000"))
+        # Unique per queue, so a restarted worker that reuses a pid doesn't inherit the old leases
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # kind -> (executor vendor, callable taking the job params as keyword arguments, fallback result)
+        self._handlers: Dict[str, Tuple[str, Callable[..., str], Optional[str]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._watcher: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, vendor: str, handler: Callable[..., str], fallback: Optional[str] = None) -> None:
+        """
+        Register a job kind. Handlers swallow vendor errors and return a
+        fallback URL; a job returning `fallback` is recorded as failed (with
+        the fallback as its result) so that resubmitting it retries the vendor.
+        """
+        self._handlers[kind] = (vendor, handler, fallback)
+
+    async def submit(self, kind: str, **params) -> str:
+        """Queue a job (or join an identical existing one) and return its ID"""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        job_id = job_id_for(kind, params)
+        created = await self.executor.run("default", self.store.create, job_id, kind, params, self.owner, self.lease,
+                                          self.result_ttl)
+        if created:
+            cache_misses.inc(cache=f"{kind}_job")
+            self._start(job_id, kind, params)
+        else:
+            cache_hits.inc(cache=f"{kind}_job")
+        return job_id
+
+    def _start(self, job_id: str, kind: str, params: Dict[str, Any]) -> None:
+        if job_id in self._tasks:
+            return
+        task = asyncio.ensure_future(self._run(job_id, kind, params))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, job_id: str, kind: str, params: Dict[str, Any]) -> None:
+        vendor, handler, fallback = self._handlers[kind]
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+        try:
+            async with self._semaphore:
+                await self.executor.run("default", self.store.update, job_id, RUNNING, owner=self.owner)
+                try:
+                    result = await self.executor.run(vendor, handler, **params)
+                except Exception as e:
+                    print(f"Media job {job_id} ({kind}) failed: {e}")
+                    await self.executor.run("default", self.store.update, job_id, FAILED, None, str(e),
+                                            owner=self.owner)
+                else:
+                    status = FAILED if fallback is not None and result == fallback else COMPLETED
+                    await self.executor.run("default", self.store.update, job_id, status, result, owner=self.owner)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: str) -> None:
+        """Keep renewing this queue's lease on a job until the job finishes"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await self.executor.run("default", self.store.renew, job_id, self.owner, self.lease)
+            except Exception as e:
+                print(f"Error renewing the lease on media job {job_id}: {e}")
+                continue
+            if not renewed:
+                print(f"Media job {job_id} was taken over by another worker")
+                return
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Current status of a job, without its input parameters"""
+        job = await self.executor.run("default", self.store.get, job_id)
+        if job is None:
+            return None
+        job.pop("params")
+        return job
+
+    async def resume(self) -> int:
+        """Claim and restart unfinished jobs no live worker holds; returns how many"""
+        jobs = await self.executor.run("default", self.store.stale)
+        resumed = 0
+        for job in jobs:
+            if job["kind"] not in self._handlers:
+                continue
+            if await self.executor.run("default", self.store.claim, job["job_id"], self.owner, self.lease):
+                self._start(job["job_id"], job["kind"], job["params"])
+                resumed += 1
+        return resumed
+
+    def watch(self) -> None:
+        """
+        Resume jobs abandoned by other workers, and purge expired results,
+        in the background every lease seconds
+        """
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._watch())
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease)
+            try:
+                resumed = await self.resume()
+            except Exception as e:
+                print(f"Error resuming media jobs: {e}")
+                continue
+            if resumed:
+                print(f"Resumed {resumed} media jobs abandoned by another worker")
+            try:
+                await self.executor.run("default", self.store.purge, self.result_ttl)
+            except Exception as e:
+                print(f"Error purging media jobs: {e}")
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def shutdown(self) -> None:
+        # Unfinished jobs stay queued/running in the store, released for the next worker to resume
+        if self._watcher is not None:
+            self._watcher.cancel()
+        for task in list(self._tasks.values()):
+            task.cancel()
+        try:
+            self.store.release(self.owner)
+        except Exception as e:
+            print(f"Error releasing media jobs: {e}")
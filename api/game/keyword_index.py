@@ -0,0 +1,129 @@
+import json
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from api.game.embeddings import tokenize
+from api.game.metadata_index import sorted_contains
+
+# Okapi BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class BM25Index:
+    """
+    Inverted index with BM25 scoring over a fixed set of texts.
+
+    Each term's postings (the texts containing it) are stored contiguously,
+    together with the term's full BM25 weight in each of them: idf, term
+    frequency and length normalization are all computed once at build
+    time. A query only touches the postings of its own terms and sums their
+    weights, so its cost depends on how common the query terms are rather
+    than on the size of the corpus.
+
+    Terms are kept sorted and looked up by binary search, so a saved index
+    opens memory-mapped without building a vocabulary dict.
+    """
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, postings: np.ndarray, weights: np.ndarray,
+                 count: int):
+        # Sorted; term t is terms[t]
+        self.terms = terms
+        # Postings of term t are postings[offsets[t]:offsets[t + 1]]
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        self.count = count
+
+    @classmethod
+    def build(cls, texts: List[str], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        vocabulary: Dict[str, int] = {}
+        term_ids = []
+        doc_ids = []
+        freqs = []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[doc_id] = len(tokens)
+            for term, freq in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                freqs.append(freq)
+
+        # Renumber the terms in sorted order
+        terms = np.array(sorted(vocabulary), dtype=str)
+        sorted_ids = np.empty(len(vocabulary), dtype=np.int64)
+        sorted_ids[[vocabulary[term] for term in terms.tolist()]] = np.arange(len(vocabulary))
+        term_ids = sorted_ids[np.array(term_ids, dtype=np.int64)] if term_ids else np.zeros(0, dtype=np.int64)
+        doc_ids = np.array(doc_ids, dtype=np.int32)
+        freqs = np.array(freqs, dtype=np.float32)
+
+        doc_freqs = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.float32)
+        idf = np.log1p((len(texts) - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        average_length = float(lengths.mean()) if len(texts) else 0.0
+        norms = k1 * (1 - b + b * lengths[doc_ids] / max(average_length, 1.0))
+        weights = idf[term_ids] * freqs * (k1 + 1) / (freqs + norms)
+
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(doc_freqs.astype(np.int64))
+        return cls(terms, offsets, doc_ids[order], weights[order].astype(np.float32), len(texts))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _term_ids(self, query: str) -> List[int]:
+        words = sorted(set(tokenize(query)))
+        if not words or not len(self.terms):
+            return []
+        positions = np.searchsorted(self.terms, words)
+        return [int(p) for p, word in zip(positions, words) if p < len(self.terms) and self.terms[p] == word]
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (scores, ids) of the k best-scoring texts for a query, best first.
+        allowed, a sorted array of text ids, restricts the results.
+        """
+        term_ids = self._term_ids(query)
+        if not term_ids or k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int32)
+
+        ranges = [slice(self.offsets[t], self.offsets[t + 1]) for t in term_ids]
+        if len(ranges) == 1:
+            ids, scores = self.postings[ranges[0]], self.weights[ranges[0]]
+        else:
+            ids, inverse = np.unique(np.concatenate([self.postings[r] for r in ranges]), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate([self.weights[r] for r in ranges]))
+        if allowed is not None:
+            keep = sorted_contains(allowed, ids)
+            ids, scores = ids[keep], scores[keep]
+
+        # Partial selection of the k best instead of sorting every match
+        if k < len(scores):
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return scores[best].astype(np.float32), ids[best]
+
+    def save(self, directory: str) -> None:
+        """Write the index as .npy files in directory, which should be new (see load)"""
+        os.makedirs(directory, exist_ok=True)
+        for name, array in (("terms", self.terms), ("offsets", self.offsets), ("postings", self.postings),
+                            ("weights", self.weights)):
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        with open(os.path.join(directory, "bm25.json"), "w") as f:
+            json.dump({"count": self.count}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "BM25Index":
+        """Open a saved index; with mmap, its arrays are mapped rather than read"""
+        mode = "r" if mmap else None
+        with open(os.path.join(directory, "bm25.json")) as f:
+            info = json.load(f)
+        arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode)
+                  for name in ("terms", "offsets", "postings", "weights")]
+        return cls(*arrays, info["count"])
@@ -0,0 +1,310 @@
+import asyncio
+import functools
+import time
+from typing import Any, Dict, List, Optional
+
+from api.game.circuit import CircuitOpenError, circuits
+from api.game.metrics import span, upstream_errors
+
+# Same defaults as the AI21 SDK's create_and_poll
+POLL_INTERVAL_SEC = 1.0
+POLL_TIMEOUT_SEC = 120.0
+TERMINAL_STATUSES = {"completed", "failed", "requires_action"}
+
+
+class MaestroRunError(Exception):
+    """A Maestro run finished without producing a usable result"""
+
+
+def run_maestro(client, input: str, requirements: List[Dict[str, Any]], operation: str,
+                poll_interval: float = POLL_INTERVAL_SEC, poll_timeout: float = POLL_TIMEOUT_SEC) -> Any:
+    """
+    Equivalent of client.beta.maestro.runs.create_and_poll, split into its
+    create and poll phases so each is timed separately
+    (maestro.<operation>.create / maestro.<operation>.poll).
+
+    Blocks the calling thread for the whole run; the API uses
+    MaestroRunManager instead. Raises CircuitOpenError straight away while
+    the Maestro circuit is open.
+    """
+    runs = client.beta.maestro.runs
+    try:
+        with circuits.get("maestro").guard():
+            with span(f"maestro.{operation}.create"):
+                run = runs.create(input=input, requirements=requirements)
+
+            with span(f"maestro.{operation}.poll"):
+                started_at = time.monotonic()
+                while run.status not in TERMINAL_STATUSES:
+                    if time.monotonic() - started_at >= poll_timeout:
+                        raise TimeoutError(f"Maestro run {run.id} did not finish within {poll_timeout}s")
+                    time.sleep(poll_interval)
+                    run = runs.retrieve(run.id)
+
+            if run.status != "completed":
+                raise MaestroRunError(f"Maestro run {run.id} ended with status {run.status}")
+            return run
+    except CircuitOpenError:
+        raise
+    except Exception:
+        upstream_errors.inc(vendor="maestro", operation=operation)
+        raise
+
+
+class _TrackedRun:
+    def __init__(self, client, run_id: str, operation: str, future: asyncio.Future,
+                 deadline: float, interval: float):
+        self.client = client
+        self.run_id = run_id
+        self.operation = operation
+        self.future = future
+        self.started_at = time.monotonic()
+        self.deadline = deadline
+        self.interval = interval
+        self.next_poll = self.started_at + interval
+        self.errors = 0
+        self.polling: Optional[asyncio.Task] = None
+
+
+class MaestroRunManager:
+    """
+    Tracks every outstanding Maestro run from one asyncio polling loop.
+
+    run() creates the run and then waits on a future. The loop retrieves
+    each run's status when it is due and resolves the future once the
+    run is finished. A thread is only held for the duration of each short
+    create/retrieve HTTP call (on the executor's "maestro" pool), never for
+    the whole run, so hundreds of concurrent runs don't need hundreds of
+    blocked threads.
+
+    Polling ramps up exponentially per run: the first check comes after
+    about half the typical duration of that operation's recent runs (but
+    no sooner than min_interval), and each "still running" answer
+    stretches the interval by `backoff`, up to max_interval. A run is
+    therefore noticed at most about (backoff - 1) x its age late, plus
+    min_interval. The trade-off is in min_interval: the default 50ms keeps
+    short runs from waiting on the poller, at the cost of a few more
+    retrieve calls per run (about log(max_interval / min_interval) /
+    log(backoff), ~8, before the interval levels off); raise it if the
+    retrieve calls count against a tight rate limit. Runs that pass
+    their timeout fail with TimeoutError.
+    Each retrieve call runs as its own task and counts as a failed poll
+    after poll_timeout, so a hung call only delays its own run and the
+    loop keeps enforcing every run's deadline.
+    Cancelling a caller stops tracking its run and cancels the run
+    upstream, also when it is still being created, if the client supports
+    runs.cancel (older AI21 SDKs don't; the run is then only abandoned).
+    """
+
+    def __init__(self, executor, min_interval: float = 0.05, max_interval: float = 2.0, backoff: float = 1.5,
+                 timeout: float = POLL_TIMEOUT_SEC, max_poll_errors: int = 3, poll_timeout: float = 10.0):
+        self.executor = executor
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.poll_timeout = poll_timeout
+        self.max_poll_errors = max_poll_errors
+        self._runs: Dict[str, _TrackedRun] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        # operation -> moving average of run durations (seconds)
+        self._typical_duration: Dict[str, float] = {}
+        self.created = 0
+        self.polls = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.poll_timeouts = 0
+        self.cancelled = 0
+        self.cancel_requests = 0
+
+    def _first_interval(self, operation: str) -> float:
+        typical = self._typical_duration.get(operation)
+        if typical is None:
+            return self.min_interval
+        return max(self.min_interval, min(self.max_interval, typical / 2))
+
+    def _ensure_loop(self) -> None:
+        if self._loop_task is None or self._loop_task.done():
+            self._wakeup = asyncio.Event()
+            self._loop_task = asyncio.ensure_future(self._poll_loop())
+
+    async def run(self, client, input: str, requirements: List[Dict[str, Any]], operation: str,
+                  timeout: Optional[float] = None) -> Any:
+        """Create a run and wait for it to finish; same result and errors as run_maestro"""
+        runs = client.beta.maestro.runs
+        tracked = None
+        try:
+            with circuits.get("maestro").guard():
+                with span(f"maestro.{operation}.create"):
+                    create = asyncio.ensure_future(
+                        self.executor.run("maestro", runs.create, input=input, requirements=requirements)
+                    )
+                    try:
+                        run = await asyncio.shield(create)
+                    except asyncio.CancelledError:
+                        # The create call still finishes in its thread; cancel the run it makes
+                        create.add_done_callback(lambda done: self._cancel_created(client, done))
+                        raise
+                self.created += 1
+
+                with span(f"maestro.{operation}.poll"):
+                    if run.status not in TERMINAL_STATUSES:
+                        self._ensure_loop()
+                        future = asyncio.get_running_loop().create_future()
+                        tracked = _TrackedRun(
+                            client, run.id, operation, future,
+                            deadline=time.monotonic() + (timeout or self.timeout),
+                            interval=self._first_interval(operation)
+                        )
+                        self._runs[run.id] = tracked
+                        self._wakeup.set()
+                        run = await future
+
+                if run.status != "completed":
+                    raise MaestroRunError(f"Maestro run {run.id} ended with status {run.status}")
+                return run
+        except asyncio.CancelledError:
+            if tracked is not None and self._runs.pop(tracked.run_id, None) is not None:
+                self.cancelled += 1
+                self._cancel_upstream(client, tracked.run_id)
+            raise
+        except CircuitOpenError:
+            raise
+        except Exception:
+            upstream_errors.inc(vendor="maestro", operation=operation)
+            raise
+
+    async def _poll_loop(self) -> None:
+        while True:
+            if not self._runs:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            next_due = now + self.max_interval
+            for tracked in list(self._runs.values()):
+                if tracked.future.done():
+                    self._runs.pop(tracked.run_id, None)
+                elif now >= tracked.deadline:
+                    self._runs.pop(tracked.run_id, None)
+                    self.timed_out += 1
+                    if tracked.polling is not None:
+                        tracked.polling.cancel()
+                    tracked.future.set_exception(TimeoutError(
+                        f"Maestro run {tracked.run_id} did not finish within {tracked.deadline - tracked.started_at:.0f}s"
+                    ))
+                elif tracked.polling is not None:
+                    next_due = min(next_due, tracked.deadline)
+                elif tracked.next_poll <= now:
+                    # A task per poll, so one slow retrieve doesn't hold up the others
+                    tracked.polling = asyncio.ensure_future(self._poll(tracked))
+                    tracked.polling.add_done_callback(functools.partial(self._polled, tracked))
+                    next_due = min(next_due, tracked.deadline)
+                else:
+                    next_due = min(next_due, tracked.next_poll, tracked.deadline)
+
+            # Sleep until the next run is due, a poll finishes, or a new run is added
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_due - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    def _polled(self, tracked: _TrackedRun, task: asyncio.Task) -> None:
+        tracked.polling = None
+        if not task.cancelled() and task.exception() is not None:
+            # _poll handles the call's errors; anything else fails the run rather than stalling it
+            self._finish(tracked, error=task.exception())
+        self._wakeup.set()
+
+    async def _poll(self, tracked: _TrackedRun) -> None:
+        self.polls += 1
+        try:
+            run = await asyncio.wait_for(
+                self.executor.run("maestro", tracked.client.beta.maestro.runs.retrieve, tracked.run_id),
+                timeout=self.poll_timeout
+            )
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.poll_timeouts += 1
+                e = TimeoutError(f"Retrieving Maestro run {tracked.run_id} took over {self.poll_timeout}s")
+            tracked.errors += 1
+            if tracked.errors >= self.max_poll_errors:
+                self._finish(tracked, error=e)
+                return
+            tracked.next_poll = time.monotonic() + tracked.interval
+            return
+
+        tracked.errors = 0
+        if run.status in TERMINAL_STATUSES:
+            self._finish(tracked, run=run)
+        else:
+            tracked.interval = min(self.max_interval, tracked.interval * self.backoff)
+            tracked.next_poll = time.monotonic() + tracked.interval
+
+    def _finish(self, tracked: _TrackedRun, run: Any = None, error: Optional[Exception] = None) -> None:
+        if self._runs.pop(tracked.run_id, None) is None or tracked.future.done():
+            return
+        if error is not None:
+            self.failed += 1
+            tracked.future.set_exception(error)
+            return
+        if run.status == "completed":
+            self.completed += 1
+            duration = time.monotonic() - tracked.started_at
+            typical = self._typical_duration.get(tracked.operation)
+            self._typical_duration[tracked.operation] = duration if typical is None else 0.8 * typical + 0.2 * duration
+        else:
+            self.failed += 1
+        tracked.future.set_result(run)
+
+    def _cancel_created(self, client, create: asyncio.Future) -> None:
+        if create.cancelled() or create.exception() is not None:
+            return
+        run = create.result()
+        self.created += 1
+        self.cancelled += 1
+        if run.status not in TERMINAL_STATUSES:
+            self._cancel_upstream(client, run.id)
+
+    def _cancel_upstream(self, client, run_id: str) -> None:
+        """Ask Maestro to stop a run nobody waits for, in the background"""
+        cancel = getattr(client.beta.maestro.runs, "cancel", None)
+        if cancel is None:
+            return
+        self.cancel_requests += 1
+        request = asyncio.ensure_future(self.executor.run("maestro", cancel, run_id))
+        # A failed cancel only means the run finishes unused
+        request.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    def outstanding(self) -> int:
+        return len(self._runs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "outstanding": len(self._runs),
+            "created": self.created,
+            "polls": self.polls,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "poll_timeouts": self.poll_timeouts,
+            "cancelled": self.cancelled,
+            "cancel_requests": self.cancel_requests,
+            "typical_duration_ms": {
+                operation: round(1000 * seconds, 1) for operation, seconds in self._typical_duration.items()
+            },
+        }
+
+    def shutdown(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+        for tracked in list(self._runs.values()):
+            if tracked.polling is not None:
+                tracked.polling.cancel()
+            if not tracked.future.done():
+                tracked.future.cancel()
+        self._runs.clear()
@@ -0,0 +1,223 @@
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Document fields that are content rather than metadata
+CONTENT_FIELDS = frozenset(("title", "text", "metadata"))
+
+
+def normalize_value(value: Any) -> Any:
+    return value.casefold() if isinstance(value, str) else value
+
+
+def normalize_metadata(doc: Dict[str, Any]) -> Dict[str, List[Any]]:
+    """
+    A document's filterable fields as {field: [values]}: top-level fields
+    and those under "metadata" (nested objects flattened to dotted names,
+    e.g. "place.region"), with strings casefolded and a list field giving
+    one value per element. A field under "metadata" overrides a top-level
+    field of the same name.
+    """
+    fields: Dict[str, List[Any]] = {}
+
+    def add(name: str, value: Any) -> None:
+        if isinstance(value, dict):
+            for key, item in value.items():
+                add(f"{name}.{key}", item)
+        elif isinstance(value, (list, tuple)):
+            fields[name] = [normalize_value(item) for item in value if not isinstance(item, (dict, list))]
+        elif value is not None:
+            fields[name] = [normalize_value(value)]
+
+    for key, value in doc.items():
+        if key not in CONTENT_FIELDS:
+            add(key, value)
+    for key, value in (doc.get("metadata") or {}).items():
+        add(key, value)
+    return fields
+
+
+def filter_values(value: Any) -> List[Any]:
+    """A filter's accepted values: a list means any of them"""
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    return [normalize_value(item) for item in values]
+
+
+def matches_filters(doc: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether a document passes every filter. Filters set to None, and fields
+    the document doesn't have, don't exclude it; strings compare case-insensitively.
+    """
+    fields = normalize_metadata(doc)
+    for key, value in (filters or {}).items():
+        if value is None or key not in fields:
+            continue
+        if not set(filter_values(value)).intersection(fields[key]):
+            return False
+    return True
+
+
+def sorted_contains(values: np.ndarray, items: np.ndarray) -> np.ndarray:
+    """Which items are in the sorted array values, by binary search: O(len(items) * log(len(values)))"""
+    if not len(values):
+        return np.zeros(len(items), dtype=bool)
+    positions = np.minimum(np.searchsorted(values, items), len(values) - 1)
+    return values[positions] == items
+
+
+def value_key(value: Any) -> str:
+    """A normalized value as stored in the index (JSON, so 1 and "1" stay distinct)"""
+    return json.dumps(value, sort_keys=True)
+
+
+class MetadataIndex:
+    """
+    Posting lists from (field, value) to the documents that have it, so
+    a filter is resolved to the matching passages with a few array
+    operations instead of checking every document.
+
+    resolve() follows matches_filters: fields are ANDed, the values of one
+    field are ORed, and a document without the field passes. The posting
+    lists are sorted, so fields are intersected starting from the one the
+    fewest documents pass, by binary search, and only the documents that
+    pass them all are expanded to passage ids through passage_offsets:
+    document d's passages are passage_offsets[d]:passage_offsets[d + 1].
+
+    Each field's values are kept sorted and found by binary search, and
+    all posting lists live in one array, so a saved index opens
+    memory-mapped in constant time even for unique fields such as id.
+    """
+
+    def __init__(self, fields: Dict[str, Dict[str, Any]], postings: np.ndarray, passage_offsets: np.ndarray):
+        # field -> {"values": sorted value keys, "starts": where each value's list starts (plus the end),
+        #           "present": [start, end) of the list of documents that have the field}
+        self._fields = fields
+        self.postings = postings
+        self.passage_offsets = passage_offsets
+        self.count = len(passage_offsets) - 1
+
+    @classmethod
+    def build(cls, documents: Iterable[Dict[str, Any]], passage_offsets: np.ndarray) -> "MetadataIndex":
+        by_field: Dict[str, Dict[str, List[int]]] = {}
+        present: Dict[str, List[int]] = {}
+        for doc_index, doc in enumerate(documents):
+            for field, values in normalize_metadata(doc).items():
+                present.setdefault(field, []).append(doc_index)
+                by_value = by_field.setdefault(field, {})
+                for key in dict.fromkeys(value_key(value) for value in values):
+                    by_value.setdefault(key, []).append(doc_index)
+
+        fields: Dict[str, Dict[str, Any]] = {}
+        lists = []
+        start = 0
+        for field, by_value in by_field.items():
+            fields[field] = {"present": [start, start + len(present[field])]}
+            lists.append(present[field])
+            start += len(present[field])
+            keys = sorted(by_value)
+            starts = [start]
+            for key in keys:
+                lists.append(by_value[key])
+                start += len(by_value[key])
+                starts.append(start)
+            fields[field]["values"] = np.array(keys, dtype=str)
+            fields[field]["starts"] = np.array(starts, dtype=np.int64)
+        postings = np.fromiter((doc for docs in lists for doc in docs), dtype=np.int32, count=start)
+        return cls(fields, postings, passage_offsets)
+
+    def fields(self) -> Dict[str, int]:
+        """Distinct values per field"""
+        return {field: len(info["values"]) for field, info in self._fields.items()}
+
+    def documents_with(self, field: str, value: Any) -> np.ndarray:
+        """The documents whose field has this (normalized) value"""
+        info = self._fields.get(field)
+        if info is None:
+            return self.postings[:0]
+        values = info["values"]
+        key = value_key(value)
+        position = int(np.searchsorted(values, key))
+        if position == len(values) or values[position] != key:
+            return self.postings[:0]
+        return self.postings[info["starts"][position]:info["starts"][position + 1]]
+
+    def resolve_documents(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Sorted indexes of the documents that pass the filters, or None when nothing is filtered"""
+        # Per filtered field: how many documents pass it, the documents with an accepted value,
+        # and the documents that have the field at all (the others pass too)
+        terms = []
+        for field, value in (filters or {}).items():
+            if value is None or field not in self._fields:
+                continue
+            lists = [self.documents_with(field, item) for item in filter_values(value)]
+            matches = lists[0] if len(lists) == 1 else np.unique(np.concatenate(lists))
+            start, end = self._fields[field]["present"]
+            present = self.postings[start:end]
+            terms.append((len(matches) + self.count - len(present), matches, present))
+        if not terms:
+            return None
+
+        # Start from the field the fewest documents pass and narrow it down with the others
+        terms.sort(key=lambda term: term[0])
+        _, matches, present = terms[0]
+        allowed = np.asarray(matches, dtype=np.int64)
+        if len(present) < self.count:
+            missing = np.ones(self.count, dtype=bool)
+            missing[present] = False
+            allowed = np.union1d(allowed, np.flatnonzero(missing))
+        for _, matches, present in terms[1:]:
+            if not len(allowed):
+                break
+            keep = sorted_contains(matches, allowed)
+            if len(present) < self.count:
+                keep |= ~sorted_contains(present, allowed)
+            allowed = allowed[keep]
+        return allowed
+
+    def passages(self, documents: np.ndarray) -> np.ndarray:
+        """Sorted ids of the given (sorted) documents' passages"""
+        starts = self.passage_offsets[documents]
+        counts = self.passage_offsets[documents + 1] - starts
+        # Each passage's id is its position in the output plus how far its document's run is shifted
+        shifts = starts - (np.cumsum(counts) - counts)
+        return np.arange(int(counts.sum()), dtype=np.int64) + np.repeat(shifts, counts)
+
+    def resolve(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Sorted ids of the passages whose documents pass the filters, or None when nothing is filtered"""
+        documents = self.resolve_documents(filters)
+        if documents is None:
+            return None
+        return self.passages(documents)
+
+    def save(self, directory: str) -> None:
+        """
+        Write the index to directory: the posting lists and each field's
+        values and list starts as .npy files, and a JSON table of the fields
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "postings.npy"), self.postings)
+        table = {}
+        for number, (field, info) in enumerate(self._fields.items()):
+            np.save(os.path.join(directory, f"field{number}.values.npy"), info["values"])
+            np.save(os.path.join(directory, f"field{number}.starts.npy"), info["starts"])
+            table[field] = {"file": f"field{number}", "present": info["present"]}
+        with open(os.path.join(directory, "metadata.json"), "w") as f:
+            json.dump(table, f)
+
+    @classmethod
+    def load(cls, directory: str, passage_offsets: np.ndarray, mmap: bool = True) -> "MetadataIndex":
+        """Open a saved index; with mmap, its arrays are mapped rather than read"""
+        mode = "r" if mmap else None
+        with open(os.path.join(directory, "metadata.json")) as f:
+            table = json.load(f)
+        fields = {
+            field: {
+                "values": np.load(os.path.join(directory, f"{entry['file']}.values.npy"), mmap_mode=mode),
+                "starts": np.load(os.path.join(directory, f"{entry['file']}.starts.npy"), mmap_mode=mode),
+                "present": entry["present"],
+            }
+            for field, entry in table.items()
+        }
+        return cls(fields, np.load(os.path.join(directory, "postings.npy"), mmap_mode=mode), passage_offsets)
@@ -0,0 +1,194 @@
+import bisect
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Vendor calls range from milliseconds (RAG) to minutes (Maestro runs)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose values are read from a callback at scrape time"""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Dict[LabelKey, float]]):
+        self.name = name
+        self.help = help
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self._collect().items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(_label_key(labels))
+        return int(sum(counts[:-1])) if counts else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                cumulative = 0.0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', repr(bound)))} {cumulative}")
+                cumulative += counts[len(self.buckets)]
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], Dict[LabelKey, float]]) -> Gauge:
+        """Register (or replace) a callback gauge"""
+        with self._lock:
+            gauge = self._metrics[name] = Gauge(name, help, collect)
+            return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+stage_duration = metrics.histogram("rpg_stage_duration_seconds", "Time spent in each stage of a turn")
+upstream_errors = metrics.counter("rpg_upstream_errors_total", "Failed calls to upstream vendors")
+fallbacks = metrics.counter("rpg_fallbacks_total", "Responses served from a component's fallback")
+cache_hits = metrics.counter("rpg_cache_hits_total", "Requests served without repeating upstream work")
+cache_misses = metrics.counter("rpg_cache_misses_total", "Requests that had to do the upstream work")
+
+
+# Trace of the request being handled: its ID and the spans recorded so far.
+# The executor copies the context into worker threads so spans recorded
+# inside the blocking vendor calls land on the right request.
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("rpg_trace", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.spans: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.spans.append((name, seconds))
+
+    def server_timing(self) -> str:
+        """Spans as a Server-Timing header value (durations in milliseconds)"""
+        with self._lock:
+            spans = list(self.spans)
+        return ", ".join(f"{name.replace('.', '-')};dur={seconds * 1000:.1f}" for name, seconds in spans)
+
+
+def start_trace(trace_id: Optional[str] = None) -> Tuple[Trace, contextvars.Token]:
+    trace = Trace(trace_id)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token: contextvars.Token) -> None:
+    _current_trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a block into rpg_stage_duration_seconds and the current trace"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stage_duration.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
@@ -1,215 +1,263 @@
-import ai21
 import json
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+from api.game.ai21_client import ai21_clients
+from api.game.events import turn_event, apply_choice, apply_score, remember_action
 from api.game.scoring_agent import ScoringAgent
+from api.game.maestro import run_maestro, MaestroRunManager
+from api.game.scene_graph import SceneGraph
+from api.game.result_cache import ResultCache, content_key
+from api.game.metrics import span, fallbacks
+
+# Maestro requirements for generated choices. Cached choices are keyed by
+# these (and CHOICES_PROMPT_VERSION), so editing one invalidates them.
+CHOICE_REQUIREMENTS = [
+    {
+        "name": "choice_count",
+        "description": "Generate exactly 4 distinct choices labeled A, B, C, and D",
+        "is_mandatory": True
+    },
+    {
+        "name": "historical_accuracy",
+        "description": "Choices must be historically plausible based on the provided historical context",
+        "is_mandatory": True
+    },
+    {
+        "name": "moral_diversity",
+        "description": "Choices should represent different moral alignments (good/evil, lawful/chaotic)",
+        "is_mandatory": True
+    }
+]
+# Used when Maestro can't produce four usable choices
+DEFAULT_CHOICES = [
+    "A) Proceed cautiously forward.",
+    "B) Speak with your companion about the situation.",
+    "C) Look for an alternative path.",
+    "D) Rest and consider your options."
+]
+# Bump when the choices prompt or how its output is parsed changes
+CHOICES_PROMPT_VERSION = 1
+
+EXPERIENCE_PER_CHOICE = 10
+
+def new_player_state() -> Dict[str, Any]:
+    """Initial state for a new player"""
+    return {
+        "alignment": {
+            "law_chaos": 0,  # -100 (chaotic) to 100 (lawful)
+            "good_evil": 0,  # -100 (evil) to 100 (good)
+        },
+        "skills": {},
+        "experience": 0,
+        "score": 0,
+        "feedback_history": []
+    }
+
+def new_agent_state() -> Dict[str, Any]:
+    """Initial state of the companion's relationship with a new player"""
+    return {
+        "trust": 50,  # 0-100
+        "recent_actions": [],
+    }
 
 class GameOrchestrator:
-    def __init__(self, api_key):
-        # Initialize the AI21 client with the API key
-        self.client = ai21.AI21Client(api_key=api_key)
+    def __init__(self, api_key, campaign_path: Optional[str] = None, choice_cache: Optional[ResultCache] = None,
+                 client=None):
+        # Imported here so the API process can start without loading NumPy
+        from api.game.impacts import ImpactTable
+        
+        # The process-wide AI21 client for this key (see api/game/ai21_client.py)
+        self.client = client or ai21_clients.get(api_key)
         self.current_scene = None
-        self.player_state = {
-            "alignment": {
-                "law_chaos": 0,  # -100 (chaotic) to 100 (lawful)
-                "good_evil": 0,  # -100 (evil) to 100 (good)
-            },
-            "skills": {},
-            "experience": 0,
-            "score": 0,
-            "feedback_history": []
-        }
-        self.agent_state = {
-            "trust": 50,  # 0-100
-            "recent_actions": [],
-        }
+        # Default single-player state, used when callers don't pass their own
+        # (the API keeps one state per session, see api/game/session.py)
+        self.player_state = new_player_state()
+        self.agent_state = new_agent_state()
+        
+        # Generated choices, kept across restarts (see api/game/result_cache.py)
+        self.choice_cache = choice_cache or ResultCache.from_env("choices")
         
         # Initialize the scoring agent
-        self.scoring_agent = ScoringAgent(api_key)
-        
-        # Load scenes from JSON file
-        self.scenes = self._load_scenes()
-        
-    def _load_scenes(self) -> Dict[str, Any]:
-        """Load scene data from JSON file"""
-        # For now, return a hardcoded scene for testing
-        return {
-            "intro": {
-                "scene_id": "intro",
-                "description": "You stand at the edge of a medieval village. The church bell tower looms in the distance, and villagers hurry about their daily tasks. Ser Elyen, your companion, stands beside you, his weathered armor gleaming in the afternoon sun.",
-                "rag_context_query": "medieval English village, 13th century, daily life",
-                "region": "England",
-                "actions": [
-                    "A) Approach the village elder to inquire about lodging.",
-                    "B) Head directly to the church to seek sanctuary.",
-                    "C) Visit the local tavern to gather information.",
-                    "D) Remain outside the village and make camp in the woods."
-                ],
-                "next_scene_map": {
-                    "A": "village_elder",
-                    "B": "church",
-                    "C": "tavern",
-                    "D": "forest_camp"
-                }
-            },
-            "village_elder": {
-                "scene_id": "village_elder",
-                "description": "The village elder, a man with a long gray beard and weathered hands, greets you with suspicion. His small cottage is filled with herbs and scrolls, suggesting he is both the leader and healer of this community.",
-                "rag_context_query": "medieval village elder, healer, community leader, 13th century England",
-                "region": "England",
-                "actions": [
-                    "A) Offer payment for a night's lodging in the village.",
-                    "B) Mention that you are on a quest and need information.",
-                    "C) Intimidate the elder into helping you.",
-                    "D) Show him a mysterious symbol you carry."
-                ],
-                "next_scene_map": {
-                    "A": "lodging",
-                    "B": "quest_info",
-                    "C": "intimidation",
-                    "D": "symbol_reveal"
-                }
-            },
-            # Add more scenes as needed
-        }
+        self.scoring_agent = ScoringAgent(api_key, client=self.client)
+        
+        # Load the campaign's scenes (CAMPAIGN_PATH, see api/game/scene_graph.py)
+        self.scene_graph = SceneGraph.load(campaign_path)
+        self.scenes = self.scene_graph.scenes
+        # Choice impacts compiled into lookup arrays
+        self.impacts = ImpactTable(self.scene_graph)
         
     def get_scene(self, scene_id: str) -> Dict[str, Any]:
-        """Get scene data by ID"""
-        if scene_id not in self.scenes:
-            raise ValueError(f"Scene {scene_id} not found")
-            
-        self.current_scene = scene_id
-        return self.scenes[scene_id]
+        """Get scene data by ID; raises ValueError if the campaign has no such scene"""
+        return self.scene_graph.scene(scene_id)
+    
+    def next_scene_id(self, scene_id: str, choice_index: int) -> str:
+        """The scene a choice leads to"""
+        return self.scene_graph.next_scene(scene_id, choice_index)
+        
+    def _prepare_choices(self, scene_context: str, historical_context: List[Dict[str, str]],
+                         scene_id: Optional[str]) -> Tuple[Optional[List[str]], str, str]:
+        """
+        (choices, prompt, cache_key); choices is set when the scene has
+        predefined ones, otherwise look cache_key up in choice_cache before
+        running Maestro
+        """
+        scene_id = scene_id or self.current_scene
         
-    def generate_scene_choices(self, scene_context: str, historical_context: List[Dict[str, str]]) -> List[str]:
-        """Generate player choices for the current scene using Maestro"""
         # Extract historical facts as text
         historical_facts = "\n".join([f"- {item['text']}" for item in historical_context])
         
         # If we already have predefined choices, return those
-        if self.current_scene and "actions" in self.scenes[self.current_scene]:
-            return self.scenes[self.current_scene]["actions"]
+        if scene_id and "actions" in self.scenes[scene_id]:
+            return self.scenes[scene_id]["actions"], "", ""
             
+        prompt = f"Generate 4 player choices for this medieval RPG scene:\n\nScene: {scene_context}\n\nHistorical context:\n{historical_facts}"
+        
+        # Reuse choices already generated for exactly this prompt
+        cache_key = content_key(CHOICES_PROMPT_VERSION, prompt, CHOICE_REQUIREMENTS)
+        return None, prompt, cache_key
+    
+    def _parse_choices(self, run_result) -> Optional[List[str]]:
+        """The run's four choices, or None (counted as a fallback) if it didn't produce exactly four"""
+        # Parse the choices from the result
+        choices = run_result.result.split("\n")
+        # Filter out any non-choice lines
+        choices = [c for c in choices if c.startswith("A)") or c.startswith("B)") or 
+                  c.startswith("C)") or c.startswith("D)")]
+        
+        # Ensure we have exactly 4 choices
+        if len(choices) != 4:
+            fallbacks.inc(component="choices")
+            return None
+        return choices
+    
+    def _fallback_choices(self, error: Exception) -> List[str]:
+        print(f"Error generating choices: {error}")
+        # Fall back to default choices
+        fallbacks.inc(component="choices")
+        return list(DEFAULT_CHOICES)
+        
+    def generate_scene_choices(self, scene_context: str, historical_context: List[Dict[str, str]], scene_id: Optional[str] = None) -> List[str]:
+        """Generate player choices for a scene (the current scene by default) using Maestro"""
+        choices, prompt, cache_key = self._prepare_choices(scene_context, historical_context, scene_id)
+        if choices is not None:
+            return choices
+        found, choices = self.choice_cache.get(cache_key)
+        if found:
+            return choices
+        
         # Otherwise, generate choices with Maestro
         try:
             # Use Maestro API with requirements
-            run_result = self.client.beta.maestro.runs.create_and_poll(
-                input=f"Generate 4 player choices for this medieval RPG scene:\n\nScene: {scene_context}\n\nHistorical context:\n{historical_facts}",
-                requirements=[
-                    {
-                        "name": "choice_count",
-                        "description": "Generate exactly 4 distinct choices labeled A, B, C, and D",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "historical_accuracy",
-                        "description": f"Choices must be historically plausible based on the provided historical context",
-                        "is_mandatory": True
-                    },
-                    {
-                        "name": "moral_diversity",
-                        "description": "Choices should represent different moral alignments (good/evil, lawful/chaotic)",
-                        "is_mandatory": True
-                    }
-                ]
+            run_result = run_maestro(
+                self.client,
+                operation="choices",
+                input=prompt,
+                requirements=CHOICE_REQUIREMENTS
             )
-            
-            # Parse the choices from the result
-            choices = run_result.result.split("\n")
-            # Filter out any non-choice lines
-            choices = [c for c in choices if c.startswith("A)") or c.startswith("B)") or 
-                      c.startswith("C)") or c.startswith("D)")]
-            
-            # Ensure we have exactly 4 choices
-            if len(choices) != 4:
-                # Fall back to default choices
-                choices = [
-                    "A) Proceed cautiously forward.",
-                    "B) Speak with your companion about the situation.",
-                    "C) Look for an alternative path.",
-                    "D) Rest and consider your options."
-                ]
-                
+            choices = self._parse_choices(run_result)
+        except Exception as e:
+            return self._fallback_choices(e)
+        if choices is None:
+            return list(DEFAULT_CHOICES)
+        self.choice_cache.set(cache_key, choices)
+        return choices
+    
+    async def generate_scene_choices_async(self, scene_context: str, historical_context: List[Dict[str, str]],
+                                           runs: MaestroRunManager, scene_id: Optional[str] = None) -> List[str]:
+        """
+        generate_scene_choices, waiting for the Maestro run on the shared run
+        manager instead of a thread. The choice cache's SQLite reads and
+        writes run on the run manager's executor, off the event loop.
+        """
+        choices, prompt, cache_key = self._prepare_choices(scene_context, historical_context, scene_id)
+        if choices is not None:
             return choices
-            
+        found, choices = await runs.executor.run("default", self.choice_cache.get, cache_key)
+        if found:
+            return choices
+        
+        try:
+            run_result = await runs.run(
+                self.client,
+                operation="choices",
+                input=prompt,
+                requirements=CHOICE_REQUIREMENTS
+            )
+            choices = self._parse_choices(run_result)
         except Exception as e:
-            print(f"Error generating choices: {e}")
-            # Fall back to default choices
-            return [
-                "A) Proceed cautiously forward.",
-                "B) Speak with your companion about the situation.",
-                "C) Look for an alternative path.",
-                "D) Rest and consider your options."
-            ]
+            return self._fallback_choices(e)
+        if choices is None:
+            return list(DEFAULT_CHOICES)
+        await runs.executor.run("default", self.choice_cache.set, cache_key, choices)
+        return choices
     
-    def update_player_state(self, scene_id: str, choice_index: int) -> Dict[str, Any]:
+    def update_player_state(self, scene_id: str, choice_index: int,
+                            player_state: Optional[Dict[str, Any]] = None,
+                            agent_state: Optional[Dict[str, Any]] = None,
+                            events: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
         """
-        Update player state based on their choice and return scoring information
+        Update player state based on their choice and return scoring information.
+        The orchestrator's own state is updated unless a session's state is passed in.
+        The change is described by a turn event (see api/game/events.py), which
+        is appended to `events` when given so the session can persist it.
         """
-        # Define the impact of choices on alignment and trust
-        # This would be more sophisticated in a full implementation
-        choice_impacts = {
-            "intro": [
-                {"law_chaos": 5, "good_evil": 0, "trust": 0},  # A - lawful neutral
-                {"law_chaos": 10, "good_evil": 5, "trust": 5},  # B - lawful good
-                {"law_chaos": -5, "good_evil": 0, "trust": 0},  # C - chaotic neutral
-                {"law_chaos": -10, "good_evil": 0, "trust": -5}   # D - chaotic neutral
-            ],
-            "village_elder": [
-                {"law_chaos": 5, "good_evil": 0, "trust": 0},  # A - lawful neutral
-                {"law_chaos": 0, "good_evil": 5, "trust": 5},  # B - neutral good
-                {"law_chaos": -5, "good_evil": -10, "trust": -10},  # C - chaotic evil
-                {"law_chaos": 0, "good_evil": 0, "trust": 0}   # D - true neutral
-            ],
-            # Add more scenes as needed
-        }
-        
-        # Apply the impact if defined
-        if scene_id in choice_impacts and 0 <= choice_index < len(choice_impacts[scene_id]):
-            impact = choice_impacts[scene_id][choice_index]
-            
-            # Update alignment
-            self.player_state["alignment"]["law_chaos"] += impact["law_chaos"]
-            self.player_state["alignment"]["law_chaos"] = max(-100, min(100, self.player_state["alignment"]["law_chaos"]))
-            
-            self.player_state["alignment"]["good_evil"] += impact["good_evil"]
-            self.player_state["alignment"]["good_evil"] = max(-100, min(100, self.player_state["alignment"]["good_evil"]))
-            
-            # Update agent trust
-            self.agent_state["trust"] += impact["trust"]
-            self.agent_state["trust"] = max(0, min(100, self.agent_state["trust"]))
-            
-            # Add to recent actions
-            choice_letter = "ABCD"[choice_index]
-            scene = self.scenes[scene_id]
-            action = scene["actions"][choice_index]
-            self.agent_state["recent_actions"].append(action)
-            
-            # Keep only the 5 most recent actions
-            if len(self.agent_state["recent_actions"]) > 5:
-                self.agent_state["recent_actions"] = self.agent_state["recent_actions"][-5:]
-                
-        # Award experience
-        self.player_state["experience"] += 10
+        if player_state is None:
+            player_state = self.player_state
+        if agent_state is None:
+            agent_state = self.agent_state
         
-        # Use the scoring agent to evaluate the player's choice
-        scoring_result = self.scoring_agent.score_choice(scene_id, choice_index, self.player_state)
+        # The choice's impact on alignment and trust, if the campaign defines one, and experience
+        impact = self.impacts.impact(scene_id, choice_index)
+        event = turn_event(
+            scene_id, choice_index,
+            action=self.scenes[scene_id]["actions"][choice_index] if impact is not None else None,
+            impact=impact,
+            experience=EXPERIENCE_PER_CHOICE
+        )
+        apply_choice(player_state, agent_state, event)
         
-        # Update player score
-        self.player_state["score"] += scoring_result.get("total", 5)
+        # Use the scoring agent to evaluate the player's choice
+        with span("scoring"):
+            scoring_result = self.scoring_agent.score_choice(scene_id, choice_index, player_state)
         
-        # Add feedback to history
+        # Update player score and feedback history
+        event["score"] = scoring_result.get("total", 5)
         if "feedback" in scoring_result:
-            feedback_entry = {
+            event["feedback"] = {
                 "scene_id": scene_id,
                 "choice_index": choice_index,
                 "feedback": scoring_result["feedback"],
                 "scores": {k: v for k, v in scoring_result.items() if k != "feedback"}
             }
-            self.player_state["feedback_history"].append(feedback_entry)
-            
-            # Keep only the 10 most recent feedback entries
-            if len(self.player_state["feedback_history"]) > 10:
-                self.player_state["feedback_history"] = self.player_state["feedback_history"][-10:]
+        apply_score(player_state, event)
         
+        if events is not None:
+            events.append(event)
         return scoring_result
+    
+    def update_player_states_batch(self, player_states: List[Dict[str, Any]], agent_states: List[Dict[str, Any]],
+                                   scene_ids: List[str], choice_indices: List[int]) -> List[bool]:
+        """
+        Apply one choice to each of many players (simulations, bots), with
+        the same effect as update_player_state minus the scoring. Returns
+        whether each choice had a defined impact.
+
+        The impacts are applied by ImpactTable.apply_batch, but the states
+        are copied out of and back into the dicts one player at a time, and
+        recent actions are updated per player too, so this is a convenience
+        rather than a fast path. Simulations running many steps should keep
+        the states packed (see pack_states) and call apply_batch directly.
+        """
+        from api.game.impacts import pack_states, unpack_states
+        
+        states = pack_states(player_states, agent_states)
+        states, applied = self.impacts.apply_batch(states, scene_ids, choice_indices, out=states)
+        unpack_states(states, player_states, agent_states)
+        
+        applied = applied.tolist()
+        for agent_state, player_state, scene_id, choice_index, was_applied in zip(
+                agent_states, player_states, scene_ids, choice_indices, applied):
+            if was_applied:
+                remember_action(agent_state, self.scenes[scene_id]["actions"][choice_index])
+            player_state["experience"] += EXPERIENCE_PER_CHOICE
+        return applied
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+# A stage receives the results of the stages it depends on, keyed by stage name
+StageFn = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class Pipeline:
+    """
+    Dependency-aware runner for the stages that assemble a response.
+
+    Stages are added in order and may only depend on stages added before them,
+    so the graph is always acyclic. Each stage starts as soon as its own
+    dependencies finish, which means independent stages run concurrently and
+    the total latency is that of the slowest dependency chain rather than the
+    sum of all stages.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Tuple[StageFn, List[str]]] = {}
+        self.timings: Dict[str, float] = {}
+
+    def add_stage(self, name: str, fn: StageFn, depends_on: Iterable[str] = ()) -> "Pipeline":
+        """Register a stage; returns the pipeline so calls can be chained"""
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already defined")
+        deps = list(depends_on)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self.stages[name] = (fn, deps)
+        return self
+
+    async def _run_stage(self, name: str, tasks: Dict[str, "asyncio.Task"]) -> Any:
+        fn, deps = self.stages[name]
+        inputs = {dep: await tasks[dep] for dep in deps}
+        started_at = time.perf_counter()
+        try:
+            return await fn(inputs)
+        finally:
+            self.timings[name] = time.perf_counter() - started_at
+
+    def _start(self) -> Dict[str, "asyncio.Task"]:
+        tasks: Dict[str, asyncio.Task] = {}
+        for name in self.stages:
+            tasks[name] = asyncio.ensure_future(self._run_stage(name, tasks))
+        return tasks
+
+    @staticmethod
+    def _cancel(tasks: Dict[str, "asyncio.Task"]) -> None:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+    async def run(self) -> Dict[str, Any]:
+        """Run every stage and return all results keyed by stage name"""
+        tasks = self._start()
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            self._cancel(tasks)
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    async def stream(self) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Run every stage, yielding (stage name, result) pairs in the order the
+        stages finish so callers can forward partial results immediately.
+        Stages still running are cancelled if the consumer stops early.
+        """
+        tasks = self._start()
+        order = {name: position for position, name in enumerate(tasks)}
+        pending = {task: name for name, task in tasks.items()}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+                for name in sorted((pending[task] for task in done), key=order.get):
+                    task = tasks[name]
+                    del pending[task]
+                    yield name, task.result()
+        finally:
+            self._cancel(tasks)
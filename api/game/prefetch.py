@@ -0,0 +1,260 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from api.game.metrics import metrics, cache_hits, cache_misses, start_trace
+
+prefetch_events = metrics.counter("rpg_prefetch_total", "Speculative prefetches by outcome")
+
+
+class Prefetcher:
+    """
+    Speculative work done for a player before they ask for it.
+
+    While a player reads a scene, schedule() warms up the scenes they can
+    go to next in the background. Upstream calls made by that work go
+    through fetch(..., speculative=True) and their results are kept for a
+    while, so when the real request comes fetch() returns them straight
+    away, or joins the call if it is still running.
+
+    Speculation is low priority and bounded:
+      - at most max_concurrency targets are warmed at once across all players
+      - each session has a token-bucket budget of targets (session_budget,
+        refilled at refill_per_sec), so one player clicking around can't
+        run up the upstream bill
+      - cancel() drops the targets a session no longer needs (the branches
+        it didn't take) unless another session still wants them. A
+        speculative call is cancelled along with the last target waiting
+        on it, unless a foreground fetch has joined it, so abandoned
+        Maestro runs and image predictions stop instead of finishing
+        unused. (A blocking SDK call already running in a thread still
+        returns, but nothing waits for it.)
+
+    Vendor wrappers return a canned fallback instead of raising; fetch()
+    is told how to recognise one so it is returned but never kept, and the
+    real request retries the vendor instead of getting it for ttl seconds.
+    """
+
+    def __init__(self, name: str = "scene", max_entries: int = 256, ttl: float = 600.0,
+                 session_budget: float = 8.0, refill_per_sec: float = 4.0 / 60, max_concurrency: int = 2):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.session_budget = session_budget
+        self.refill_per_sec = refill_per_sec
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        # key -> (expires_at, result) of finished speculative calls, oldest first
+        self._results: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        # key -> speculative call in progress, how many speculative callers wait on it,
+        # and the keys a foreground fetch has joined (never cancelled)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self._joined: Set[Hashable] = set()
+        # target -> warm-up task, and the sessions that want it
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._interest: Dict[Hashable, Set[str]] = {}
+        self._session_targets: Dict[str, Set[Hashable]] = {}
+        # target -> when its last completed warm-up expires
+        self._warmed: Dict[Hashable, float] = {}
+        # session -> (tokens, updated_at)
+        self._budgets: Dict[str, Tuple[float, float]] = {}
+
+        self.counts = {"scheduled": 0, "over_budget": 0, "cancelled": 0, "completed": 0, "failed": 0,
+                       "fallback": 0}
+
+    @classmethod
+    def from_env(cls, name: str = "scene", prefix: str = "PREFETCH", session_budget: float = 8.0,
+                 refill_per_min: float = 4.0, max_concurrency: int = 2) -> "Prefetcher":
+        """Configured from <prefix>_CACHE_SIZE, _TTL_SEC, _SESSION_BUDGET, _BUDGET_REFILL_PER_MIN and _CONCURRENCY"""
+        return cls(
+            name=name,
+            max_entries=int(os.getenv(f"{prefix}_CACHE_SIZE", "256")),
+            ttl=float(os.getenv(f"{prefix}_TTL_SEC", "600")),
+            session_budget=float(os.getenv(f"{prefix}_SESSION_BUDGET", str(session_budget))),
+            refill_per_sec=float(os.getenv(f"{prefix}_BUDGET_REFILL_PER_MIN", str(refill_per_min))) / 60,
+            max_concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(max_concurrency))),
+        )
+
+    def _count(self, outcome: str) -> None:
+        self.counts[outcome] += 1
+        prefetch_events.inc(kind=self.name, outcome=outcome)
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._results.get(key)
+        if entry is None:
+            return False, None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._results[key]
+            return False, None
+        return True, result
+
+    def _store(self, key: Hashable, future: asyncio.Future, fallback: Optional[Callable[[Any], bool]]) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+            self._waiters.pop(key, None)
+            self._joined.discard(key)
+        if future.cancelled() or future.exception() is not None:
+            return
+        if fallback is not None and fallback(future.result()):
+            self._count("fallback")
+            return
+        self._results[key] = (time.monotonic() + self.ttl, future.result())
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def cached(self, key: Hashable) -> bool:
+        return self._lookup(key)[0] or key in self._inflight
+
+    async def fetch(self, key: Hashable, fn: Callable[[], Awaitable[Any]], speculative: bool = False,
+                    fallback: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Result for key: from a finished speculative call, by joining one in
+        progress, or by calling fn. Speculative callers' results are kept
+        for later unless fallback(result) says fn fell back; foreground
+        results are not.
+        """
+        found, result = self._lookup(key)
+        if found:
+            if not speculative:
+                cache_hits.inc(cache=f"{self.name}_prefetch")
+            return result
+        future = self._inflight.get(key)
+        if future is not None:
+            if speculative:
+                return await self._wait(key, future)
+            self._joined.add(key)
+            cache_hits.inc(cache=f"{self.name}_prefetch")
+            try:
+                result = await asyncio.shield(future)
+            except Exception:
+                # The speculative call failed; make the call for real
+                return await fn()
+            if fallback is not None and fallback(result):
+                return await fn()
+            return result
+        if not speculative:
+            cache_misses.inc(cache=f"{self.name}_prefetch")
+            return await fn()
+
+        future = asyncio.ensure_future(fn())
+        self._inflight[key] = future
+        # Stored from a callback so the result is kept even if the speculation is cancelled meanwhile
+        future.add_done_callback(lambda _: self._store(key, future, fallback))
+        return await self._wait(key, future)
+
+    async def _wait(self, key: Hashable, future: asyncio.Future) -> Any:
+        """Wait on a speculative call; the last speculative caller to be cancelled cancels it"""
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key) is future:
+                self._waiters[key] -= 1
+                if not self._waiters[key] and key not in self._joined and not future.done():
+                    future.cancel()
+
+    def _spend(self, session_id: str) -> bool:
+        now = time.monotonic()
+        tokens, updated_at = self._budgets.get(session_id, (self.session_budget, now))
+        tokens = min(self.session_budget, tokens + (now - updated_at) * self.refill_per_sec)
+        if tokens < 1:
+            self._budgets[session_id] = (tokens, now)
+            return False
+        self._budgets[session_id] = (tokens - 1, now)
+        return True
+
+    def schedule(self, session_id: str, target: Hashable, warm: Callable[[], Awaitable[Any]]) -> bool:
+        """Warm up target for a session in the background, within its budget"""
+        self._prune_budgets()
+        if self._warmed.get(target, 0.0) > time.monotonic():
+            return True
+        task = self._tasks.get(target)
+        if task is not None and not task.done():
+            self._interest[target].add(session_id)
+            self._session_targets.setdefault(session_id, set()).add(target)
+            return True
+        if not self._spend(session_id):
+            self._count("over_budget")
+            return False
+
+        self._count("scheduled")
+        self._interest[target] = {session_id}
+        self._session_targets.setdefault(session_id, set()).add(target)
+        task = asyncio.ensure_future(self._run(target, warm))
+        self._tasks[target] = task
+        task.add_done_callback(lambda _: self._finished(target, task))
+        return True
+
+    async def _run(self, target: Hashable, warm: Callable[[], Awaitable[Any]]) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Its own trace, so spans don't land on the request that scheduled it
+        start_trace(f"prefetch-{self.name}")
+        async with self._semaphore:
+            await warm()
+
+    def _finished(self, target: Hashable, task: asyncio.Task) -> None:
+        if self._tasks.get(target) is task:
+            del self._tasks[target]
+            for session_id in self._interest.pop(target, ()):
+                targets = self._session_targets.get(session_id)
+                if targets is not None:
+                    targets.discard(target)
+                    if not targets:
+                        del self._session_targets[session_id]
+        if task.cancelled():
+            self._count("cancelled")
+        elif task.exception() is not None:
+            print(f"Prefetch of {self.name} {target} failed: {task.exception()}")
+            self._count("failed")
+        else:
+            self._count("completed")
+            now = time.monotonic()
+            self._warmed[target] = now + self.ttl
+            if len(self._warmed) > self.max_entries:
+                self._warmed = {t: expires_at for t, expires_at in self._warmed.items() if expires_at > now}
+
+    def cancel(self, session_id: str, keep: Iterable[Hashable] = ()) -> int:
+        """Stop warming a session's targets other than `keep`; returns how many were cancelled"""
+        keep = set(keep)
+        cancelled = 0
+        for target in list(self._session_targets.get(session_id, ())):
+            if target in keep:
+                continue
+            self._session_targets[session_id].discard(target)
+            interest = self._interest.get(target)
+            if interest is None:
+                continue
+            interest.discard(session_id)
+            task = self._tasks.get(target)
+            if not interest and task is not None and not task.done():
+                task.cancel()
+                cancelled += 1
+        if not self._session_targets.get(session_id):
+            self._session_targets.pop(session_id, None)
+        return cancelled
+
+    def _prune_budgets(self) -> None:
+        # Forget sessions whose bucket would have refilled anyway
+        if len(self._budgets) < 1024:
+            return
+        now = time.monotonic()
+        for session_id, (tokens, updated_at) in list(self._budgets.items()):
+            if tokens + (now - updated_at) * self.refill_per_sec >= self.session_budget:
+                del self._budgets[session_id]
+
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counts, inflight=len(self._tasks), cached=len(self._results))
+
+    def shutdown(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
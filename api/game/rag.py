@@ -1,95 +1,297 @@
+import hashlib
 import json
 import os
-from typing import List, Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+import numpy as np
+
+from api.game.coalesce import normalize_text
+from api.game.embeddings import Embedder, create_embedder
+from api.game.ingest import Ingester
+from api.game.metadata_index import filter_values
+from api.game.metrics import cache_hits, cache_misses, span
+from api.game.segment import Segment, manifest_segments, manifest_stat, read_manifest, segment_path
+
+# Reciprocal rank fusion constant: larger values flatten the gap between top ranks
+RRF_K = 60
+
+
+def filters_key(filters: Optional[Dict[str, Any]]) -> str:
+    """Filters normalized the way matches_filters compares them"""
+    normalized = {
+        key: sorted(filter_values(value), key=str)
+        for key, value in (filters or {}).items() if value is not None
+    }
+    return json.dumps(normalized, sort_keys=True, default=str)
+
 
 class RAGRetriever:
-    def __init__(self, index_path: str, documents_path: str):
-        # In a full implementation, we would use FAISS or another vector database
-        # For this MVP, we'll use a simple in-memory approach with sample data
-        self.documents = self._load_sample_documents()
-        
-    def _load_sample_documents(self) -> List[Dict[str, Any]]:
-        """Load sample historical documents"""
-        return [
-            {
-                "title": "Medieval English Village Life",
-                "text": "In 13th century England, villages were typically centered around a church and manor house. Most villagers were serfs who worked the lord's land in exchange for protection and the right to farm small plots for themselves. Daily life revolved around agricultural work, with different tasks depending on the season. Village communities were close-knit, with social gatherings often occurring after church services on Sundays.",
-                "tags": ["England", "village", "daily life", "13th century"],
-                "region": "England"
-            },
-            {
-                "title": "Medieval Church and Religion",
-                "text": "The church was the center of medieval life, both spiritually and socially. Church bells marked the hours of the day and called people to prayer. Priests were often the most educated people in a village and served as advisors and record-keepers. Most people were deeply religious, believing firmly in heaven, hell, and the power of saints to intercede on their behalf. Churches often contained relics believed to have healing powers.",
-                "tags": ["religion", "church", "priest", "medieval"],
-                "region": "Europe"
-            },
-            {
-                "title": "Medieval Taverns and Alehouses",
-                "text": "Taverns in medieval England served as important social hubs where people gathered to drink, share news, and find lodging. Ale was the common drink, as water was often unsafe. Tavern keepers were licensed by local authorities and had to follow regulations about prices and measures. Travelers often sought out taverns for accommodation, though they might have to share beds with strangers. Gambling, storytelling, and music were common tavern entertainments.",
-                "tags": ["tavern", "ale", "social", "England", "medieval"],
-                "region": "England"
-            },
-            {
-                "title": "Medieval Forests and Wilderness",
-                "text": "Forests in medieval England were not simply wild areas but legally designated regions subject to forest law, which preserved hunting rights for the nobility. Commoners could be severely punished for poaching. However, forests provided essential resources: wood for fuel and building, herbs for medicine, honey from wild bees, and forage for pigs. Outlaws sometimes lived in forests, giving rise to legends like Robin Hood. Travelers feared forests as places of danger and mystery.",
-                "tags": ["forest", "wilderness", "medieval", "England"],
-                "region": "England"
-            },
-            {
-                "title": "Village Elders and Governance",
-                "text": "In medieval English villages, elders were respected community members who helped resolve disputes and maintain local customs. While the lord's steward had official authority, village elders often had significant informal influence. Many served on manorial courts that handled minor offenses and land disputes. Village elders were typically older men who had demonstrated wisdom and fairness throughout their lives. Some were also skilled in traditional medicine, using herbs and folk remedies to treat common ailments.",
-                "tags": ["elder", "governance", "village", "medieval", "England"],
-                "region": "England"
-            },
-            {
-                "title": "Medieval Knights and Chivalry",
-                "text": "Knights in 13th century England were mounted warriors who served a lord in exchange for land (fiefs). The code of chivalry governed knightly behavior, emphasizing courage, loyalty, and protection of the weak. Knights underwent years of training, starting as pages around age 7, then becoming squires before being knighted. A knight's armor and weapons were extremely expensive, often costing the equivalent of several years' income from a manor. Tournaments allowed knights to practice combat skills and gain reputation.",
-                "tags": ["knight", "chivalry", "medieval", "England", "13th century"],
-                "region": "England"
-            }
-        ]
-        
+    """
+    Vector search over the historical documents in documents_path.
+
+    Documents are split into passages, embedded (see api/game/embeddings.py)
+    and indexed twice: in an IVFIndex for vector search and in a BM25Index
+    for keyword search. A query runs both and merges their rankings with
+    reciprocal rank fusion, so exact names and terms rank well even when
+    the embedding misses them.
+
+    The index is a set of segments (see api/game/segment.py) listed in
+    index_path/manifest.json, per source file: documents_path, ingested
+    on startup whenever it changes, and any lore dumps ingested with
+    `python -m api.game.ingest`. Segments are opened memory-mapped, so
+    starting a worker takes milliseconds whatever the corpus size and every
+    worker shares one copy of the index in the page cache. The vectors can
+    be stored as float16 or int8 (RAG_VECTOR_DTYPE) to shrink it further.
+
+    Filters are resolved in each segment against its metadata index before
+    anything is scored. Candidates from all segments are ranked together.
+
+    Results are cached per (normalized query, filters, k) in a bounded LRU,
+    and materialize() precomputes a fixed set of queries (every scene's
+    context query) that is kept for as long as the index is. Both are keyed
+    by the index version, so a rebuilt index never serves old results.
+
+    upsert(), delete() and merge() change the index while it serves (see
+    Ingester), and refresh() picks up changes made by any process. The
+    segments and version a search uses are one tuple, replaced in a single
+    assignment once the new view is open and its materialized queries are
+    retrieved, so a search never sees a half-updated index.
+    """
+
+    def __init__(self, index_path: str, documents_path: str, embedder: Optional[Embedder] = None,
+                 nprobe: Optional[int] = None, cache_size: Optional[int] = None, vector_dtype: Optional[str] = None):
+        self.index_path = index_path
+        self.documents_path = documents_path
+        self.embedder = embedder or create_embedder()
+        self.ingester = Ingester(index_path, self.embedder, vector_dtype)
+        self.nprobe = nprobe or (int(os.getenv("RAG_NPROBE")) if os.getenv("RAG_NPROBE") else None)
+
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv("RAG_CACHE_SIZE", "1024"))
+        self._cache: "OrderedDict[Tuple, List[Dict[str, Any]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._materialized: Dict[Tuple, List[Dict[str, Any]]] = {}
+        self._materialize_queries: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+        self._materialize_k = 2
+
+        # (version, segments) of the index searches use; see refresh()
+        self._view: Tuple[str, List[Segment]] = ("", [])
+        self._manifest_stat = None
+        self._reload_lock = threading.Lock()
+        if not self.ingester.is_current(self.documents_path):
+            try:
+                with span("rag.build_index"):
+                    self.ingester.ingest(self.documents_path)
+            except (OSError, ValueError) as e:
+                print(f"Error loading historical documents from {self.documents_path}: {e}")
+        self.refresh()
+
+    @property
+    def version(self) -> str:
+        """Identifies the index's contents in cache keys"""
+        return self._view[0]
+
+    @property
+    def segments(self) -> List[Segment]:
+        return self._view[1]
+
+    def refresh(self) -> bool:
+        """
+        Switch to the index the manifest describes if it changed since it
+        was last read; returns whether it did. Segments still listed stay
+        open (with their new tombstones), so this only opens what's new.
+        """
+        with self._reload_lock:
+            stat = manifest_stat(self.index_path)
+            if stat == self._manifest_stat and self._manifest_stat is not None:
+                return False
+            try:
+                view = self._open_view(read_manifest(self.index_path))
+            except OSError as e:
+                # A merge removed a segment between reading the manifest and opening it; retry next time
+                print(f"Error reloading the retrieval index: {e}")
+                return False
+            with span("rag.materialize"):
+                materialized = self._retrieve_all(view, self._materialize_queries, self._materialize_k)
+            self._materialized = materialized
+            self._view = view
+            self._manifest_stat = stat
+            # Entries of the old version can't be hit anymore
+            with self._cache_lock:
+                self._cache.clear()
+            return True
+
+    def _open_view(self, manifest: Dict[str, Any]) -> Tuple[str, List[Segment]]:
+        names = []
+        tombstones: Dict[str, List[int]] = {}
+        if manifest.get("settings") == self.ingester.settings:
+            names = manifest_segments(manifest)
+            tombstones = manifest.get("deleted", {})
+        current = {segment.name: segment for segment in self.segments}
+        segments = []
+        for name in names:
+            deleted = tombstones.get(name, [])
+            segment = current.get(name)
+            if segment is None:
+                segment = Segment.open(segment_path(self.index_path, name), deleted)
+                if self.nprobe:
+                    segment.index.nprobe = self.nprobe
+            elif len(segment.deleted) != len(deleted):
+                # A segment's tombstones only ever grow
+                segment = segment.with_deleted(deleted)
+            segments.append(segment)
+        contents = [self.ingester.settings, [[name, len(tombstones.get(name, []))] for name in names]]
+        return hashlib.sha256(json.dumps(contents).encode()).hexdigest()[:16], segments
+
+    def upsert(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Add or replace documents by id (see Ingester.upsert) and switch to the updated index"""
+        result = self.ingester.upsert(documents)
+        self.refresh()
+        return {**result, "version": self.version}
+
+    def delete(self, doc_ids: Iterable[Any]) -> int:
+        """Delete the documents with these ids; returns how many there were"""
+        deleted = self.ingester.delete(doc_ids)
+        if deleted:
+            self.refresh()
+        return deleted
+
+    def merge(self) -> int:
+        """Merge small segments and drop deleted documents (see Ingester.merge); returns the number of merges"""
+        merged = self.ingester.merge()
+        if merged:
+            self.refresh()
+        return merged
+
+    @staticmethod
+    def _cache_key(version: str, query: str, k: int, filters: Optional[Dict[str, Any]]) -> Tuple:
+        return version, normalize_text(query), filters_key(filters), k
+
+    def lookup(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None) -> Optional[List[Dict[str, Any]]]:
+        """The materialized or cached result for a query, or None; never searches"""
+        return self._lookup(self.version, query, k, filters)
+
+    def _lookup(self, version: str, query: str, k: int,
+                filters: Optional[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        key = self._cache_key(version, query, k, filters)
+        docs = self._materialized.get(key)
+        if docs is None:
+            with self._cache_lock:
+                docs = self._cache.get(key)
+                if docs is not None:
+                    self._cache.move_to_end(key)
+        if docs is None:
+            return None
+        cache_hits.inc(cache="rag")
+        return list(docs)
+
     def retrieve(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """Retrieve relevant documents based on query and optional filters"""
-        # In a full implementation, this would use vector similarity search
-        # For this MVP, we'll use simple keyword matching
-        
-        # Convert query to lowercase for case-insensitive matching
-        query_lower = query.lower()
-        
-        # Split query into keywords
-        keywords = query_lower.split()
-        
-        # Score documents based on keyword matches
-        scored_docs = []
-        for doc in self.documents:
-            # Apply filters if provided
-            if filters:
-                skip = False
-                for key, value in filters.items():
-                    if key in doc and value is not None and doc[key] != value:
-                        skip = True
-                        break
-                if skip:
-                    continue
-            
-            # Count keyword matches in title and text
-            score = 0
-            for keyword in keywords:
-                if keyword in doc["title"].lower():
-                    score += 2  # Title matches are weighted higher
-                if keyword in doc["text"].lower():
-                    score += 1
-                if "tags" in doc:
-                    for tag in doc["tags"]:
-                        if keyword in tag.lower():
-                            score += 1.5  # Tag matches are also important
-            
-            if score > 0:
-                scored_docs.append((score, doc))
-        
-        # Sort by score (descending) and take top k
-        scored_docs.sort(reverse=True, key=lambda x: x[0])
-        top_docs = [doc for score, doc in scored_docs[:k]]
-        
+        # The whole search uses this view, even if a refresh swaps in another meanwhile
+        version, segments = self._view
+        docs = self._lookup(version, query, k, filters)
+        if docs is not None:
+            return docs
+        cache_misses.inc(cache="rag")
+        with span("rag.retrieve"):
+            docs = self._retrieve(segments, query, self.embedder.embed([query])[0], k, filters)
+        if self.cache_size > 0:
+            with self._cache_lock:
+                self._cache[self._cache_key(version, query, k, filters)] = docs
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return list(docs)
+
+    def materialize(self, queries: List[Tuple[str, Optional[Dict[str, Any]]]], k: int = 2) -> int:
+        """
+        Retrieve every (query, filters) pair up front, embedding all the
+        queries in one batch, and keep the results outside the LRU so they
+        are never evicted. Replaces any earlier materialized set, and is
+        redone whenever the index changes; returns the number of distinct
+        queries.
+        """
+        with self._reload_lock:
+            self._materialize_queries = list(queries)
+            self._materialize_k = k
+            with span("rag.materialize"):
+                self._materialized = self._retrieve_all(self._view, self._materialize_queries, k)
+            return len(self._materialized)
+
+    def _retrieve_all(self, view: Tuple[str, List[Segment]], queries: List[Tuple[str, Optional[Dict[str, Any]]]],
+                      k: int) -> Dict[Tuple, List[Dict[str, Any]]]:
+        version, segments = view
+        requests = {}
+        for query, filters in queries:
+            requests.setdefault(self._cache_key(version, query, k, filters), (query, filters))
+        if not requests:
+            return {}
+        vectors = self.embedder.embed([query for query, _ in requests.values()])
+        return {
+            key: self._retrieve(segments, query, vector, k, filters)
+            for (key, (query, filters)), vector in zip(requests.items(), vectors)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        segments = self.segments
+        return {
+            "version": self.version,
+            "segments": len(segments),
+            "documents": sum(segment.document_count() for segment in segments),
+            "deleted_documents": sum(len(segment.deleted) for segment in segments),
+            "passages": sum(len(segment) for segment in segments),
+            "vector_dtype": self.ingester.vector_dtype,
+            "cached_queries": len(self._cache),
+            "cache_size": self.cache_size,
+            "materialized_queries": len(self._materialized),
+        }
+
+    def _retrieve(self, segments: List[Segment], query: str, query_vector: np.ndarray, k: int,
+                  filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Passages of the same document take slots, so ask for more
+        candidates = max(10 * k, 50)
+        # (score, segment number, passage id) from every segment
+        vector_hits = []
+        keyword_hits = []
+        for number, segment in enumerate(segments):
+            vector_scores, vector_ids, keyword_scores, keyword_ids = segment.search(
+                query, query_vector, candidates, k, filters
+            )
+            # Passages with no similarity at all aren't matches, however few there are
+            positive = vector_scores > 0
+            vector_hits.extend(zip(vector_scores[positive].tolist(), [number] * int(positive.sum()),
+                                   vector_ids[positive].tolist()))
+            keyword_hits.extend(zip(keyword_scores.tolist(), [number] * len(keyword_ids), keyword_ids.tolist()))
+        vector_hits.sort(key=lambda hit: -hit[0])
+        keyword_hits.sort(key=lambda hit: -hit[0])
+        return self._top_documents(segments, self._fuse(vector_hits[:candidates], keyword_hits[:candidates]), k)
+
+    @staticmethod
+    def _fuse(vector_hits: List[Tuple[float, int, int]], keyword_hits: List[Tuple[float, int, int]]) -> List[Tuple[int, int]]:
+        """
+        (segment number, passage id) ranked by reciprocal rank fusion of the
+        vector and keyword rankings. Ranks are used instead of scores
+        because cosine similarity and BM25 aren't on comparable scales.
+        """
+        fused: Dict[Tuple[int, int], float] = {}
+        for rank, (_, number, passage_id) in enumerate(vector_hits):
+            fused[number, passage_id] = 1.0 / (RRF_K + rank)
+        for rank, (_, number, passage_id) in enumerate(keyword_hits):
+            fused[number, passage_id] = fused.get((number, passage_id), 0.0) + 1.0 / (RRF_K + rank)
+        return sorted(fused, key=fused.get, reverse=True)
+
+    @staticmethod
+    def _top_documents(segments: List[Segment], passages: List[Tuple[int, int]], k: int) -> List[Dict[str, Any]]:
+        """The k best distinct documents, in order of their best passage"""
+        top_docs = []
+        seen = set()
+        for number, passage_id in passages:
+            if len(top_docs) == k:
+                break
+            segment = segments[number]
+            doc_index = int(segment.document_indexes([passage_id])[0])
+            if (number, doc_index) in seen:
+                continue
+            seen.add((number, doc_index))
+            top_docs.append(segment.documents[doc_index])
         return top_docs
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from api.game.metrics import cache_hits, cache_misses
+
+
+def content_key(*parts: Any) -> str:
+    """Stable hash of JSON-serializable inputs; any change to them gives a new key"""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache for expensive generated results.
+
+    A per-process LRU sits in front of a SQLite table that survives
+    restarts and is shared by every worker on the host. Entries are
+    content-addressed (see content_key): the key covers everything the
+    result depends on, including a version, so changing an input, a
+    prompt or a requirement simply stops matching the old entries, and
+    they age out with the TTL. Only JSON-serializable values are cached.
+    """
+
+    def __init__(self, namespace: str, path: Optional[str] = None, max_entries: int = 1024,
+                 ttl: float = 7 * 24 * 3600):
+        self.namespace = namespace
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connection() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, expires_at REAL NOT NULL, "
+                    "PRIMARY KEY (namespace, key))"
+                )
+            self.purge_expired()
+
+    @classmethod
+    def from_env(cls, namespace: str) -> "ResultCache":
+        """Configured from RESULT_CACHE_PATH (empty for memory only), RESULT_CACHE_SIZE and RESULT_CACHE_TTL_SEC"""
+        return cls(
+            namespace,
+            path=os.getenv("RESULT_CACHE_PATH", "data/cache.db") or None,
+            max_entries=int(os.getenv("RESULT_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("RESULT_CACHE_TTL_SEC", str(7 * 24 * 3600))),
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, expires_at: float, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """(True, value) for a live entry, (False, None) otherwise"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    cache_hits.inc(cache=f"{self.namespace}_memory")
+                    return True, entry[1]
+                del self._memory[key]
+
+        if self.path:
+            try:
+                row = self._connection().execute(
+                    "SELECT value, expires_at FROM results WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (self.namespace, key, now)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Error reading {self.namespace} cache: {e}")
+                row = None
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, row[1], value)
+                cache_hits.inc(cache=f"{self.namespace}_disk")
+                return True, value
+
+        cache_misses.inc(cache=self.namespace)
+        return False, None
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, expires_at, value)
+        if not self.path:
+            return
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT INTO results (namespace, key, value, created_at, expires_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET "
+                    "value = excluded.value, created_at = excluded.created_at, expires_at = excluded.expires_at",
+                    (self.namespace, key, json.dumps(value), now, expires_at)
+                )
+        except sqlite3.Error as e:
+            # The in-memory tier still has it
+            print(f"Error writing {self.namespace} cache: {e}")
+
+    def purge_expired(self) -> int:
+        """Delete expired entries from the disk tier; returns how many were removed"""
+        if not self.path:
+            return 0
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM results WHERE namespace = ? AND expires_at <= ?", (self.namespace, time.time())
+            )
+        return cursor.rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM results WHERE namespace = ?", (self.namespace,))
@@ -0,0 +1,288 @@
+import json
+import os
+from collections import deque
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+CHOICE_LETTERS = "ABCD"
+REQUIRED_FIELDS = ("scene_id", "description", "rag_context_query")
+
+DEFAULT_CAMPAIGN_PATH = "data/campaigns/default.json"
+
+
+class SceneGraphError(ValueError):
+    """A campaign file that can't be loaded, with every problem found in it"""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__("Invalid campaign:\n" + "\n".join(f"- {problem}" for problem in problems))
+
+
+class SceneGraph:
+    """
+    A campaign's scenes, validated and compiled into lookup tables.
+
+    Everything a request needs is precomputed when the campaign loads: the
+    scene by ID, its choices, the scene each choice leads to, the distinct
+    successors and predecessors of every scene, the depth of each scene
+    from the start (and the scenes at each depth), and which scenes can be
+    reached from which. Lookups are plain dict/tuple indexing, so they cost
+    the same for a campaign of ten scenes or ten thousand.
+
+    Reachability is stored as one bitset per scene (bit i = scene i), built
+    once over the graph's strongly connected components, so "can the
+    player still get to X from here?" is a single bit test.
+    """
+
+    def __init__(self, scenes: List[Dict[str, Any]], start_scene: str, campaign_id: str = "default",
+                 title: str = ""):
+        self.campaign_id = campaign_id
+        self.title = title
+        self.start_scene = start_scene
+
+        problems = self._validate(scenes, start_scene)
+        if problems:
+            raise SceneGraphError(problems)
+
+        self.scenes: Dict[str, Dict[str, Any]] = {scene["scene_id"]: scene for scene in scenes}
+        self._ids: Tuple[str, ...] = tuple(self.scenes)
+        self._index: Dict[str, int] = {scene_id: i for i, scene_id in enumerate(self._ids)}
+
+        # scene -> scene reached by each choice, in choice order
+        self._transitions: Dict[str, Tuple[str, ...]] = {}
+        self._successors: Dict[str, Tuple[str, ...]] = {}
+        predecessors: Dict[str, List[str]] = {scene_id: [] for scene_id in self._ids}
+        for scene_id, scene in self.scenes.items():
+            next_scene_map = scene.get("next_scene_map", {})
+            transitions = tuple(next_scene_map[letter] for letter in CHOICE_LETTERS[:len(scene.get("actions", []))])
+            self._transitions[scene_id] = transitions
+            self._successors[scene_id] = tuple(dict.fromkeys(transitions))
+            for successor in self._successors[scene_id]:
+                predecessors[successor].append(scene_id)
+        self._predecessors = {scene_id: tuple(ids) for scene_id, ids in predecessors.items()}
+
+        self._depth, self._by_depth = self._compute_depths()
+        self._reach = self._compute_reachability()
+
+        unreachable = [scene_id for scene_id in self._ids if scene_id not in self._depth]
+        if unreachable:
+            shown = ", ".join(unreachable[:10]) + (", ..." if len(unreachable) > 10 else "")
+            print(f"Campaign {campaign_id}: {len(unreachable)} scenes unreachable from {start_scene}: {shown}")
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SceneGraph":
+        scenes = data.get("scenes")
+        if not isinstance(scenes, list):
+            raise SceneGraphError(["'scenes' must be a list of scenes"])
+        start_scene = data.get("start_scene") or (scenes[0].get("scene_id") if scenes else None)
+        return cls(scenes, start_scene, campaign_id=data.get("campaign_id", "default"),
+                   title=data.get("title", ""))
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> "SceneGraph":
+        """Load a campaign file (CAMPAIGN_PATH, or the bundled default campaign)"""
+        path = path or os.getenv("CAMPAIGN_PATH", DEFAULT_CAMPAIGN_PATH)
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    @staticmethod
+    def _validate(scenes: List[Dict[str, Any]], start_scene: Optional[str]) -> List[str]:
+        problems: List[str] = []
+        seen = set()
+        for position, scene in enumerate(scenes):
+            if not isinstance(scene, dict):
+                problems.append(f"scene #{position} is not an object")
+                continue
+            for field in REQUIRED_FIELDS:
+                if not scene.get(field):
+                    problems.append(f"scene #{position} ({scene.get('scene_id')}) is missing '{field}'")
+            scene_id = scene.get("scene_id")
+            if scene_id in seen:
+                problems.append(f"duplicate scene_id '{scene_id}'")
+            seen.add(scene_id)
+
+        ids = {scene.get("scene_id") for scene in scenes if isinstance(scene, dict)}
+        if start_scene not in ids:
+            problems.append(f"start scene '{start_scene}' is not defined")
+
+        for scene in scenes:
+            if not isinstance(scene, dict):
+                continue
+            scene_id = scene.get("scene_id")
+            actions = scene.get("actions", [])
+            next_scene_map = scene.get("next_scene_map", {})
+            if not isinstance(actions, list) or len(actions) > len(CHOICE_LETTERS):
+                problems.append(f"'{scene_id}': 'actions' must be a list of at most {len(CHOICE_LETTERS)} choices")
+                continue
+            letters = CHOICE_LETTERS[:len(actions)]
+            for letter, action in zip(letters, actions):
+                if not str(action).startswith(f"{letter})"):
+                    problems.append(f"'{scene_id}': choice {letter} should start with '{letter})'")
+            if set(next_scene_map) != set(letters):
+                problems.append(f"'{scene_id}': next_scene_map keys {sorted(next_scene_map)} "
+                                f"don't match its choices {list(letters)}")
+            for letter, target in next_scene_map.items():
+                if target not in ids:
+                    problems.append(f"'{scene_id}': choice {letter} leads to undefined scene '{target}'")
+            impacts = scene.get("impacts")
+            if impacts is not None:
+                if not isinstance(impacts, list) or len(impacts) != len(actions):
+                    problems.append(f"'{scene_id}': 'impacts' must have one entry per choice")
+                elif not all(isinstance(impact, dict) and all(isinstance(value, int) for value in impact.values())
+                             for impact in impacts):
+                    problems.append(f"'{scene_id}': impacts must map fields to whole numbers")
+        return problems
+
+    def _compute_depths(self) -> Tuple[Dict[str, int], Dict[int, Tuple[str, ...]]]:
+        """Fewest choices needed to reach each scene from the start (breadth-first)"""
+        depth = {self.start_scene: 0}
+        by_depth: Dict[int, List[str]] = {0: [self.start_scene]}
+        queue = deque([self.start_scene])
+        while queue:
+            scene_id = queue.popleft()
+            for successor in self._successors[scene_id]:
+                if successor not in depth:
+                    depth[successor] = depth[scene_id] + 1
+                    by_depth.setdefault(depth[successor], []).append(successor)
+                    queue.append(successor)
+        return depth, {d: tuple(ids) for d, ids in by_depth.items()}
+
+    def _compute_reachability(self) -> List[int]:
+        """
+        Bitset of the scenes reachable from each scene (including itself).
+
+        Tarjan's algorithm (iterative, so deep campaigns don't hit the
+        recursion limit) emits strongly connected components sinks first,
+        so each component's set is its members plus the already computed
+        sets of the components it points to.
+        """
+        count = len(self._ids)
+        successors = [[self._index[s] for s in self._successors[scene_id]] for scene_id in self._ids]
+        index = [-1] * count
+        lowlink = [0] * count
+        on_stack = [False] * count
+        stack: List[int] = []
+        component_of = [-1] * count
+        component_reach: List[int] = []
+        counter = 0
+
+        for root in range(count):
+            if index[root] != -1:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, child = work[-1]
+                if child == 0:
+                    index[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                if child < len(successors[node]):
+                    work[-1] = (node, child + 1)
+                    target = successors[node][child]
+                    if index[target] == -1:
+                        work.append((target, 0))
+                    elif on_stack[target]:
+                        lowlink[node] = min(lowlink[node], index[target])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        members.append(member)
+                        if member == node:
+                            break
+                    component = len(component_reach)
+                    reach = 0
+                    for member in members:
+                        component_of[member] = component
+                        reach |= 1 << member
+                    for member in members:
+                        for target in successors[member]:
+                            if component_of[target] != component:
+                                reach |= component_reach[component_of[target]]
+                    component_reach.append(reach)
+
+        return [component_reach[component_of[i]] for i in range(count)]
+
+    def __contains__(self, scene_id: str) -> bool:
+        return scene_id in self.scenes
+
+    def __len__(self) -> int:
+        return len(self.scenes)
+
+    @property
+    def scene_ids(self) -> Tuple[str, ...]:
+        """Scene IDs in campaign order; a scene's position is its index in the compiled tables"""
+        return self._ids
+
+    def index_of(self, scene_id: str) -> int:
+        if scene_id not in self._index:
+            raise ValueError(f"Scene {scene_id} not found")
+        return self._index[scene_id]
+
+    def scene(self, scene_id: str) -> Dict[str, Any]:
+        if scene_id not in self.scenes:
+            raise ValueError(f"Scene {scene_id} not found")
+        return self.scenes[scene_id]
+
+    def choices(self, scene_id: str) -> List[str]:
+        return self.scene(scene_id).get("actions", [])
+
+    def next_scene(self, scene_id: str, choice_index: int) -> str:
+        """The scene a choice leads to"""
+        transitions = self._transitions.get(scene_id)
+        if transitions is None:
+            raise ValueError(f"Scene {scene_id} not found")
+        if not 0 <= choice_index < len(transitions):
+            raise ValueError(f"Scene {scene_id} has no choice {choice_index}")
+        return transitions[choice_index]
+
+    def successors(self, scene_id: str) -> Tuple[str, ...]:
+        """Distinct scenes one choice away, in choice order"""
+        return self._successors.get(scene_id, ())
+
+    def predecessors(self, scene_id: str) -> Tuple[str, ...]:
+        return self._predecessors.get(scene_id, ())
+
+    def depth(self, scene_id: str) -> Optional[int]:
+        """Fewest choices from the start scene, or None if it can't be reached"""
+        return self._depth.get(scene_id)
+
+    def scenes_at_depth(self, depth: int) -> Tuple[str, ...]:
+        return self._by_depth.get(depth, ())
+
+    def can_reach(self, from_scene: str, to_scene: str) -> bool:
+        return bool(self._reach[self._index[from_scene]] >> self._index[to_scene] & 1)
+
+    def reachable(self, scene_id: str) -> FrozenSet[str]:
+        """Every scene the player can still get to from this one (including it)"""
+        reach = self._reach[self._index[scene_id]]
+        return frozenset(self._ids[i] for i in range(len(self._ids)) if reach >> i & 1)
+
+    def within(self, scene_id: str, hops: int) -> Dict[str, int]:
+        """Scenes at most `hops` choices away, with their distance (for prefetching)"""
+        distance = {scene_id: 0}
+        frontier = [scene_id]
+        for hop in range(1, hops + 1):
+            next_frontier = []
+            for current in frontier:
+                for successor in self._successors[current]:
+                    if successor not in distance:
+                        distance[successor] = hop
+                        next_frontier.append(successor)
+            frontier = next_frontier
+        return distance
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "campaign_id": self.campaign_id,
+            "scenes": len(self.scenes),
+            "transitions": sum(len(t) for t in self._transitions.values()),
+            "reachable_from_start": len(self._depth),
+            "max_depth": max(self._by_depth) if self._by_depth else 0,
+        }
@@ -1,15 +1,16 @@
-import ai21
 from typing import Dict, Any, List
 
+from api.game.ai21_client import ai21_clients
+
 class ScoringAgent:
     """
     Agent responsible for scoring player choices and providing feedback
     based on game objectives and player alignment.
     """
     
-    def __init__(self, api_key: str):
-        # Initialize the AI21 client with the API key
-        self.client = ai21.AI21Client(api_key=api_key)
+    def __init__(self, api_key: str, client=None):
+        # The process-wide AI21 client for this key (see api/game/ai21_client.py)
+        self.client = client or ai21_clients.get(api_key)
         
         # Define scoring categories and weights
         self.scoring_categories = {
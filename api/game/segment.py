@@ -0,0 +1,287 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from api.game.document_store import DocumentStore
+from api.game.keyword_index import BM25_B, BM25_K1, BM25Index
+from api.game.metadata_index import MetadataIndex, normalize_value, sorted_contains
+from api.game.vector_index import IVFIndex
+
+# Bump when passage splitting or the files of a segment change
+INDEX_FORMAT_VERSION = 4
+# Long documents are indexed as overlapping windows of this many words
+PASSAGE_WORDS = 120
+PASSAGE_OVERLAP = 20
+
+SEGMENTS_DIR = "segments"
+MANIFEST = "manifest.json"
+# Files of the single-file index format that came before directories
+LEGACY_FILES = ("ivf.npz", "bm25.npz", "passage_docs.npy")
+# The format before segments: one directory per index, named by a fingerprint prefix and holding these
+LEGACY_VERSION_DIR = re.compile(r"[0-9a-f]{16}")
+LEGACY_VERSION_ENTRIES = ("documents", "passage_offsets.npy", "ivf", "bm25", "metadata")
+# Manifest source of the documents added, updated and deleted while the API runs
+LIVE_SOURCE = "live"
+
+
+def index_settings(embedder_signature: str, vector_dtype: str) -> str:
+    """Everything besides the documents that an index depends on; segments built with other settings can't be mixed"""
+    return (f"{INDEX_FORMAT_VERSION}:{PASSAGE_WORDS}:{PASSAGE_OVERLAP}:{BM25_K1}:{BM25_B}:"
+            f"{vector_dtype}:{embedder_signature}")
+
+
+class Segment:
+    """
+    An immutable slice of the retrieval index: some documents, their
+    passages and the vector, keyword and metadata indexes over those
+    passages. Saved as one directory and opened memory-mapped.
+
+    Documents deleted or replaced later are only tombstoned: deleted holds
+    their indexes (kept in the manifest, not in the segment) and searches
+    skip their passages until a merge rewrites the segment without them.
+    """
+
+    def __init__(self, name: str, documents: Sequence[Dict[str, Any]], passage_offsets: np.ndarray,
+                 index: IVFIndex, keywords: BM25Index, metadata: MetadataIndex,
+                 passage_hashes: Optional[np.ndarray] = None, deleted: Sequence[int] = ()):
+        self.name = name
+        self.documents = documents
+        # Document d's passages are passage_offsets[d]:passage_offsets[d + 1]
+        self.passage_offsets = passage_offsets
+        self.index = index
+        self.keywords = keywords
+        self.metadata = metadata
+        # Content hashes of the passages, used to deduplicate later ingestion
+        self.passage_hashes = passage_hashes if passage_hashes is not None else np.zeros(0, dtype=np.uint64)
+        self.deleted = np.unique(np.asarray(deleted, dtype=np.int64))
+        # Sorted ids of the passages of the documents that aren't deleted, or None when all of them are live
+        self.live = None
+        if len(self.deleted):
+            live_documents = np.ones(len(passage_offsets) - 1, dtype=bool)
+            live_documents[self.deleted] = False
+            self.live = metadata.passages(np.flatnonzero(live_documents))
+
+    @classmethod
+    def build(cls, name: str, documents: List[Dict[str, Any]], passage_counts: List[int], passages: List[str],
+              vectors: np.ndarray, passage_hashes: np.ndarray, vector_dtype: str = "float32") -> "Segment":
+        """A segment from documents, the number of passages each has, and the passages' texts and vectors"""
+        passage_offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        passage_offsets[1:] = np.cumsum(passage_counts)
+        index = IVFIndex.build(vectors, dtype=vector_dtype)
+        keywords = BM25Index.build(passages)
+        metadata = MetadataIndex.build(documents, passage_offsets)
+        return cls(name, documents, passage_offsets, index, keywords, metadata, passage_hashes)
+
+    def save(self, directory: str) -> None:
+        """Write the segment to directory; it only appears under that name once complete"""
+        temp_directory = f"{directory}.tmp-{os.getpid()}"
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        DocumentStore.write(os.path.join(temp_directory, "documents"), self.documents)
+        np.save(os.path.join(temp_directory, "passage_offsets.npy"), self.passage_offsets)
+        np.save(os.path.join(temp_directory, "passage_hashes.npy"), self.passage_hashes)
+        self.index.save(os.path.join(temp_directory, "ivf"))
+        self.keywords.save(os.path.join(temp_directory, "bm25"))
+        self.metadata.save(os.path.join(temp_directory, "metadata"))
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            # Another process wrote the same segment first
+            if not os.path.isdir(directory):
+                raise
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+    @classmethod
+    def open(cls, directory: str, deleted: Sequence[int] = ()) -> "Segment":
+        passage_offsets = np.load(os.path.join(directory, "passage_offsets.npy"), mmap_mode="r")
+        return cls(
+            os.path.basename(directory),
+            DocumentStore(os.path.join(directory, "documents")),
+            passage_offsets,
+            IVFIndex.load(os.path.join(directory, "ivf")),
+            BM25Index.load(os.path.join(directory, "bm25")),
+            MetadataIndex.load(os.path.join(directory, "metadata"), passage_offsets),
+            np.load(os.path.join(directory, "passage_hashes.npy"), mmap_mode="r"),
+            deleted,
+        )
+
+    def close(self) -> None:
+        """Release the document store; only for segments no search can still be using"""
+        if isinstance(self.documents, DocumentStore):
+            self.documents.close()
+
+    def with_deleted(self, deleted: Sequence[int]) -> "Segment":
+        """The same segment with other tombstones; shares everything else, so it's cheap"""
+        return Segment(self.name, self.documents, self.passage_offsets, self.index, self.keywords, self.metadata,
+                       self.passage_hashes, deleted)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def document_count(self) -> int:
+        """Documents that aren't deleted"""
+        return len(self.documents) - len(self.deleted)
+
+    def find(self, doc_id: Any) -> List[int]:
+        """Indexes of the live documents with this id"""
+        candidates = self.metadata.documents_with("id", normalize_value(doc_id)).tolist()
+        deleted = set(self.deleted.tolist())
+        # The metadata index casefolds ids, so compare the stored ones too
+        return [index for index in candidates if index not in deleted and self.documents[index].get("id") == doc_id]
+
+    def document_indexes(self, passage_ids: Sequence[int]) -> np.ndarray:
+        return np.searchsorted(self.passage_offsets, passage_ids, side="right") - 1
+
+    def search(self, query: str, query_vector: np.ndarray, candidates: int, k: int,
+               filters: Optional[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Vector and keyword candidates among the passages whose documents
+        pass the filters: (vector scores, passage ids, keyword scores,
+        passage ids), each best first.
+
+        Filters are resolved against the metadata index to passage ids
+        before anything is scored. When fewer passages match than a vector search would scan
+        anyway, only those are compared with the query.
+        """
+        empty = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        if not len(self.index):
+            return empty + empty
+
+        # Sorted ids of the passages that may match, or None for all of them
+        allowed = self.live
+        documents = self.metadata.resolve_documents(filters)
+        if documents is not None:
+            if len(self.deleted):
+                documents = documents[~sorted_contains(self.deleted, documents)]
+            allowed = self.metadata.passages(documents)
+        if allowed is not None and not len(allowed):
+            return empty + empty
+
+        if allowed is not None and len(allowed) <= self.index.rows_scanned():
+            # Fewer matching passages than the probed lists hold: compare with just those, exactly
+            vector_scores, vector_ids = self.index.search_ids(query_vector, candidates, allowed)
+            exact = True
+        else:
+            vector_scores, vector_ids = self.index.search(query_vector, candidates, allowed=allowed)
+            exact = allowed is None
+        if not exact and len(np.unique(self.document_indexes(vector_ids))) < k:
+            # The probed lists held too few matching passages; search all of them
+            vector_scores, vector_ids = self.index.search_ids(query_vector, candidates, allowed)
+        keyword_scores, keyword_ids = self.keywords.search(query, candidates, allowed=allowed)
+        return vector_scores, vector_ids, keyword_scores, keyword_ids
+
+
+def segment_path(index_path: str, name: str) -> str:
+    return os.path.join(index_path, SEGMENTS_DIR, name)
+
+
+def stage_segment(index_path: str, segment: Segment) -> str:
+    """
+    Save segment under a temporary name, which remove_unused_segments
+    leaves alone; returns the path for publish_segment
+    """
+    staged = f"{segment_path(index_path, segment.name)}.tmp-{os.getpid()}"
+    segment.save(staged)
+    return staged
+
+
+def publish_segment(index_path: str, staged: str, name: str) -> None:
+    """
+    Move a staged segment to its name. Call with the manifest lock held, in
+    the critical section that references it, so a concurrent
+    remove_unused_segments never sees it unreferenced.
+    """
+    os.rename(staged, segment_path(index_path, name))
+
+
+def read_manifest(index_path: str) -> Dict[str, Any]:
+    """
+    The index's manifest, or {} if there's none: {"settings",
+    "sources": {source: {"fingerprint", "stat", "segments", "documents",
+    "passages"}}, "deleted": {segment: [document indexes]}, "edited":
+    [ids changed through the live source]}
+    """
+    try:
+        with open(os.path.join(index_path, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def manifest_stat(index_path: str) -> Optional[Tuple[int, int, int]]:
+    """Changes whenever the manifest is written (it's replaced, so the inode does)"""
+    try:
+        stat = os.stat(os.path.join(index_path, MANIFEST))
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def write_manifest(index_path: str, manifest: Dict[str, Any]) -> None:
+    # Tombstones go with their segment
+    names = set(manifest_segments(manifest))
+    manifest["deleted"] = {name: docs for name, docs in manifest.get("deleted", {}).items() if name in names}
+    path = os.path.join(index_path, MANIFEST)
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def manifest_segments(manifest: Dict[str, Any]) -> List[str]:
+    return [name for source in manifest.get("sources", {}).values() for name in source["segments"]]
+
+
+@contextmanager
+def index_lock(index_path: str, name: str = "manifest") -> Iterator[None]:
+    """
+    An exclusive lock across processes, so workers and the ingest CLI take
+    turns: "manifest" while changing the manifest, or one per source while
+    ingesting it
+    """
+    os.makedirs(index_path, exist_ok=True)
+    with open(os.path.join(index_path, f".{name}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def remove_unused_segments(index_path: str, keep: Sequence[str]) -> None:
+    """
+    Delete segment directories that nothing references, and the files left
+    by older index formats. Processes still serving a deleted segment keep
+    their mapped files until they close them. Nothing else under index_path
+    is touched.
+    """
+    keep = set(keep)
+    # Segments of an interrupted ingestion, kept so it can resume
+    ingest_dir = os.path.join(index_path, "ingest")
+    for name in os.listdir(ingest_dir) if os.path.isdir(ingest_dir) else []:
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(ingest_dir, name)) as f:
+                    keep.update(json.load(f).get("segments", []))
+            except (OSError, ValueError):
+                pass
+    segments_dir = os.path.join(index_path, SEGMENTS_DIR)
+    for name in os.listdir(segments_dir) if os.path.isdir(segments_dir) else []:
+        if name not in keep and ".tmp-" not in name:
+            shutil.rmtree(os.path.join(segments_dir, name), ignore_errors=True)
+
+    for name in LEGACY_FILES:
+        path = os.path.join(index_path, name)
+        if os.path.isfile(path):
+            os.remove(path)
+    for name in os.listdir(index_path):
+        path = os.path.join(index_path, name)
+        if LEGACY_VERSION_DIR.fullmatch(name) and all(
+            os.path.exists(os.path.join(path, entry)) for entry in LEGACY_VERSION_ENTRIES
+        ):
+            shutil.rmtree(path, ignore_errors=True)
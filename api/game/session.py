@@ -0,0 +1,399 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from api.game.events import MOOD, SCENE, apply_event, decode_event, encode_event
+
+# Bump when the compact layout below changes
+STATE_FORMAT_VERSION = 1
+
+
+class SessionConflictError(Exception):
+    """Raised when a session was saved by someone else since it was loaded"""
+
+
+class GameSession:
+    """Everything the game remembers about one player"""
+
+    def __init__(self, session_id: str, player_state: Dict[str, Any], agent_state: Dict[str, Any],
+                 agent_memory: Dict[str, Any], current_scene: Optional[str] = None, version: int = 0):
+        self.session_id = session_id
+        self.player_state = player_state
+        self.agent_state = agent_state
+        self.agent_memory = agent_memory
+        self.current_scene = current_scene
+        # Number of events in the session's log; used to detect concurrent writers
+        self.version = version
+        # Version the latest stored snapshot was taken at
+        self.snapshot_version = version
+        # Turn events since the last save (see GameOrchestrator.update_player_state)
+        self.events: List[Dict[str, Any]] = []
+        self._mark_saved()
+
+    def _mark_saved(self) -> None:
+        self._saved_scene = self.current_scene
+        self._saved_mood = self.agent_memory.get("mood")
+
+    def pending_events(self) -> List[Dict[str, Any]]:
+        """Events since the last save: the recorded turns, plus a scene or mood change if there was one"""
+        events = list(self.events)
+        if self.agent_memory.get("mood") != self._saved_mood:
+            events.append({"type": MOOD, "mood": self.agent_memory.get("mood")})
+        if self.current_scene != self._saved_scene:
+            events.append({"type": SCENE, "scene_id": self.current_scene})
+        return events
+
+    def to_compact(self) -> str:
+        """
+        Serialize to a compact JSON array. Positional fields and no whitespace
+        keep a typical session well under a kilobyte.
+        """
+        player, agent, memory = self.player_state, self.agent_state, self.agent_memory
+        return json.dumps([
+            STATE_FORMAT_VERSION,
+            self.current_scene,
+            [player["alignment"]["law_chaos"], player["alignment"]["good_evil"]],
+            player["experience"],
+            player["score"],
+            player["skills"],
+            player["feedback_history"],
+            agent["trust"],
+            agent["recent_actions"],
+            [memory["trust_in_player"], memory["mood"], memory["recent_actions"]],
+        ], separators=(",", ":"))
+
+    @classmethod
+    def from_compact(cls, session_id: str, data: str, template_memory: Dict[str, Any], version: int = 0) -> "GameSession":
+        """Rebuild a session from to_compact() output (a snapshot taken at `version`)"""
+        fields = json.loads(data)
+        if fields[0] != STATE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported session format {fields[0]}")
+        (_, current_scene, alignment, experience, score, skills, feedback_history,
+         trust, recent_actions, memory_fields) = fields
+        memory = dict(template_memory)
+        memory["trust_in_player"], memory["mood"], memory["recent_actions"] = memory_fields
+        return cls(
+            session_id=session_id,
+            player_state={
+                "alignment": {"law_chaos": alignment[0], "good_evil": alignment[1]},
+                "skills": skills,
+                "experience": experience,
+                "score": score,
+                "feedback_history": feedback_history,
+            },
+            agent_state={"trust": trust, "recent_actions": recent_actions},
+            agent_memory=memory,
+            current_scene=current_scene,
+            version=version,
+        )
+
+
+class SessionBackend:
+    """
+    Storage for sessions as an append-only event log per session plus its
+    latest snapshot. A session's version is the number of events in its
+    log. Implementations must be thread-safe.
+    """
+
+    def load(self, session_id: str) -> Optional[Tuple[Optional[str], int, List[Tuple[int, str]]]]:
+        """
+        Return (latest snapshot or None, the version it was taken at, the
+        (version, event) pairs logged since), or None if the session does
+        not exist
+        """
+        raise NotImplementedError
+
+    def append(self, session_id: str, events: List[str], expected_version: int) -> int:
+        """
+        Append events if the session's version still equals expected_version
+        and return the new version; raise SessionConflictError otherwise.
+        """
+        raise NotImplementedError
+
+    def save_snapshot(self, session_id: str, data: str, version: int) -> None:
+        """Store the state as of `version`, unless a newer snapshot is already stored"""
+        raise NotImplementedError
+
+    def events(self, session_id: str, after: int = 0) -> List[Tuple[int, str]]:
+        """(version, event) pairs logged after version `after`, oldest first"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+
+class InMemoryBackend(SessionBackend):
+    """Process-local backend; sessions are lost on restart"""
+
+    def __init__(self):
+        self._logs: Dict[str, List[str]] = {}
+        self._snapshots: Dict[str, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, session_id: str) -> Optional[Tuple[Optional[str], int, List[Tuple[int, str]]]]:
+        with self._lock:
+            log = self._logs.get(session_id)
+            if log is None:
+                return None
+            snapshot, snapshot_version = self._snapshots.get(session_id, (None, 0))
+            return snapshot, snapshot_version, list(enumerate(log[snapshot_version:], snapshot_version + 1))
+
+    def append(self, session_id: str, events: List[str], expected_version: int) -> int:
+        with self._lock:
+            log = self._logs.setdefault(session_id, [])
+            if len(log) != expected_version:
+                raise SessionConflictError(f"Session {session_id} was modified concurrently")
+            log.extend(events)
+            return len(log)
+
+    def save_snapshot(self, session_id: str, data: str, version: int) -> None:
+        with self._lock:
+            current = self._snapshots.get(session_id)
+            if current is None or current[1] < version:
+                self._snapshots[session_id] = (data, version)
+
+    def events(self, session_id: str, after: int = 0) -> List[Tuple[int, str]]:
+        with self._lock:
+            return list(enumerate(self._logs.get(session_id, [])[after:], after + 1))
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._logs.pop(session_id, None)
+            self._snapshots.pop(session_id, None)
+
+
+class SQLiteBackend(SessionBackend):
+    """
+    SQLite-backed sessions. Every uvicorn worker pointing at the same file
+    sees the same sessions, which is enough to run several workers on one host.
+
+    Saving a turn inserts a few small rows into session_events; the
+    (session_id, version) primary key is what rejects a concurrent writer.
+    Sessions stored by the earlier one-row-per-session layout are moved
+    into session_snapshots the first time the database is opened.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_events ("
+                "session_id TEXT NOT NULL, version INTEGER NOT NULL, data TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (session_id, version))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_snapshots ("
+                "session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL)"
+            )
+            legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sessions'").fetchone()
+            if legacy:
+                conn.execute(
+                    "INSERT OR IGNORE INTO session_snapshots (session_id, version, data) "
+                    "SELECT session_id, version, data FROM sessions"
+                )
+                conn.execute("ALTER TABLE sessions RENAME TO sessions_migrated")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id: str) -> Optional[Tuple[Optional[str], int, List[Tuple[int, str]]]]:
+        conn = self._connection()
+        snapshot = conn.execute(
+            "SELECT data, version FROM session_snapshots WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        snapshot_version = snapshot[1] if snapshot else 0
+        # Events are never rewritten, so the tail matches whichever snapshot was read
+        events = self.events(session_id, snapshot_version)
+        if snapshot is None and not events:
+            return None
+        return (snapshot[0] if snapshot else None), snapshot_version, events
+
+    def append(self, session_id: str, events: List[str], expected_version: int) -> int:
+        conn = self._connection()
+        now = time.time()
+        rows = [(session_id, expected_version + i, data, now) for i, data in enumerate(events, 1)]
+        try:
+            # Versions are contiguous, so a stale writer always collides on expected_version + 1
+            with conn:
+                conn.executemany(
+                    "INSERT INTO session_events (session_id, version, data, created_at) VALUES (?, ?, ?, ?)", rows
+                )
+        except sqlite3.IntegrityError:
+            raise SessionConflictError(f"Session {session_id} was modified concurrently")
+        return expected_version + len(events)
+
+    def save_snapshot(self, session_id: str, data: str, version: int) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO session_snapshots (session_id, version, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET version = excluded.version, data = excluded.data "
+                "WHERE excluded.version > session_snapshots.version",
+                (session_id, version, data)
+            )
+
+    def events(self, session_id: str, after: int = 0) -> List[Tuple[int, str]]:
+        return self._connection().execute(
+            "SELECT version, data FROM session_events WHERE session_id = ? AND version > ? ORDER BY version",
+            (session_id, after)
+        ).fetchall()
+
+    def delete(self, session_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM session_events WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM session_snapshots WHERE session_id = ?", (session_id,))
+
+
+def create_backend(name: Optional[str] = None, path: Optional[str] = None) -> SessionBackend:
+    """Build the backend selected by SESSION_BACKEND ("memory" or "sqlite")"""
+    name = (name or os.getenv("SESSION_BACKEND", "memory")).lower()
+    if name == "memory":
+        return InMemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(path or os.getenv("SESSION_DB_PATH", "data/sessions.db"))
+    raise ValueError(f"Unknown session backend {name}")
+
+
+class SessionStore:
+    """
+    Per-player game state with per-session locking.
+
+    Requests for the same session are serialized by an asyncio lock, so a
+    player's alignment and score can't be corrupted by overlapping requests,
+    while requests for different sessions proceed independently.
+
+    Saving appends the session's new events to its log; every
+    snapshot_every events the whole state is also stored as a snapshot.
+    Loading takes the latest snapshot and replays the events logged since.
+    """
+
+    def __init__(self, backend: SessionBackend, new_player_state, new_agent_state, new_agent_memory,
+                 snapshot_every: Optional[int] = None):
+        self.backend = backend
+        self.snapshot_every = snapshot_every or int(os.getenv("SESSION_SNAPSHOT_EVERY", "20"))
+        self._new_player_state = new_player_state
+        self._new_agent_state = new_agent_state
+        self._new_agent_memory = new_agent_memory
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def _new_session(self, session_id: str) -> GameSession:
+        return GameSession(
+            session_id=session_id,
+            player_state=self._new_player_state(),
+            agent_state=self._new_agent_state(),
+            agent_memory=self._new_agent_memory(),
+        )
+
+    def load(self, session_id: str) -> GameSession:
+        """Load a session, creating a fresh one if it doesn't exist yet"""
+        stored = self.backend.load(session_id)
+        if stored is None:
+            return self._new_session(session_id)
+        snapshot, snapshot_version, events = stored
+        if snapshot is None:
+            session = self._new_session(session_id)
+        else:
+            session = GameSession.from_compact(session_id, snapshot, self._new_agent_memory(), snapshot_version)
+        for version, data in events:
+            apply_event(session, decode_event(data))
+            session.version = version
+        session._mark_saved()
+        return session
+
+    def save(self, session: GameSession) -> None:
+        events = session.pending_events()
+        if not events:
+            return
+        session.version = self.backend.append(
+            session.session_id, [encode_event(event) for event in events], session.version
+        )
+        session.events.clear()
+        session._mark_saved()
+
+        if session.version - session.snapshot_version >= self.snapshot_every:
+            try:
+                self.backend.save_snapshot(session.session_id, session.to_compact(), session.version)
+                session.snapshot_version = session.version
+            except Exception as e:
+                # The events are stored; the next save tries again
+                print(f"Error saving snapshot of session {session.session_id}: {e}")
+
+    def history(self, session_id: str) -> List[Dict[str, Any]]:
+        """Every event in a session's log, each with the version it created"""
+        return [dict(decode_event(data), version=version) for version, data in self.backend.events(session_id)]
+
+    def session(self, session_id: Optional[str] = None) -> "_LockedSession":
+        """
+        Async context manager yielding the locked session; it is saved on a
+        clean exit. A new session ID is issued when none is given.
+
+            async with store.session(session_id) as session:
+                ...
+        """
+        return _LockedSession(self, session_id or self.new_session_id())
+
+    async def _acquire(self, session_id: str) -> None:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        self._waiters[session_id] = self._waiters.get(session_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_waiter(session_id)
+            raise
+
+    def _release(self, session_id: str) -> None:
+        self._locks[session_id].release()
+        self._release_waiter(session_id)
+
+    def _release_waiter(self, session_id: str) -> None:
+        # Drop the lock once nobody holds or waits on it, so idle sessions cost nothing
+        self._waiters[session_id] -= 1
+        if self._waiters[session_id] == 0:
+            del self._waiters[session_id]
+            del self._locks[session_id]
+
+
+class _LockedSession:
+    def __init__(self, store: SessionStore, session_id: str):
+        self.store = store
+        self.session_id = session_id
+        self.session: Optional[GameSession] = None
+
+    async def __aenter__(self) -> GameSession:
+        await self.store._acquire(self.session_id)
+        try:
+            self.session = self.store.load(self.session_id)
+        except BaseException:
+            self.store._release(self.session_id)
+            raise
+        return self.session
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.store.save(self.session)
+        finally:
+            self.store._release(self.session_id)
@@ -0,0 +1,221 @@
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from api.game.metadata_index import sorted_contains
+
+# Below this many vectors an exact scan is as fast as probing lists
+FLAT_THRESHOLD = 2048
+# Rows scored per matrix product while training and assigning
+BATCH_ROWS = 16384
+# How vectors can be stored: float32 is exact, float16 halves the size,
+# int8 (one scale per vector) quarters it
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+
+def default_nlist(count: int) -> int:
+    """~4 * sqrt(n) lists, so a probe scans about sqrt(n) / 4 vectors per list"""
+    if count < FLAT_THRESHOLD:
+        return 1
+    return int(4 * np.sqrt(count))
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BATCH_ROWS):
+        batch = vectors[start:start + BATCH_ROWS]
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def _train_centroids(vectors: np.ndarray, nlist: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """Spherical k-means: centroids are kept unit length, so inner product is cosine"""
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums
+        # Restart empty lists from random vectors
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        np.divide(centroids, norms, out=centroids, where=norms > 0)
+    return centroids
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Vectors in the storage dtype, and for int8 the per-vector scales that restore them"""
+    if dtype == "float32":
+        return vectors, None
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.zeros(0, dtype=np.float32)
+        scales = np.where(scales > 0, scales, 1).astype(np.float32)
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    raise ValueError(f"Unknown vector dtype {dtype}, expected one of {', '.join(VECTOR_DTYPES)}")
+
+
+class IVFIndex:
+    """
+    Inverted-file index for top-k inner-product search over unit vectors.
+
+    Vectors are clustered around nlist centroids and stored grouped by
+    cluster. A query is compared with every centroid and then only with
+    the vectors of the nprobe closest clusters, so its cost grows with
+    nlist + nprobe * n / nlist instead of n: with the default ~4 * sqrt(n)
+    lists and nprobe=16 that's about 5,000 dot products at n = 500k.
+    Small collections use a single list, i.e. an exact scan.
+
+    Vectors can be stored quantized (see quantize) and are scored in
+    float32. A saved index is loaded memory-mapped: a search only pages in
+    the lists it probes, and every process that opens the same files shares
+    one copy in the page cache.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, ids: np.ndarray, offsets: np.ndarray,
+                 nprobe: int = 16, scales: Optional[np.ndarray] = None, id_order: Optional[np.ndarray] = None):
+        self.centroids = centroids
+        self.vectors = vectors
+        # Per-vector scales of int8 vectors
+        self.scales = scales
+        self.ids = ids
+        # Vectors of list l are rows offsets[l]:offsets[l + 1]
+        self.offsets = offsets
+        self.nprobe = nprobe
+        # Rows by id, to find given ids' vectors without a scan
+        self.id_order = np.argsort(ids, kind="stable") if id_order is None else id_order
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, ids: Optional[np.ndarray] = None, nlist: Optional[int] = None,
+              nprobe: int = 16, train_iterations: int = 10, max_train_vectors: int = 100000,
+              seed: int = 0, dtype: str = "float32") -> "IVFIndex":
+        """
+        Cluster the vectors (k-means on a sample of at most max_train_vectors),
+        group them by list and store them as dtype
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        count, dim = vectors.shape
+        ids = np.arange(count, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        nlist = max(1, min(nlist or default_nlist(count), count))
+
+        if nlist == 1:
+            centroids = np.zeros((1, dim), dtype=np.float32)
+            assignments = np.zeros(count, dtype=np.int32)
+        else:
+            rng = np.random.default_rng(seed)
+            sample = vectors
+            if count > max_train_vectors:
+                sample = vectors[rng.choice(count, max_train_vectors, replace=False)]
+            centroids = _train_centroids(sample, nlist, train_iterations, rng)
+            assignments = _assign(vectors, centroids)
+
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+        stored, scales = quantize(vectors[order], dtype)
+        return cls(centroids, stored, ids[order], offsets, nprobe, scales)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def dtype(self) -> str:
+        return str(self.vectors.dtype)
+
+    def _candidate_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        if self.nlist == 1 or nprobe >= self.nlist:
+            return np.arange(len(self.ids))
+        closeness = self.centroids @ query
+        probed = np.argpartition(-closeness, nprobe - 1)[:nprobe]
+        return np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probed])
+
+    def rows_scanned(self, nprobe: Optional[int] = None) -> int:
+        """About how many vectors a search compares the query with"""
+        if self.nlist == 1:
+            return len(self.ids)
+        return min(len(self.ids), (nprobe or self.nprobe) * len(self.ids) // self.nlist)
+
+    def search(self, query: np.ndarray, k: int, nprobe: Optional[int] = None,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (scores, ids) of the k best matches for one query vector, best first.
+        allowed, a sorted array of ids, restricts the matches to the allowed
+        vectors within the probed lists.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        rows = self._candidate_rows(query, nprobe or self.nprobe)
+        if allowed is not None:
+            rows = rows[sorted_contains(allowed, self.ids[rows])]
+        return self._top_k(query, rows, k)
+
+    def search_ids(self, query: np.ndarray, k: int, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact search among the given ids only; costs O(len(ids))"""
+        query = np.asarray(query, dtype=np.float32)
+        positions = np.searchsorted(self.ids, ids, sorter=self.id_order)
+        return self._top_k(query, self.id_order[positions], k)
+
+    def reconstruct(self, ids: np.ndarray) -> np.ndarray:
+        """The stored vectors of the given ids as float32; quantizing them again gives back the same values"""
+        positions = np.searchsorted(self.ids, ids, sorter=self.id_order)
+        rows = self.id_order[positions]
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def _scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        # Fancy indexing copies just these rows out of the (possibly mapped) array
+        scores = self.vectors[rows].astype(np.float32, copy=False) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+    def _top_k(self, query: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if not len(rows) or k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        scores = self._scores(query, rows)
+        if k < len(scores):
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return scores[best], self.ids[rows[best]]
+
+    def save(self, directory: str) -> None:
+        """Write the index as .npy files in directory, which should be new (see load)"""
+        os.makedirs(directory, exist_ok=True)
+        arrays = {"centroids": self.centroids, "vectors": self.vectors, "ids": self.ids,
+                  "offsets": self.offsets, "id_order": self.id_order}
+        if self.scales is not None:
+            arrays["scales"] = self.scales
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        with open(os.path.join(directory, "ivf.json"), "w") as f:
+            json.dump({"nprobe": self.nprobe, "dtype": self.dtype, "count": len(self.ids)}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "IVFIndex":
+        """Open a saved index; with mmap, the per-vector arrays are mapped rather than read"""
+        mode = "r" if mmap else None
+        with open(os.path.join(directory, "ivf.json")) as f:
+            info = json.load(f)
+
+        def array(name: str, mapped: bool = True) -> np.ndarray:
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode if mapped else None)
+
+        scales = array("scales") if os.path.exists(os.path.join(directory, "scales.npy")) else None
+        # Centroids and list offsets are read on every query, so they're read into memory
+        return cls(array("centroids", mapped=False), array("vectors"), array("ids"), array("offsets", mapped=False),
+                   info["nprobe"], scales, array("id_order"))
@@ -1,9 +1,17 @@
 import os
-import replicate
 from typing import Optional
+from api.game.circuit import CircuitOpenError, circuits
+from api.game.metrics import span, upstream_errors, fallbacks
+
+# Shown when image generation fails
+FALLBACK_IMAGE_URL = "https://placehold.co/600x400?text=Scene+Image+Unavailable"
 
 class SceneVisualizer:
     def __init__(self, api_key: str):
+        # Imported here so the API process can start without loading the SDK
+        import replicate
+        self.replicate = replicate
+        
         # Set the Replicate API token
         os.environ['REPLICATE_API_TOKEN'] = api_key
         
@@ -16,24 +24,25 @@ class SceneVisualizer:
                 prompt += f" Historical details: {historical_context}"
                 
             # Make the request to the Replicate model
-            output = replicate.run(
-                "sundai-club/handala_model_1:bcbb4661012269b7fc3e5effc65b82283452c795c8e3195e45ddd35672f0c4ec",
-                input={
-                    "model": "dev",
-                    "go_fast": False,
-                    "lora_scale": 1,
-                    "megapixels": "1",
-                    "num_outputs": 1,
-                    "aspect_ratio": "1:1",
-                    "output_format": "webp",
-                    "guidance_scale": 3,
-                    "output_quality": 80,
-                    "prompt_strength": 0.8,
-                    "extra_lora_scale": 1,
-                    "num_inference_steps": 28,
-                    "prompt": prompt
-                }
-            )
+            with span("replicate.prediction"), circuits.get("replicate").guard():
+                output = self.replicate.run(
+                    "sundai-club/handala_model_1:bcbb4661012269b7fc3e5effc65b82283452c795c8e3195e45ddd35672f0c4ec",
+                    input={
+                        "model": "dev",
+                        "go_fast": False,
+                        "lora_scale": 1,
+                        "megapixels": "1",
+                        "num_outputs": 1,
+                        "aspect_ratio": "1:1",
+                        "output_format": "webp",
+                        "guidance_scale": 3,
+                        "output_quality": 80,
+                        "prompt_strength": 0.8,
+                        "extra_lora_scale": 1,
+                        "num_inference_steps": 28,
+                        "prompt": prompt
+                    }
+                )
             
             # Return the URL of the generated image
             if isinstance(output, list) and len(output) > 0:
@@ -42,13 +51,20 @@ class SceneVisualizer:
                 return output
             else:
                 print(f"Unexpected output format from Replicate: {type(output)}")
+                fallbacks.inc(component="image")
                 return self._get_fallback_image()
                 
+        except CircuitOpenError:
+            # Replicate is failing; don't wait for it
+            fallbacks.inc(component="image")
+            return self._get_fallback_image()
         except Exception as e:
             print(f"Error generating scene image: {e}")
+            upstream_errors.inc(vendor="replicate", operation="prediction")
+            fallbacks.inc(component="image")
             return self._get_fallback_image()
             
     def _get_fallback_image(self) -> str:
         """Return a fallback image URL if image generation fails"""
         # In a production system, you would have a set of fallback images
-        return "https://placehold.co/600x400?text=Scene+Image+Unavailable"
+        return FALLBACK_IMAGE_URL
@@ -1,13 +1,24 @@
-import requests
 import base64
 import os
 import json
 from typing import Optional
+from api.game.circuit import CircuitOpenError, circuits
+from api.game.metrics import span, upstream_errors, fallbacks
+
+# Played when speech generation fails
+FALLBACK_AUDIO_URL = "/static/audio/fallback.mp3"
 
 class SesameVoice:
     def __init__(self, api_key: str):
+        # Imported here so the API process can start without loading requests
+        import requests
+        # A session keeps connections to Sesame alive between calls
+        self.http = requests.Session()
+        
         self.api_key = api_key
         self.api_url = "https://api.sesame.ai/v1/speech"
+        # Seconds to wait for Sesame before falling back
+        self.timeout = float(os.getenv("SESAME_TIMEOUT_SEC", "30"))
         # Create directory for audio files
         os.makedirs("static/audio", exist_ok=True)
         
@@ -27,18 +38,22 @@ class SesameVoice:
             mapped_emotion = emotion_mapping.get(emotion, "neutral")
             
             # Make API request to Sesame
-            response = requests.post(
-                self.api_url,
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "text": text,
-                    "voice_id": voice_id,
-                    "emotion": mapped_emotion
-                }
-            )
+            with span("sesame.speech"), circuits.get("sesame").guard() as call:
+                response = self.http.post(
+                    self.api_url,
+                    headers={
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json"
+                    },
+                    json={
+                        "text": text,
+                        "voice_id": voice_id,
+                        "emotion": mapped_emotion
+                    },
+                    timeout=self.timeout
+                )
+                if response.status_code != 200:
+                    call.fail()
             
             # Check for successful response
             if response.status_code == 200:
@@ -53,13 +68,21 @@ class SesameVoice:
                 return f"/static/audio/{file_name}"
             else:
                 print(f"Error from Sesame API: {response.status_code} - {response.text}")
+                upstream_errors.inc(vendor="sesame", operation="speech")
+                fallbacks.inc(component="audio")
                 return self._get_fallback_audio()
                 
+        except CircuitOpenError:
+            # Sesame is failing; don't wait for it
+            fallbacks.inc(component="audio")
+            return self._get_fallback_audio()
         except Exception as e:
             print(f"Error generating speech: {e}")
+            upstream_errors.inc(vendor="sesame", operation="speech")
+            fallbacks.inc(component="audio")
             return self._get_fallback_audio()
             
     def _get_fallback_audio(self) -> str:
         """Return a fallback audio URL if speech generation fails"""
         # In a production system, you would have a set of fallback audio files
-        return "/static/audio/fallback.mp3"
+        return FALLBACK_AUDIO_URL
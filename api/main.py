@@ -1,16 +1,35 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+import asyncio
+import copy
+import json
 import os
+import secrets
+import time
 from dotenv import load_dotenv
 import uvicorn
 
-# Import our game components
-from api.game.orchestrator import GameOrchestrator
-from api.game.rag import RAGRetriever
-from api.game.agent import MaestroCharacterAgent
-from api.game.visualizer import SceneVisualizer
-from api.game.voice import SesameVoice
+# Import our game components. The heavy ones (vendor SDKs, clients, indexes)
+# are only constructed on first use, see build_* below.
+from api.game.orchestrator import DEFAULT_CHOICES, new_player_state, new_agent_state
+from api.game.agent import FALLBACK_RESPONSES, describe_trust
+from api.game.visualizer import FALLBACK_IMAGE_URL
+from api.game.voice import FALLBACK_AUDIO_URL
+from api.game.components import Components
+from api.game.executor import VendorExecutor
+from api.game.maestro import MaestroRunManager
+from api.game.circuit import STATE_CODES, circuits
+from api.game.ai21_client import ai21_clients
+from api.game.pipeline import Pipeline
+from api.game.session import SessionStore, SessionConflictError, create_backend
+from api.game.jobs import JobStore, MediaJobQueue
+from api.game.coalesce import SingleFlight, coalesce_key, normalize_text
+from api.game.prefetch import Prefetcher
+from api.game.metrics import metrics, span, start_trace, end_trace, fallbacks
 
 load_dotenv()
 
@@ -23,31 +42,54 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "Server-Timing"],
 )
 
-# Initialize components
-orchestrator = None
-rag = None
-agent = None
-visualizer = None
-voice = None
+request_duration = metrics.histogram("rpg_http_request_duration_seconds", "End-to-end HTTP request latency")
 
-@app.on_event("startup")
-async def startup_event():
-    global orchestrator, rag, agent, visualizer, voice
-    
-    print("Starting RPG Maestro API with Maestro character agent")
-    
-    # Initialize components
-    orchestrator = GameOrchestrator(api_key=os.getenv("AI21_API_KEY"))
-    
-    rag = RAGRetriever(
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Give every request a trace ID (taken from X-Trace-Id when the caller sends
+    one) and return it, along with a Server-Timing breakdown of the spans
+    recorded while handling the request.
+    """
+    trace, token = start_trace(request.headers.get("x-trace-id"))
+    started_at = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Trace-Id"] = trace.trace_id
+        timing = trace.server_timing()
+        if timing:
+            response.headers["Server-Timing"] = timing
+        return response
+    finally:
+        route = request.scope.get("route")
+        request_duration.observe(
+            time.perf_counter() - started_at,
+            method=request.method,
+            route=route.path if route else "unmatched",
+            status=status_code
+        )
+        end_trace(token)
+
+def build_orchestrator():
+    from api.game.orchestrator import GameOrchestrator
+    return GameOrchestrator(api_key=os.getenv("AI21_API_KEY"))
+
+def build_rag():
+    from api.game.rag import RAGRetriever
+    return RAGRetriever(
         index_path="data/faiss_index",
         documents_path="data/historical_documents.json"
     )
-    
+
+def build_agent():
+    from api.game.agent import MaestroCharacterAgent
     # Use Maestro Character Agent for more reliable responses
-    agent = MaestroCharacterAgent(
+    return MaestroCharacterAgent(
         character_profile={
             "name": "Ser Elyen",
             "alignment": "Neutral Good",
@@ -55,127 +97,682 @@ async def startup_event():
         },
         api_key=os.getenv("AI21_API_KEY")
     )
-    
+
+def build_visualizer():
+    from api.game.visualizer import SceneVisualizer
     # Initialize image generation with Replicate
-    visualizer = SceneVisualizer(api_key=os.getenv("REPLICATE_API_TOKEN"))
-    
+    return SceneVisualizer(api_key=os.getenv("REPLICATE_API_TOKEN"))
+
+def build_voice():
+    from api.game.voice import SesameVoice
     # Initialize voice synthesis
-    voice = SesameVoice(api_key=os.getenv("SESAME_API_KEY"))
+    return SesameVoice(api_key=os.getenv("SESAME_API_KEY"))
+
+# Initialize components
+components = Components({
+    "orchestrator": build_orchestrator,
+    "rag": build_rag,
+    "agent": build_agent,
+    "visualizer": build_visualizer,
+    "voice": build_voice,
+})
+executor = None
+maestro_runs = None
+sessions = None
+media_jobs = None
+warm_up_task = None
+rag_reload_task = None
+rag_merge_task = None
+# Shares one upstream call between concurrent identical requests
+flights = SingleFlight()
+# Speculative warm-up of the scenes a player can go to next
+prefetcher = None
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_IMAGES = os.getenv("PREFETCH_IMAGES", "true").lower() == "true"
+# Opt-in: generate the companion's reply to every choice while the player decides
+reply_speculator = None
+SPECULATE_REPLIES = os.getenv("REPLY_SPECULATION_ENABLED", "false").lower() == "true"
+SPECULATE_REPLY_AUDIO = os.getenv("REPLY_SPECULATION_AUDIO", "false").lower() == "true"
+# How often a worker checks for lore changed by another worker or the ingest CLI
+RAG_RELOAD_INTERVAL = float(os.getenv("RAG_RELOAD_INTERVAL_SEC", "5"))
+# Bearer token for the lore editing endpoints, which are disabled without one
+LORE_ADMIN_TOKEN = os.getenv("LORE_ADMIN_TOKEN")
 
-# Game state
-game_state = {}
+@app.on_event("startup")
+async def startup_event():
+    """
+    Only cheap setup happens here so the server starts accepting traffic
+    immediately; the game components are built in the background (and on
+    demand if a request needs one first). /readyz reports when they're done.
+    """
+    global executor, maestro_runs, sessions, media_jobs, warm_up_task, rag_reload_task, prefetcher, reply_speculator
+    
+    print("Starting RPG Maestro API with Maestro character agent")
+    
+    # Bounded per-vendor thread pools for the blocking SDK calls
+    executor = VendorExecutor()
+    
+    # Polls every outstanding Maestro run from one loop instead of a thread per run
+    maestro_runs = MaestroRunManager(
+        executor,
+        min_interval=float(os.getenv("MAESTRO_POLL_MIN_SEC", "0.05")),
+        max_interval=float(os.getenv("MAESTRO_POLL_MAX_SEC", "2.0")),
+        timeout=float(os.getenv("MAESTRO_RUN_TIMEOUT_SEC", "120")),
+        poll_timeout=float(os.getenv("MAESTRO_POLL_TIMEOUT_SEC", "10"))
+    )
+    
+    # Per-player game state (SESSION_BACKEND=memory|sqlite)
+    sessions = SessionStore(
+        create_backend(),
+        new_player_state=new_player_state,
+        new_agent_state=new_agent_state,
+        new_agent_memory=lambda: components.agent.new_memory()
+    )
+    
+    # Background image and speech generation, persisted across restarts
+    media_jobs = MediaJobQueue(JobStore(os.getenv("MEDIA_JOB_DB_PATH", "data/jobs.db")), executor)
+    media_jobs.register("image", "replicate",
+                        lambda **params: components.visualizer.generate_scene_image(**params),
+                        fallback=FALLBACK_IMAGE_URL)
+    media_jobs.register("audio", "sesame",
+                        lambda **params: components.voice.text_to_speech(**params),
+                        fallback=FALLBACK_AUDIO_URL)
+    resumed = await media_jobs.resume()
+    if resumed:
+        print(f"Resumed {resumed} unfinished media jobs")
+    media_jobs.watch()
+    
+    prefetcher = Prefetcher.from_env()
+    reply_speculator = Prefetcher.from_env(
+        name="reply", prefix="REPLY_SPECULATION", session_budget=8, refill_per_min=8, max_concurrency=4
+    )
+    
+    register_gauges()
+    
+    warm_up_task = asyncio.ensure_future(executor.run("default", warm_up))
+    rag_reload_task = asyncio.ensure_future(reload_rag())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop the background tasks, and wait for them so none is left pending or touches a closed executor
+    tasks = [task for task in (warm_up_task, rag_reload_task, rag_merge_task) if task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if prefetcher:
+        prefetcher.shutdown()
+    if reply_speculator:
+        reply_speculator.shutdown()
+    if maestro_runs:
+        maestro_runs.shutdown()
+    if media_jobs:
+        media_jobs.shutdown()
+    if executor:
+        executor.shutdown()
+    ai21_clients.close()
 
 class ActionRequest(BaseModel):
     scene_id: str
     choice_index: int
+    session_id: Optional[str] = None
+    # Return an audio job ID instead of waiting for text-to-speech
+    async_media: bool = False
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to RPG Maestro API"}
 
+@app.get("/healthz")
+async def liveness():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readiness():
+    """Readiness: every game component has been initialized"""
+    status = {
+        "status": "ready" if components.ready else "starting",
+        "components": components.status()
+    }
+    if not components.ready:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
 @app.get("/api/objectives")
 async def get_objectives():
     """Return the game objectives to display to the player before starting the game"""
-    if not orchestrator:
-        raise HTTPException(status_code=500, detail="Game system not initialized")
-        
     return {
-        "objectives": orchestrator.scoring_agent.get_game_objectives(),
+        "objectives": components.orchestrator.scoring_agent.get_game_objectives(),
         "description": "Welcome to the medieval fantasy RPG! Your choices will shape your character's alignment, skills, and the story's outcome. Make decisions wisely as they will affect your relationships with NPCs and your ability to navigate the challenges ahead."
     }
 
-@app.get("/api/scene/{scene_id}")
-async def get_scene(scene_id: str):
-    # Get scene data
-    scene = orchestrator.get_scene(scene_id)
+def register_gauges():
+    def pool_gauge(field):
+        return lambda: {(("pool", name),): pool[field] for name, pool in executor.stats().items()}
     
-    # Get historical context from RAG
-    historical_context = rag.retrieve(
-        query=scene["rag_context_query"],
-        filters={"region": scene.get("region", None)}
+    metrics.gauge("rpg_executor_queued", "Calls waiting for a worker thread", pool_gauge("queued"))
+    metrics.gauge("rpg_executor_active", "Calls running on a worker thread", pool_gauge("active"))
+    metrics.gauge("rpg_executor_workers", "Worker threads per pool", pool_gauge("max_workers"))
+    metrics.gauge("rpg_circuit_state", "Circuit breaker state per vendor (0 closed, 1 half-open, 2 open)",
+                  lambda: {(("vendor", vendor),): STATE_CODES[state] for vendor, state in circuits.states().items()})
+    metrics.gauge("rpg_ai21_connections", "Open connections in the shared AI21 client pool",
+                  lambda: {(("state", state),): count for state, count in ai21_clients.connections().items()})
+    metrics.gauge("rpg_maestro_runs_outstanding", "Maestro runs being polled",
+                  lambda: {(): maestro_runs.outstanding()})
+    metrics.gauge("rpg_inflight_coalesced", "Distinct upstream calls currently in flight",
+                  lambda: {(): flights.inflight()})
+    metrics.gauge("rpg_media_jobs_pending", "Background media jobs queued or running in this worker",
+                  lambda: {(): media_jobs.pending()})
+    metrics.gauge("rpg_prefetch_inflight", "Speculative work in progress",
+                  lambda: {(("kind", "scene"),): prefetcher.inflight(),
+                           (("kind", "reply"),): reply_speculator.inflight()})
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: per-stage latency histograms, cache, fallback and error counters"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/executors")
+async def get_executor_stats():
+    """Return queue depth and throughput counters for each vendor thread pool,
+    circuit breaker states, and how many requests were served by an
+    identical in-flight call or a prefetch"""
+    if not executor:
+        raise HTTPException(status_code=500, detail="Game system not initialized")
+        
+    return {
+        **executor.stats(),
+        "maestro_runs": maestro_runs.stats(),
+        "circuits": circuits.stats(),
+        "ai21_pool": ai21_clients.stats(),
+        "rag": components.rag.stats() if components.is_built("rag") else None,
+        "coalescing": flights.stats(),
+        "prefetch": prefetcher.stats(),
+        "reply_speculation": reply_speculator.stats()
+    }
+
+def format_historical_context(historical_context):
+    """Format historical context for frontend display"""
+    return [
+        {"title": doc["title"], "content": doc["text"]}
+        for doc in historical_context
+    ] if historical_context else []
+
+def public_player_state(player_state):
+    return {
+        "alignment": player_state["alignment"],
+        "experience": player_state["experience"],
+        "score": player_state["score"],
+        "skills": player_state["skills"]
+    }
+
+def scene_context_request(scene):
+    """The RAG query and filters for a scene's historical context"""
+    return scene["rag_context_query"], {"region": scene.get("region", None)}
+
+async def retrieve_historical_context(scene, speculative: bool = False):
+    """Get historical context from RAG for a scene"""
+    query, filters = scene_context_request(scene)
+    if components.is_built("rag"):
+        # Materialized for every scene at startup, or cached by an earlier request
+        cached = components.rag.lookup(query, filters=filters)
+        if cached is not None:
+            return cached
+    # Keyed by the index version too, so edited lore isn't served from an old prefetch
+    version = components.rag.version if components.is_built("rag") else None
+    key = coalesce_key("rag.retrieve", query=normalize_text(query), filters=filters, version=version)
+    return await prefetcher.fetch(key, lambda: flights.do(key, lambda: executor.run(
+        "rag", components.rag.retrieve, query=query, filters=filters
+    )), speculative)
+
+def materialize_scene_context():
+    """Retrieve the historical context of every scene in the campaign in one batch"""
+    scenes = components.orchestrator.scene_graph.scenes.values()
+    count = components.rag.materialize([scene_context_request(scene) for scene in scenes])
+    print(f"Materialized historical context for {count} scene queries")
+
+def warm_up():
+    """Build every component, then materialize the scenes' historical context"""
+    errors = components.warm_up()
+    if errors.get("orchestrator") is None and errors.get("rag") is None:
+        try:
+            materialize_scene_context()
+        except Exception as e:
+            print(f"Error materializing scene context: {e}")
+    return errors
+
+async def reload_rag():
+    """Switch to the latest lore whenever another worker or the ingest CLI changes the index"""
+    while True:
+        await asyncio.sleep(RAG_RELOAD_INTERVAL)
+        if not components.is_built("rag"):
+            continue
+        try:
+            await executor.run("rag", components.rag.refresh)
+        except Exception as e:
+            print(f"Error reloading the retrieval index: {e}")
+
+async def merge_rag():
+    try:
+        await executor.run("default", components.rag.merge)
+    except Exception as e:
+        print(f"Error merging retrieval index segments: {e}")
+
+def schedule_rag_merge():
+    """Merge the segments left by lore edits in the background, one merge at a time"""
+    global rag_merge_task
+    if rag_merge_task is None or rag_merge_task.done():
+        rag_merge_task = asyncio.ensure_future(merge_rag())
+
+async def generate_choices(scene, historical_context, speculative: bool = False):
+    """Generate choices for a scene using Maestro"""
+    key = coalesce_key(
+        "generate_scene_choices",
+        scene_id=scene["scene_id"],
+        scene_context=normalize_text(scene["description"]),
+        historical_context=[doc["text"] for doc in historical_context]
     )
-    
-    # Generate choices using Maestro
-    choices = orchestrator.generate_scene_choices(
+    return await prefetcher.fetch(key, lambda: flights.do(key, lambda: components.orchestrator.generate_scene_choices_async(
         scene_context=scene["description"],
-        historical_context=historical_context
+        historical_context=historical_context,
+        runs=maestro_runs,
+        scene_id=scene["scene_id"]
+    )), speculative, fallback=lambda choices: choices == DEFAULT_CHOICES)
+
+def image_params(scene, historical_context):
+    return {
+        "scene_description": scene["description"],
+        "historical_context": historical_context[0]["text"] if historical_context else ""
+    }
+
+async def generate_image(scene, historical_context, speculative: bool = False):
+    """Generate the scene image with Replicate"""
+    if circuits.rejecting("replicate"):
+        # Don't queue behind calls to a vendor that is down
+        fallbacks.inc(component="image")
+        return FALLBACK_IMAGE_URL
+    params = image_params(scene, historical_context)
+    key = coalesce_key(
+        "generate_scene_image",
+        scene_description=normalize_text(params["scene_description"]),
+        historical_context=normalize_text(params["historical_context"])
     )
+    return await prefetcher.fetch(key, lambda: flights.do(key, lambda: executor.run(
+        "replicate", components.visualizer.generate_scene_image, **params
+    )), speculative, fallback=lambda url: url == FALLBACK_IMAGE_URL)
+
+def has_spare_capacity(vendor: str) -> bool:
+    """No calls waiting for the vendor's pool and its circuit is closed"""
+    return not executor.pool(vendor).queued and not circuits.rejecting(vendor)
+
+async def warm_scene(scene):
+    """
+    Speculatively fetch what /api/scene will need for a scene. Backs off
+    from any vendor whose pool already has calls waiting, so prefetching
+    never delays a real request, and from any vendor whose circuit is
+    open, since all it would get is fallbacks.
+    """
+    if executor.pool("rag").queued:
+        return
+    historical_context = await retrieve_historical_context(scene, speculative=True)
     
-    # Generate scene image
-    image_url = visualizer.generate_scene_image(
-        scene_description=scene["description"],
-        historical_context=historical_context[0]["text"] if historical_context else ""
+    work = []
+    if has_spare_capacity("maestro"):
+        work.append(generate_choices(scene, historical_context, speculative=True))
+    if PREFETCH_IMAGES and has_spare_capacity("replicate"):
+        work.append(generate_image(scene, historical_context, speculative=True))
+    await asyncio.gather(*work)
+
+def prefetch_next_scenes(session_id: str, scene_id: str):
+    """Warm up the scenes reachable from scene_id in the background while the player reads"""
+    if not PREFETCH_ENABLED:
+        return
+    scene_graph = components.orchestrator.scene_graph
+    for next_scene_id in scene_graph.successors(scene_id):
+        next_scene = scene_graph.scene(next_scene_id)
+        prefetcher.schedule(session_id, next_scene_id, lambda scene=next_scene: warm_scene(scene))
+
+def reply_key(scene, choice, historical_context, memory):
+    """Everything the companion's reply depends on: the scene, the choice and the companion's memory"""
+    return coalesce_key(
+        "generate_response",
+        scene_id=scene["scene_id"],
+        scene_context=normalize_text(scene["description"]),
+        player_action=choice,
+        historical_context=[doc["text"] for doc in historical_context],
+        recent_actions=memory["recent_actions"],
+        mood=describe_trust(memory["trust_in_player"])
     )
+
+async def generate_reply(scene, choice, historical_context, memory, speculative: bool = False):
+    """The companion's reply to a choice, from a speculative run if one was made"""
+    call = lambda: components.agent.generate_response_async(
+        scene_context=scene["description"],
+        player_action=choice,
+        historical_context=historical_context,
+        runs=maestro_runs,
+        memory=memory
+    )
+    if not SPECULATE_REPLIES:
+        return await call()
+    return await reply_speculator.fetch(reply_key(scene, choice, historical_context, memory), call, speculative,
+                                        fallback=lambda text: text in FALLBACK_RESPONSES)
+
+async def generate_audio(text, emotion, speculative: bool = False):
+    """Speech for the companion's reply, from a speculative run if one was made"""
+    if circuits.rejecting("sesame"):
+        fallbacks.inc(component="audio")
+        return FALLBACK_AUDIO_URL
+    call = lambda: executor.run("sesame", components.voice.text_to_speech, text=text, emotion=emotion)
+    if not SPECULATE_REPLIES:
+        return await call()
+    return await reply_speculator.fetch(coalesce_key("text_to_speech", text=text, emotion=emotion), call, speculative,
+                                        fallback=lambda url: url == FALLBACK_AUDIO_URL)
+
+async def speculate_reply(scene, choice, historical_context, memory):
+    if not has_spare_capacity("maestro"):
+        return
+    text = await generate_reply(scene, choice, historical_context, memory, speculative=True)
+    if SPECULATE_REPLY_AUDIO and has_spare_capacity("sesame"):
+        await generate_audio(text, memory["mood"], speculative=True)
+
+def speculate_replies(session, scene, choices, historical_context):
+    """
+    Generate the companion's reply (and optionally its speech) to each of
+    the scene's choices in the background while the player decides. Runs
+    are keyed by the session's companion memory, so a reply is only reused
+    if nothing it depends on has changed; the ones for choices not taken
+    are cancelled when the action arrives.
+    """
+    if not SPECULATE_REPLIES:
+        return
+    for choice in choices:
+        # Each run gets its own copy: generate_response updates the memory's mood
+        memory = copy.deepcopy(session.agent_memory)
+        key = reply_key(scene, choice, historical_context, memory)
+        reply_speculator.schedule(session.session_id, key, lambda choice=choice, memory=memory: speculate_reply(
+            scene, choice, historical_context, memory
+        ))
+
+async def resolve_reply(scene, choice, historical_context, session):
+    """Reply for the action the player took; speculative runs for the other choices are dropped"""
+    if SPECULATE_REPLIES:
+        key = reply_key(scene, choice, historical_context, session.agent_memory)
+        reply_speculator.cancel(session.session_id, keep=[key])
+        # generate_response sets the mood itself; a speculative hit skips it
+        components.agent.apply_mood(session.agent_memory)
+    return await generate_reply(scene, choice, historical_context, session.agent_memory)
+
+def build_scene_pipeline(scene, async_media: bool = False) -> Pipeline:
+    """
+    Stages for assembling a scene. Choices and the image both only need the
+    retrieved historical context, so they run in parallel once it is ready.
+    With async_media the image is queued as a background job instead.
+    """
+    pipeline = Pipeline()
     
-    # Format historical context for frontend display
-    formatted_historical_context = [
-        {"title": doc["title"], "content": doc["text"]}
-        for doc in historical_context
-    ] if historical_context else []
+    pipeline.add_stage("historical_context", lambda results: retrieve_historical_context(scene))
     
-    return {
-        "scene": scene,
-        "choices": choices,
-        "image_url": image_url,
-        "historical_context": formatted_historical_context,
-        "player_state": {
-            "alignment": orchestrator.player_state["alignment"],
-            "experience": orchestrator.player_state["experience"],
-            "score": orchestrator.player_state["score"],
-            "skills": orchestrator.player_state["skills"]
-        }
-    }
+    pipeline.add_stage("choices", lambda results: generate_choices(
+        scene, results["historical_context"]
+    ), depends_on=["historical_context"])
+    
+    if async_media:
+        pipeline.add_stage("image_job_id", lambda results: media_jobs.submit(
+            "image", **image_params(scene, results["historical_context"])
+        ), depends_on=["historical_context"])
+    else:
+        pipeline.add_stage("image_url", lambda results: generate_image(
+            scene, results["historical_context"]
+        ), depends_on=["historical_context"])
+    
+    return pipeline
 
-@app.post("/api/action")
-async def process_action(request: ActionRequest):
-    # Get scene and player choice
-    scene = orchestrator.get_scene(request.scene_id)
-    choice = scene["actions"][request.choice_index]
+def build_action_pipeline(scene, scene_id: str, choice_index: int, session, async_media: bool = False) -> Pipeline:
+    """
+    Stages for resolving a player action. Scoring runs alongside retrieval and
+    the agent reply, and text-to-speech starts as soon as the reply exists
+    (or is queued as a background job with async_media).
+    """
+    choice = scene["actions"][choice_index]
+    pipeline = Pipeline()
     
-    # Get historical context from RAG
-    historical_context = rag.retrieve(
-        query=scene["rag_context_query"],
-        filters={"region": scene.get("region", None)}
-    )
+    pipeline.add_stage("historical_context", lambda results: retrieve_historical_context(scene))
     
     # Update player state based on choice and get scoring information
-    scoring_result = orchestrator.update_player_state(request.scene_id, request.choice_index)
+    pipeline.add_stage("scoring", lambda results: executor.run(
+        "default", components.orchestrator.update_player_state, scene_id, choice_index,
+        player_state=session.player_state,
+        agent_state=session.agent_state,
+        events=session.events
+    ))
     
     # Generate agent response
-    agent_response = agent.generate_response(
-        scene_context=scene["description"],
-        player_action=choice,
-        historical_context=historical_context
-    )
+    pipeline.add_stage("agent_response", lambda results: resolve_reply(
+        scene, choice, results["historical_context"], session
+    ), depends_on=["historical_context"])
     
     # Generate voice for agent response
-    audio_url = voice.text_to_speech(
-        text=agent_response,
-        emotion=agent.memory["mood"]
-    )
-    
-    # Get next scene ID
-    next_scene_id = scene["next_scene_map"][list("ABCD")[request.choice_index]]
-    
-    # Format historical context for frontend display
-    formatted_historical_context = [
-        {"title": doc["title"], "content": doc["text"]}
-        for doc in historical_context
-    ] if historical_context else []
+    if async_media:
+        pipeline.add_stage("audio_job_id", lambda results: media_jobs.submit(
+            "audio",
+            text=results["agent_response"],
+            emotion=session.agent_memory["mood"]
+        ), depends_on=["agent_response"])
+    else:
+        pipeline.add_stage("audio_url", lambda results: generate_audio(
+            results["agent_response"], session.agent_memory["mood"]
+        ), depends_on=["agent_response"])
     
-    return {
-        "agent_response": agent_response,
-        "audio_url": audio_url,
+    return pipeline
+
+def render_json(payload) -> JSONResponse:
+    """Serialize a response payload inside a timed span"""
+    with span("serialize"):
+        return JSONResponse(content=jsonable_encoder(payload))
+
+def scene_payload(session, scene, results):
+    payload = {
+        "session_id": session.session_id,
+        "scene": scene,
+        "choices": results["choices"],
+        "image_url": results.get("image_url"),
+        "historical_context": format_historical_context(results["historical_context"]),
+        "player_state": public_player_state(session.player_state)
+    }
+    if "image_job_id" in results:
+        payload["image_job_id"] = results["image_job_id"]
+    return payload
+
+def action_payload(session, next_scene_id, results):
+    payload = {
+        "session_id": session.session_id,
+        "agent_response": results["agent_response"],
+        "audio_url": results.get("audio_url"),
         "next_scene_id": next_scene_id,
-        "scoring": scoring_result,
-        "historical_context": formatted_historical_context,
-        "player_state": {
-            "alignment": orchestrator.player_state["alignment"],
-            "experience": orchestrator.player_state["experience"],
-            "score": orchestrator.player_state["score"],
-            "skills": orchestrator.player_state["skills"]
-        }
+        "scoring": results["scoring"],
+        "historical_context": format_historical_context(results["historical_context"]),
+        "player_state": public_player_state(session.player_state)
     }
+    if "audio_job_id" in results:
+        payload["audio_job_id"] = results["audio_job_id"]
+    return payload
+
+def stage_payload(name, value, session):
+    """The partial response sent when a pipeline stage finishes"""
+    if name == "historical_context":
+        return {name: format_historical_context(value)}
+    if name == "scoring":
+        return {name: value, "player_state": public_player_state(session.player_state)}
+    return {name: value}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Stop proxies (nginx, Render) from buffering the stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def find_scene(scene_id: str):
+    """The campaign's scene, or a 404 if it has none with this ID"""
+    try:
+        return components.orchestrator.get_scene(scene_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def find_next_scene_id(scene_id: str, choice_index: int) -> str:
+    """The scene a choice leads to, or a 400 if the scene has no such choice"""
+    try:
+        return components.orchestrator.next_scene_id(scene_id, choice_index)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/scene/{scene_id}")
+async def get_scene(scene_id: str, session_id: Optional[str] = None, async_media: bool = False):
+    # Get scene data
+    scene = find_scene(scene_id)
+    
+    try:
+        async with sessions.session(session_id) as session:
+            session.current_scene = scene_id
+            results = await build_scene_pipeline(scene, async_media).run()
+            speculate_replies(session, scene, results["choices"], results["historical_context"])
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    prefetch_next_scenes(session.session_id, scene_id)
+    return render_json(scene_payload(session, scene, results))
+
+@app.get("/api/scene/{scene_id}/stream")
+async def stream_scene(scene_id: str, session_id: Optional[str] = None, async_media: bool = False):
+    """
+    Server-Sent Events variant of /api/scene. Sends a "scene" event with the
+    scene text and player state immediately, then "historical_context",
+    "choices" and "image_url" as each becomes ready, and finally "done" with
+    the same payload /api/scene returns.
+    """
+    scene = find_scene(scene_id)
+    
+    async def events():
+        try:
+            async with sessions.session(session_id) as session:
+                session.current_scene = scene_id
+                yield sse_event("scene", {
+                    "session_id": session.session_id,
+                    "scene": scene,
+                    "player_state": public_player_state(session.player_state)
+                })
+                
+                results = {}
+                async for name, value in build_scene_pipeline(scene, async_media).stream():
+                    results[name] = value
+                    yield sse_event(name, stage_payload(name, value, session))
+                speculate_replies(session, scene, results["choices"], results["historical_context"])
+            prefetch_next_scenes(session.session_id, scene_id)
+            yield sse_event("done", scene_payload(session, scene, results))
+        except SessionConflictError as e:
+            yield sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/api/action")
+async def process_action(request: ActionRequest):
+    # Get scene and player choice
+    scene = find_scene(request.scene_id)
+    next_scene_id = find_next_scene_id(request.scene_id, request.choice_index)
+    
+    try:
+        async with sessions.session(request.session_id) as session:
+            # Branches the player didn't take are no longer worth prefetching
+            prefetcher.cancel(session.session_id, keep=[next_scene_id])
+            results = await build_action_pipeline(
+                scene, request.scene_id, request.choice_index, session, request.async_media
+            ).run()
+            session.current_scene = next_scene_id
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return render_json(action_payload(session, next_scene_id, results))
+
+@app.post("/api/action/stream")
+async def stream_action(request: ActionRequest):
+    """
+    Server-Sent Events variant of /api/action. Sends an "action" event with the
+    next scene ID immediately, then "scoring" (with the updated player state),
+    "historical_context", "agent_response" and "audio_url" as each becomes
+    ready, and finally "done" with the same payload /api/action returns.
+    """
+    scene = find_scene(request.scene_id)
+    next_scene_id = find_next_scene_id(request.scene_id, request.choice_index)
+    
+    async def events():
+        try:
+            async with sessions.session(request.session_id) as session:
+                prefetcher.cancel(session.session_id, keep=[next_scene_id])
+                yield sse_event("action", {
+                    "session_id": session.session_id,
+                    "next_scene_id": next_scene_id
+                })
+                
+                results = {}
+                pipeline = build_action_pipeline(
+                    scene, request.scene_id, request.choice_index, session, request.async_media
+                )
+                async for name, value in pipeline.stream():
+                    results[name] = value
+                    yield sse_event(name, stage_payload(name, value, session))
+                session.current_scene = next_scene_id
+            yield sse_event("done", action_payload(session, next_scene_id, results))
+        except SessionConflictError as e:
+            yield sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/api/session/{session_id}/events")
+async def get_session_events(session_id: str):
+    """A session's event log: every turn with its impact, score and feedback, and each scene visited"""
+    if not sessions:
+        raise HTTPException(status_code=500, detail="Game system not initialized")
+    events = await executor.run("default", sessions.history, session_id)
+    if not events:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return {"session_id": session_id, "events": events}
+
+class LoreDocuments(BaseModel):
+    # {"id", "title", "text", "metadata"}, like data/historical_documents.json
+    documents: List[Dict[str, Any]]
+
+def require_lore_admin(authorization: Optional[str] = Header(None)):
+    if not LORE_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Lore editing is disabled; set LORE_ADMIN_TOKEN")
+    if not secrets.compare_digest(authorization or "", f"Bearer {LORE_ADMIN_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid lore admin token")
+
+@app.post("/api/lore", dependencies=[Depends(require_lore_admin)])
+async def upsert_lore(request: LoreDocuments):
+    """Add lore documents, or replace those with the same id; searches use them as soon as this returns"""
+    try:
+        result = await executor.run("default", components.rag.upsert, request.documents)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    schedule_rag_merge()
+    return result
+
+@app.delete("/api/lore/{doc_id}", dependencies=[Depends(require_lore_admin)])
+async def delete_lore(doc_id: str):
+    """Delete a lore document"""
+    deleted = await executor.run("default", components.rag.delete, [doc_id])
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"Lore document {doc_id} not found")
+    schedule_rag_merge()
+    return {"deleted": deleted, "version": components.rag.version}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a background media job; "result" holds the URL once completed"""
+    job = await media_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
 if __name__ == "__main__":
     uvicorn.run("api.main:app", host="0.0.0.0", port=8000, reload=True)
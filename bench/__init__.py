@@ -0,0 +1 @@
+# Offline benchmarking tools: fake vendor backends and a load generator
@@ -0,0 +1,225 @@
+"""
+In-process stand-ins for the AI21 Maestro, Replicate and Sesame APIs.
+
+Each fake sleeps for a latency drawn from a configurable distribution and
+fails at a configurable rate, so the real game code (including its fallback
+paths) can be load tested without network access or API keys.
+"""
+import base64
+import itertools
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+
+class LatencyProfile:
+    """Log-normal latency with a given median and p95, plus an error rate"""
+
+    def __init__(self, median_ms: float, p95_ms: Optional[float] = None, error_rate: float = 0.0):
+        self.median_ms = median_ms
+        self.p95_ms = p95_ms if p95_ms is not None else median_ms
+        self.error_rate = error_rate
+        # p95 of a log-normal is median * exp(1.645 * sigma)
+        self.sigma = math.log(self.p95_ms / self.median_ms) / 1.645 if self.p95_ms > self.median_ms else 0.0
+
+    def sample_seconds(self, rng: random.Random) -> float:
+        if self.sigma == 0.0:
+            return self.median_ms / 1000
+        return rng.lognormvariate(math.log(self.median_ms), self.sigma) / 1000
+
+    def fails(self, rng: random.Random) -> bool:
+        return self.error_rate > 0 and rng.random() < self.error_rate
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyProfile":
+        """Parse "median_ms[,p95_ms[,error_rate]]", e.g. "1200,4000,0.02" """
+        parts = [float(part) for part in spec.split(",")]
+        return cls(*parts)
+
+
+# Rough production-like defaults: Maestro runs take seconds, images a bit longer
+DEFAULT_PROFILES = {
+    "maestro": LatencyProfile(median_ms=2500, p95_ms=6000),
+    "replicate": LatencyProfile(median_ms=4000, p95_ms=9000),
+    "sesame": LatencyProfile(median_ms=600, p95_ms=1500),
+}
+
+
+class VendorStats:
+    """Thread-safe record of every fake upstream call, for per-stage breakdowns"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.calls: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, operation: str, seconds: float, failed: bool) -> None:
+        with self._lock:
+            self.calls.setdefault(operation, []).append(seconds)
+            if failed:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def snapshot(self) -> Dict[str, Dict[str, List[float]]]:
+        with self._lock:
+            return {op: {"latencies": list(values), "errors": self.errors.get(op, 0)} for op, values in self.calls.items()}
+
+
+class FakeVendorError(Exception):
+    pass
+
+
+class _FakeVendor:
+    def __init__(self, name: str, profile: LatencyProfile, stats: VendorStats, seed: Optional[int]):
+        self.name = name
+        self.profile = profile
+        self.stats = stats
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def _draw(self):
+        with self._rng_lock:
+            return self.profile.sample_seconds(self._rng), self.profile.fails(self._rng)
+
+    def _call(self, operation: str) -> None:
+        """Sleep like the real vendor would and raise if this call should fail"""
+        delay, failed = self._draw()
+        time.sleep(delay)
+        self.stats.record(f"{self.name}.{operation}", delay, failed)
+        if failed:
+            raise FakeVendorError(f"Injected {self.name} failure")
+
+
+class FakeMaestroRuns(_FakeVendor):
+    """Implements the parts of client.beta.maestro.runs the game uses"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ids = itertools.count(1)
+        self._runs: Dict[str, Dict[str, Any]] = {}
+        self._runs_lock = threading.Lock()
+        # Runs cancelled before they finished
+        self.cancelled = 0
+
+    @staticmethod
+    def _result_for(input: str) -> str:
+        if "player choices" in input:
+            return "\n".join([
+                "A) Press on along the old road.",
+                "B) Ask Ser Elyen what he knows of this place.",
+                "C) Slip away unseen.",
+                "D) Wait and watch.",
+            ])
+        return "I have seen such choices before, in the days of the old king. Let us hope this one serves us better."
+
+    def create_and_poll(self, input: str, requirements=None, **kwargs):
+        self._call("run")
+        return SimpleNamespace(id=f"run-{next(self._ids)}", status="completed", result=self._result_for(input))
+
+    def create(self, input: str, requirements=None, **kwargs):
+        """Start a run that completes after a sampled latency, checked by retrieve()"""
+        delay, failed = self._draw()
+        run_id = f"run-{next(self._ids)}"
+        with self._runs_lock:
+            self._runs[run_id] = {
+                "started_at": time.monotonic(),
+                "delay": delay,
+                "failed": failed,
+                "result": self._result_for(input),
+            }
+        return SimpleNamespace(id=run_id, status="in_progress", result=None)
+
+    def retrieve(self, run_id: str):
+        with self._runs_lock:
+            run = self._runs[run_id]
+        if time.monotonic() - run["started_at"] < run["delay"]:
+            return SimpleNamespace(id=run_id, status="in_progress", result=None)
+        with self._runs_lock:
+            if self._runs.pop(run_id, None) is not None:
+                self.stats.record(f"{self.name}.run", run["delay"], run["failed"])
+        if run["failed"]:
+            return SimpleNamespace(id=run_id, status="failed", result=None)
+        return SimpleNamespace(id=run_id, status="completed", result=run["result"])
+
+
+    def cancel(self, run_id: str):
+        with self._runs_lock:
+            run = self._runs.pop(run_id, None)
+        if run is not None:
+            self.cancelled += 1
+        return SimpleNamespace(id=run_id, status="cancelled", result=None)
+
+
+class FakeAI21Client:
+    def __init__(self, runs: FakeMaestroRuns):
+        self.beta = SimpleNamespace(maestro=SimpleNamespace(runs=runs))
+
+
+class FakeReplicate(_FakeVendor):
+    """Stands in for the replicate module held by SceneVisualizer"""
+
+    def run(self, model: str, input: Dict[str, Any] = None, **kwargs):
+        self._call("prediction")
+        return [f"https://fake-replicate.local/{abs(hash(input.get('prompt', ''))) % 10**8}.webp"]
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, payload: Dict[str, Any]):
+        self.status_code = status_code
+        self._payload = payload
+        self.text = str(payload)
+
+    def json(self) -> Dict[str, Any]:
+        return self._payload
+
+
+class FakeSesame(_FakeVendor):
+    """Stands in for SesameVoice's requests session"""
+
+    _AUDIO = base64.b64encode(b"ID3fake-audio").decode("ascii")
+
+    def post(self, url: str, headers=None, json=None, **kwargs):
+        try:
+            self._call("speech")
+        except FakeVendorError:
+            return _FakeResponse(503, {"error": "Injected sesame failure"})
+        return _FakeResponse(200, {"audio": self._AUDIO})
+
+
+class FakeVendors:
+    """
+    Installs the fakes into an initialized api.main module and restores the
+    real clients on uninstall().
+    """
+
+    def __init__(self, profiles: Optional[Dict[str, LatencyProfile]] = None, seed: Optional[int] = None):
+        profiles = dict(DEFAULT_PROFILES, **(profiles or {}))
+        self.stats = VendorStats()
+        self.maestro = FakeMaestroRuns("maestro", profiles["maestro"], self.stats, seed)
+        self.replicate = FakeReplicate("replicate", profiles["replicate"], self.stats, seed)
+        self.sesame = FakeSesame("sesame", profiles["sesame"], self.stats, seed)
+        self._restore: List = []
+
+    def _patch(self, target, attribute: str, value) -> None:
+        self._restore.append((target, attribute, getattr(target, attribute)))
+        setattr(target, attribute, value)
+
+    def install(self, main_module) -> "FakeVendors":
+        components = main_module.components
+        client = FakeAI21Client(self.maestro)
+        self._patch(components.orchestrator, "client", client)
+        self._patch(components.orchestrator.scoring_agent, "client", client)
+        self._patch(components.agent, "client", client)
+        self._patch(components.visualizer, "replicate", self.replicate)
+        self._patch(components.voice, "http", self.sesame)
+        return self
+
+    def uninstall(self) -> None:
+        while self._restore:
+            target, attribute, value = self._restore.pop()
+            setattr(target, attribute, value)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Offline load generator for the RPG Maestro API.
+
+Runs the real FastAPI app in-process with fake vendor backends (see
+bench/fakes.py) and drives /api/scene and /api/action from a number of
+concurrent virtual players, then reports latency percentiles, throughput
+and a per-stage breakdown of where the time went.
+
+    python -m bench.loadgen --concurrency 50 --duration 30
+    python -m bench.loadgen --maestro 1200,4000,0.05 --fail-p95-ms 9000
+
+Pass --url to drive an already running server over HTTP instead; vendor
+fakes are only installed in in-process mode.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.fakes import FakeVendors, LatencyProfile
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50_ms": round(1000 * percentile(values, 50), 1),
+        "p95_ms": round(1000 * percentile(values, 95), 1),
+        "p99_ms": round(1000 * percentile(values, 99), 1),
+        "max_ms": round(1000 * max(values), 1) if values else 0.0,
+    }
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+async def _timed(client: httpx.AsyncClient, result: LoadResult, endpoint: str, method: str, url: str, **kwargs):
+    started_at = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code == 200
+    except httpx.HTTPError:
+        response, ok = None, False
+    result.record(endpoint, time.perf_counter() - started_at, ok)
+    return response if ok else None
+
+
+async def virtual_player(client: httpx.AsyncClient, result: LoadResult, deadline: float,
+                         turns_left: List[int], start_scene: str, rng: random.Random) -> None:
+    """Play turns (load a scene, make a choice, follow it) until time or turns run out"""
+    session_id = None
+    scene_id = start_scene
+    while time.perf_counter() < deadline and turns_left[0] > 0:
+        turns_left[0] -= 1
+        params = {"session_id": session_id} if session_id else {}
+        scene = await _timed(client, result, "GET /api/scene", "GET", f"/api/scene/{scene_id}", params=params)
+        if scene is None:
+            scene_id = start_scene
+            continue
+        data = scene.json()
+        session_id = data.get("session_id", session_id)
+
+        choice_index = rng.randrange(len(data["scene"].get("actions") or data["choices"]))
+        action = await _timed(client, result, "POST /api/action", "POST", "/api/action", json={
+            "scene_id": scene_id,
+            "choice_index": choice_index,
+            "session_id": session_id,
+        })
+        next_scene_id = action.json().get("next_scene_id") if action is not None else None
+        # Follow the story while it leads somewhere we can load, otherwise start over
+        if next_scene_id and (not known_scenes or next_scene_id in known_scenes):
+            scene_id = next_scene_id
+        else:
+            scene_id = start_scene
+
+
+# Scenes the in-process app can serve, filled in by run(); empty over HTTP,
+# where players follow every next_scene_id and restart when one fails to load
+known_scenes: Dict[str, Any] = {}
+
+
+async def run_load(client: httpx.AsyncClient, concurrency: int, duration: float, max_turns: int,
+                   start_scene: str, seed: int) -> LoadResult:
+    result = LoadResult()
+    deadline = time.perf_counter() + duration
+    turns_left = [max_turns]
+    rng = random.Random(seed)
+    players = [
+        virtual_player(client, result, deadline, turns_left, start_scene, random.Random(rng.random()))
+        for _ in range(concurrency)
+    ]
+    await asyncio.gather(*players)
+    result.finished_at = time.perf_counter()
+    return result
+
+
+def build_report(result: LoadResult, fakes: Optional[FakeVendors], executor_stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    elapsed = (result.finished_at or time.perf_counter()) - result.started_at
+    total = sum(len(values) for values in result.latencies.values())
+    report = {
+        "elapsed_s": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "endpoints": {
+            endpoint: dict(summarize(values), errors=result.errors.get(endpoint, 0))
+            for endpoint, values in sorted(result.latencies.items())
+        },
+    }
+    if fakes is not None:
+        report["stages"] = {
+            operation: dict(summarize(data["latencies"]), errors=data["errors"])
+            for operation, data in sorted(fakes.stats.snapshot().items())
+        }
+    if executor_stats is not None:
+        report["executor"] = executor_stats
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"\n===== Load Test Results ({report['elapsed_s']}s) =====")
+    print(f"Requests: {report['requests']}  Throughput: {report['throughput_rps']} req/s")
+
+    def table(title: str, rows: Dict[str, Dict[str, Any]]) -> None:
+        print(f"\n{title:<28}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for name, row in rows.items():
+            print(f"{name:<28}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['errors']:>8}")
+
+    table("Endpoint", report["endpoints"])
+    if "stages" in report:
+        table("Upstream stage", report["stages"])
+    if "executor" in report:
+        print(f"\n{'Executor pool':<28}{'completed':>10}{'peak queue':>12}{'avg wait ms':>13}")
+        for name, pool in report["executor"].items():
+            if isinstance(pool, dict) and "completed" in pool:
+                print(f"{name:<28}{pool['completed']:>10}{pool['peak_queue_depth']:>12}{pool['avg_wait_ms']:>13}")
+
+
+async def run(args) -> Dict[str, Any]:
+    fakes = None
+    executor_stats = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        # The components need keys to construct their clients; the fakes replace them
+        for key in ("AI21_API_KEY", "REPLICATE_API_TOKEN", "SESAME_API_KEY"):
+            os.environ.setdefault(key, "offline-benchmark")
+        # Start from empty job and result stores so earlier runs don't skew the numbers
+        scratch = tempfile.mkdtemp(prefix="rpg-bench-")
+        os.environ.setdefault("MEDIA_JOB_DB_PATH", os.path.join(scratch, "jobs.db"))
+        os.environ.setdefault("RESULT_CACHE_PATH", os.path.join(scratch, "cache.db"))
+
+        from api import main
+        await main.startup_event()
+        profiles = {}
+        for vendor in ("maestro", "replicate", "sesame"):
+            spec = getattr(args, vendor)
+            if spec:
+                profiles[vendor] = LatencyProfile.parse(spec)
+        fakes = FakeVendors(profiles, seed=args.seed).install(main)
+        known_scenes.update(main.components.orchestrator.scenes)
+
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        client = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout)
+
+    async with client:
+        if args.warmup:
+            await run_load(client, min(args.concurrency, 4), args.warmup, args.concurrency, args.scene, args.seed)
+            if fakes is not None:
+                fakes.stats.reset()
+        result = await run_load(client, args.concurrency, args.duration, args.max_turns, args.scene, args.seed)
+        if args.url:
+            response = await client.get("/api/executors")
+            executor_stats = response.json() if response.status_code == 200 else None
+
+    if not args.url:
+        executor_stats = main.executor.stats()
+        fakes.uninstall()
+        await main.shutdown_event()
+
+    return build_report(result, fakes, executor_stats)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline load test for the RPG Maestro API")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent virtual players")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to generate load for")
+    parser.add_argument("--max-turns", type=int, default=10**9, help="Stop after this many turns in total")
+    parser.add_argument("--warmup", type=float, default=0.0, help="Seconds of warm-up load excluded from results")
+    parser.add_argument("--scene", default="intro", help="Scene every player starts from")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--url", help="Drive a running server instead of the in-process app")
+    for vendor in ("maestro", "replicate", "sesame"):
+        parser.add_argument(f"--{vendor}", metavar="MEDIAN[,P95[,ERROR_RATE]]",
+                            help=f"Latency profile for the fake {vendor} backend, in ms")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this path")
+    parser.add_argument("--fail-p95-ms", type=float, help="Exit non-zero if any endpoint's p95 exceeds this")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.fail_p95_ms is not None:
+        slow = [name for name, row in report["endpoints"].items() if row["p95_ms"] > args.fail_p95_ms]
+        if slow:
+            print(f"\n❌ p95 above {args.fail_p95_ms} ms: {', '.join(slow)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
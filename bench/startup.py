@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the RPG Maestro API.
+
+Starts uvicorn in a fresh subprocess several times and measures how long it
+takes until /healthz answers (the server accepts traffic) and until /readyz
+returns 200 (every game component has been built).
+
+    python -m bench.startup --runs 5
+    python -m bench.startup --json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+from bench.loadgen import summarize
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def status_of(url: str) -> Optional[int]:
+    try:
+        with urllib.request.urlopen(url, timeout=1.0) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+
+def measure_once(timeout: float) -> Dict[str, float]:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ)
+    # The vendor clients only need a key to be constructed; nothing is called
+    for key in ("AI21_API_KEY", "REPLICATE_API_TOKEN", "SESAME_API_KEY"):
+        env.setdefault(key, "bench")
+
+    started_at = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    result: Dict[str, float] = {}
+    try:
+        while time.perf_counter() - started_at < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            if "live" not in result and status_of(f"{base_url}/healthz") == 200:
+                result["live"] = time.perf_counter() - started_at
+            if "live" in result and status_of(f"{base_url}/readyz") == 200:
+                result["ready"] = time.perf_counter() - started_at
+                return result
+            time.sleep(0.01)
+        raise TimeoutError(f"Server was not ready within {timeout}s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure API time-to-live and time-to-ready")
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts to measure")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for each start")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    live: List[float] = []
+    ready: List[float] = []
+    for _ in range(args.runs):
+        result = measure_once(args.timeout)
+        live.append(result["live"])
+        ready.append(result["ready"])
+
+    report = {"runs": args.runs, "healthz": summarize(live), "readyz": summarize(ready)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Cold starts: {args.runs}")
+        for name in ("healthz", "readyz"):
+            stats = report[name]
+            print(f"  /{name:<8} p50 {stats['p50_ms']:>8.1f} ms   p95 {stats['p95_ms']:>8.1f} ms   max {stats['max_ms']:>8.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
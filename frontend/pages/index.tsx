@@ -1,12 +1,12 @@
 import { useState, useEffect } from 'react';
 import Head from 'next/head';
-import axios from 'axios';
 import GameScene from '../components/GameScene';
 import CharacterResponse from '../components/CharacterResponse';
 import PlayerChoices from '../components/PlayerChoices';
 import LoadingIndicator from '../components/LoadingIndicator';
 import HistoricalFacts from '../components/HistoricalFacts';
 import PlayerStats from '../components/PlayerStats';
+import { streamEvents } from '../lib/streamEvents';
 
 // Define API URL based on environment
 const API_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
@@ -29,6 +29,7 @@ export default function Home() {
     skills: {}
   });
   const [feedback, setFeedback] = useState('');
+  const [sessionId, setSessionId] = useState(null);
   
   // Start the game
   const startGame = async () => {
@@ -36,22 +37,32 @@ export default function Home() {
     await fetchScene('intro');
   };
   
-  // Fetch scene data from API
+  // Fetch scene data from API, rendering each part as soon as it streams in
   const fetchScene = async (sceneId) => {
     setLoading(true);
+    setChoices([]);
+    setSceneImage('');
+    setAgentResponse(''); // Clear previous agent response
+    setAudioUrl(''); // Clear previous audio
     try {
-      const response = await axios.get(`${API_URL}/api/scene/${sceneId}`);
-      setScene(response.data.scene);
-      setChoices(response.data.choices);
-      setSceneImage(response.data.image_url);
-      setHistoricalFacts(response.data.historical_context || []);
-      setAgentResponse(''); // Clear previous agent response
-      setAudioUrl(''); // Clear previous audio
-      
-      // Update player state if available
-      if (response.data.player_state) {
-        setPlayerState(response.data.player_state);
-      }
+      const query = sessionId ? `?session_id=${encodeURIComponent(sessionId)}` : '';
+      await streamEvents(`${API_URL}/api/scene/${sceneId}/stream${query}`, {}, (event, data) => {
+        if (event === 'scene') {
+          setSessionId(data.session_id);
+          setScene(data.scene);
+          setPlayerState(data.player_state);
+          // The scene text is enough to start reading
+          setLoading(false);
+        } else if (event === 'historical_context') {
+          setHistoricalFacts(data.historical_context || []);
+        } else if (event === 'choices') {
+          setChoices(data.choices);
+        } else if (event === 'image_url') {
+          setSceneImage(data.image_url);
+        } else if (event === 'error') {
+          console.error('Error fetching scene:', data.detail);
+        }
+      });
     } catch (error) {
       console.error('Error fetching scene:', error);
     } finally {
@@ -63,35 +74,38 @@ export default function Home() {
   const makeChoice = async (choiceIndex) => {
     setLoading(true);
     try {
-      const response = await axios.post(`${API_URL}/api/action`, {
-        scene_id: scene.scene_id,
-        choice_index: choiceIndex
+      await streamEvents(`${API_URL}/api/action/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          scene_id: scene.scene_id,
+          choice_index: choiceIndex,
+          session_id: sessionId
+        })
+      }, (event, data) => {
+        if (event === 'action') {
+          setSessionId(data.session_id);
+          // Store the next scene ID for when the player continues
+          setNextSceneId(data.next_scene_id);
+        } else if (event === 'scoring') {
+          setPlayerState(data.player_state);
+          setFeedback(data.scoring && data.scoring.feedback ? data.scoring.feedback : '');
+        } else if (event === 'historical_context') {
+          setHistoricalFacts(data.historical_context || []);
+        } else if (event === 'agent_response') {
+          // Don't automatically move to the next scene
+          // Instead, show a continue button after the response
+          setAgentResponse(data.agent_response);
+          setLoading(false);
+        } else if (event === 'audio_url') {
+          setAudioUrl(data.audio_url);
+        } else if (event === 'error') {
+          console.error('Error making choice:', data.detail);
+        }
       });
-      
-      setAgentResponse(response.data.agent_response);
-      setAudioUrl(response.data.audio_url);
-      setHistoricalFacts(response.data.historical_context || []);
-      
-      // Don't automatically move to the next scene
-      // Instead, show a continue button after the response
-      setLoading(false);
-      
-      // Store the next scene ID for when the player continues
-      setNextSceneId(response.data.next_scene_id);
-      
-      // Update player state if available
-      if (response.data.player_state) {
-        setPlayerState(response.data.player_state);
-      }
-      
-      // Set feedback if available
-      if (response.data.scoring && response.data.scoring.feedback) {
-        setFeedback(response.data.scoring.feedback);
-      } else {
-        setFeedback('');
-      }
     } catch (error) {
       console.error('Error making choice:', error);
+    } finally {
       setLoading(false);
     }
   };
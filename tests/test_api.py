@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+import pytest
+
+scratch = tempfile.mkdtemp(prefix="rpg-test-")
+for key in ("AI21_API_KEY", "REPLICATE_API_TOKEN", "SESAME_API_KEY"):
+    os.environ.setdefault(key, "offline-test")
+os.environ.setdefault("MEDIA_JOB_DB_PATH", os.path.join(scratch, "jobs.db"))
+os.environ.setdefault("RESULT_CACHE_PATH", os.path.join(scratch, "cache.db"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from api import main  # noqa: E402
+from bench.fakes import FakeVendors  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        FakeVendors({}).install(main)
+        yield client
+
+
+def test_unknown_scene_is_404(client):
+    assert client.get("/api/scene/nowhere").status_code == 404
+    assert client.get("/api/scene/nowhere/stream").status_code == 404
+    response = client.post("/api/action", json={"scene_id": "nowhere", "choice_index": 0})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("choice_index", [-1, 4, 99])
+def test_missing_choice_is_400(client, choice_index):
+    scene_id = main.components.orchestrator.scene_graph.start_scene
+    response = client.post("/api/action", json={"scene_id": scene_id, "choice_index": choice_index})
+    assert response.status_code == 400
+    response = client.post("/api/action/stream", json={"scene_id": scene_id, "choice_index": choice_index})
+    assert response.status_code == 400
+
+
+def test_get_scene_doesnt_change_the_orchestrator(client):
+    orchestrator = main.components.orchestrator
+    scene_id = orchestrator.scene_graph.start_scene
+    assert orchestrator.get_scene(scene_id)["scene_id"] == scene_id
+    assert orchestrator.current_scene is None
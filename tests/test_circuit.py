@@ -0,0 +1,191 @@
+import asyncio
+
+import pytest
+
+from api.game import circuit
+from api.game.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit, "time", clock)
+    return clock
+
+
+def breaker(**settings):
+    defaults = dict(window_sec=60, min_calls=4, failure_rate=0.5, slow_call_sec=10, open_sec=30, half_open_probes=2)
+    defaults.update(settings)
+    return CircuitBreaker("vendor", **defaults)
+
+
+def succeed(cb, duration=0.0, clock=None):
+    with cb.guard():
+        if clock is not None:
+            clock.now += duration
+
+
+def fail(cb):
+    with pytest.raises(RuntimeError):
+        with cb.guard():
+            raise RuntimeError("vendor error")
+
+
+def trip(cb):
+    for _ in range(cb.min_calls):
+        fail(cb)
+    assert cb.state == OPEN
+
+
+def test_trips_once_enough_calls_fail(clock):
+    cb = breaker()
+    succeed(cb)
+    succeed(cb)
+    fail(cb)
+    assert cb.state == CLOSED  # 1 failure in 3 calls: under min_calls
+    fail(cb)
+    assert cb.state == OPEN  # 2 in 4: at the failure rate
+    assert cb.stats()["opened"] == 1
+
+
+def test_stays_closed_below_the_failure_rate(clock):
+    cb = breaker()
+    for _ in range(3):
+        succeed(cb)
+    fail(cb)
+    for _ in range(6):
+        succeed(cb)
+    fail(cb)
+    assert cb.state == CLOSED
+
+
+def test_failures_expire_with_the_window(clock):
+    cb = breaker()
+    for _ in range(3):
+        fail(cb)
+    clock.now += 61
+    fail(cb)
+    assert cb.state == CLOSED
+    assert cb.stats()["window_failures"] == 1
+
+
+def test_open_rejects_until_open_sec_passes(clock):
+    cb = breaker()
+    trip(cb)
+    assert cb.rejecting()
+    with pytest.raises(CircuitOpenError):
+        with cb.guard():
+            pytest.fail("the body must not run while the circuit is open")
+    assert cb.stats()["rejected"] == 1
+
+    clock.now += 30
+    assert not cb.rejecting()
+    with cb.guard():
+        assert cb.state == HALF_OPEN
+
+
+def test_half_open_closes_after_successful_probes(clock):
+    cb = breaker()
+    trip(cb)
+    clock.now += 30
+    succeed(cb)
+    assert cb.state == HALF_OPEN
+    succeed(cb)
+    assert cb.state == CLOSED
+    # Closing starts a fresh window
+    assert cb.stats()["window_calls"] == 0
+
+
+def test_half_open_limits_concurrent_probes(clock):
+    cb = breaker()
+    trip(cb)
+    clock.now += 30
+    with cb.guard(), cb.guard():
+        assert cb.rejecting()
+        with pytest.raises(CircuitOpenError):
+            with cb.guard():
+                pass
+    assert cb.state == CLOSED
+
+
+def test_failed_probe_reopens(clock):
+    cb = breaker()
+    trip(cb)
+    clock.now += 30
+    succeed(cb)
+    fail(cb)
+    assert cb.state == OPEN
+    assert cb.opened_at == clock.now
+    assert cb.stats()["opened"] == 2
+
+
+def test_slow_calls_count_as_failures(clock):
+    cb = breaker()
+    for _ in range(4):
+        succeed(cb, duration=11, clock=clock)
+    assert cb.state == OPEN
+    assert cb.stats()["failed"] == 4
+
+
+def test_hanging_calls_trip_the_circuit(clock):
+    cb = breaker(min_calls=2)
+    first, second = cb.guard(), cb.guard()
+    first.__enter__()
+    second.__enter__()
+    clock.now += 11
+    # Both calls are still running but past slow_call_sec
+    with pytest.raises(CircuitOpenError):
+        with cb.guard():
+            pass
+    assert cb.state == OPEN
+
+
+def test_hanging_probe_reopens(clock):
+    cb = breaker()
+    trip(cb)
+    clock.now += 30
+    probe = cb.guard()
+    probe.__enter__()
+    clock.now += 11
+    with pytest.raises(CircuitOpenError):
+        with cb.guard():
+            pass
+    assert cb.state == OPEN
+
+
+def test_fail_marks_a_call_failed_without_raising(clock):
+    cb = breaker()
+    for _ in range(4):
+        with cb.guard() as call:
+            call.fail()
+    assert cb.state == OPEN
+
+
+def test_cancelled_probe_hands_back_its_slot(clock):
+    cb = breaker(half_open_probes=1)
+    trip(cb)
+    clock.now += 30
+    with pytest.raises(asyncio.CancelledError):
+        with cb.guard():
+            raise asyncio.CancelledError()
+    assert cb.state == HALF_OPEN
+    assert not cb.rejecting()
+    succeed(cb)
+    assert cb.state == CLOSED
+
+
+def test_disabled_breakers_never_trip(clock, monkeypatch):
+    monkeypatch.setenv("CIRCUIT_BREAKER_ENABLED", "false")
+    monkeypatch.setenv("CIRCUIT_MIN_CALLS", "2")
+    cb = CircuitBreakers().get("vendor")
+    for _ in range(20):
+        fail(cb)
+    assert cb.state == CLOSED
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from api.game.events import RECENT_ACTIONS_KEPT, apply_choice, apply_event, apply_score, remember_action, turn_event
+from api.game.orchestrator import new_agent_state, new_player_state
+from api.game.session import GameSession, InMemoryBackend, SessionStore, SQLiteBackend
+
+
+def new_agent_memory():
+    return {"name": "Companion", "alignment": "neutral", "trust_in_player": 50, "recent_actions": [], "mood": "neutral"}
+
+
+def make_store(backend, snapshot_every):
+    return SessionStore(backend, new_player_state, new_agent_state, new_agent_memory, snapshot_every=snapshot_every)
+
+
+def play(store, session_id, turns, seed=0):
+    """Play random turns, saving after each one the way /api/action does; returns the live session"""
+    rng = random.Random(seed)
+    session = store.load(session_id)
+    for turn in range(turns):
+        impact = None
+        if rng.random() < 0.8:
+            impact = {"law_chaos": rng.randint(-30, 30), "good_evil": rng.randint(-30, 30), "trust": rng.randint(-20, 20)}
+        event = turn_event(f"scene_{turn % 4}", rng.randint(0, 3), f"action {turn}" if impact else None, impact, 10)
+        apply_choice(session.player_state, session.agent_state, event)
+        event["score"] = rng.randint(0, 10)
+        if rng.random() < 0.5:
+            event["feedback"] = {"scene_id": event["scene_id"], "choice_index": event["choice_index"],
+                                 "feedback": f"feedback {turn}", "scores": {"total": event["score"]}}
+        apply_score(session.player_state, event)
+        session.events.append(event)
+        session.current_scene = f"scene_{(turn + 1) % 4}"
+        if turn % 3 == 0:
+            session.agent_memory["mood"] = rng.choice(["trusting", "neutral", "suspicious"])
+        store.save(session)
+    return session
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryBackend()
+    return SQLiteBackend(str(tmp_path / "sessions.db"))
+
+
+@pytest.mark.parametrize("snapshot_every", [1, 4, 7])
+def test_snapshot_plus_events_matches_live_state(backend, snapshot_every):
+    store = make_store(backend, snapshot_every)
+    live = play(store, "player", 30)
+    loaded = store.load("player")
+    assert loaded.to_compact() == live.to_compact()
+    assert loaded.version == live.version
+
+
+def test_replaying_the_whole_log_matches_the_snapshot(backend):
+    store = make_store(backend, 4)
+    live = play(store, "player", 25)
+    snapshot, snapshot_version, _ = backend.load("player")
+    assert snapshot is not None and snapshot_version > 0
+
+    # Replay every event from a fresh session, ignoring the snapshot
+    history = store.history("player")
+    replayed = store._new_session("player")
+    for event in history:
+        apply_event(replayed, event)
+    assert replayed.to_compact() == live.to_compact()
+
+    # The snapshot equals the state replayed up to its version
+    partial = store._new_session("player")
+    for event in history:
+        if event["version"] <= snapshot_version:
+            apply_event(partial, event)
+    assert partial.to_compact() == snapshot
+
+
+def test_compact_round_trip():
+    store = make_store(InMemoryBackend(), 100)
+    live = play(store, "player", 12)
+    restored = GameSession.from_compact("player", live.to_compact(), new_agent_memory(), live.version)
+    assert restored.to_compact() == live.to_compact()
+
+
+def test_remember_action_keeps_the_most_recent():
+    agent_state = new_agent_state()
+    for number in range(RECENT_ACTIONS_KEPT + 3):
+        remember_action(agent_state, f"action {number}")
+    assert agent_state["recent_actions"] == [f"action {number}" for number in range(3, RECENT_ACTIONS_KEPT + 3)]
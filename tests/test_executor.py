@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+from api.game.executor import VendorPool
+
+
+def test_cancelled_queued_call_leaves_the_queue():
+    pool = VendorPool("test", 1)
+    release = threading.Event()
+
+    async def scenario():
+        running = asyncio.ensure_future(pool.run(release.wait))
+        queued = asyncio.ensure_future(pool.run(lambda: "never"))
+        await asyncio.sleep(0.05)
+        assert pool.stats()["queued"] == 1
+        queued.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await running is True
+        return queued
+
+    try:
+        queued = asyncio.run(scenario())
+    finally:
+        release.set()
+        pool.shutdown()
+    assert queued.cancelled()
+    stats = pool.stats()
+    assert stats["queued"] == 0 and stats["active"] == 0
+    assert stats["completed"] == 1
+
+
+def test_finished_calls_are_counted_once():
+    pool = VendorPool("test", 2)
+
+    def fail():
+        raise ValueError("boom")
+
+    async def scenario():
+        assert await pool.run(lambda x: x * 2, 21) == 42
+        try:
+            await pool.run(fail)
+        except ValueError:
+            pass
+
+    asyncio.run(scenario())
+    pool.shutdown()
+    stats = pool.stats()
+    assert (stats["queued"], stats["active"], stats["completed"], stats["failed"]) == (0, 0, 1, 1)
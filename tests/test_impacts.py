@@ -0,0 +1,102 @@
+import copy
+import random
+
+import numpy as np
+import pytest
+
+from api.game.events import apply_choice, turn_event
+from api.game.impacts import ImpactTable, pack_states, unpack_states
+from api.game.orchestrator import EXPERIENCE_PER_CHOICE, GameOrchestrator, new_agent_state, new_player_state
+from api.game.result_cache import ResultCache
+from api.game.scene_graph import SceneGraph
+
+
+@pytest.fixture(scope="module")
+def graph():
+    return SceneGraph.load()
+
+
+@pytest.fixture(scope="module")
+def table(graph):
+    return ImpactTable(graph)
+
+
+def random_players(graph, count, seed):
+    """States, scenes and choices, including choices out of range and near the clamping bounds"""
+    rng = random.Random(seed)
+    player_states, agent_states, scene_ids, choice_indices = [], [], [], []
+    for _ in range(count):
+        player = new_player_state()
+        player["alignment"]["law_chaos"] = rng.choice([-100, -95, 0, 42, 95, 100])
+        player["alignment"]["good_evil"] = rng.randint(-100, 100)
+        agent = new_agent_state()
+        agent["trust"] = rng.choice([0, 3, 50, 97, 100])
+        scene_id = rng.choice(graph.scene_ids)
+        player_states.append(player)
+        agent_states.append(agent)
+        scene_ids.append(scene_id)
+        choice_indices.append(rng.randint(-1, len(graph.choices(scene_id))))
+    return player_states, agent_states, scene_ids, choice_indices
+
+
+def apply_one_by_one(table, graph, player_states, agent_states, scene_ids, choice_indices):
+    """The per-player path a normal turn takes: impact() applied through a turn event"""
+    applied = []
+    for player, agent, scene_id, choice_index in zip(player_states, agent_states, scene_ids, choice_indices):
+        impact = table.impact(scene_id, choice_index)
+        action = graph.choices(scene_id)[choice_index] if impact is not None else None
+        apply_choice(player, agent, turn_event(scene_id, choice_index, action, impact, EXPERIENCE_PER_CHOICE))
+        applied.append(impact is not None)
+    return applied
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_apply_batch_matches_per_player_path(graph, table, seed):
+    player_states, agent_states, scene_ids, choice_indices = random_players(graph, 500, seed)
+    states = pack_states(player_states, agent_states)
+
+    batch, applied = table.apply_batch(states, scene_ids, choice_indices)
+    expected = apply_one_by_one(table, graph, player_states, agent_states, scene_ids, choice_indices)
+
+    assert any(expected) and not all(expected)
+    assert applied.tolist() == expected
+    assert batch.tolist() == pack_states(player_states, agent_states).tolist()
+
+
+def test_apply_batch_takes_scene_indices_and_writes_in_place(graph, table):
+    player_states, agent_states, scene_ids, choice_indices = random_players(graph, 50, 7)
+    states = pack_states(player_states, agent_states)
+    by_id, _ = table.apply_batch(states, scene_ids, choice_indices)
+    out, _ = table.apply_batch(states, table.scene_indices(scene_ids), np.array(choice_indices), out=states)
+    assert out is states
+    assert out.tolist() == by_id.tolist()
+
+
+def test_apply_batch_rejects_mismatched_inputs(table, graph):
+    with pytest.raises(ValueError):
+        table.apply_batch(np.zeros((2, 2), dtype=np.int32), [graph.start_scene] * 2, [0, 0])
+    with pytest.raises(ValueError):
+        table.apply_batch(np.zeros((2, 3), dtype=np.int32), [graph.start_scene], [0, 0])
+
+
+def test_unpack_writes_back_into_the_dicts(graph, table):
+    player_states, agent_states, scene_ids, choice_indices = random_players(graph, 20, 3)
+    states, _ = table.apply_batch(pack_states(player_states, agent_states), scene_ids, choice_indices)
+    unpack_states(states, player_states, agent_states)
+    assert pack_states(player_states, agent_states).tolist() == states.tolist()
+
+
+def test_update_player_states_batch_matches_per_player_path(graph, table):
+    orchestrator = GameOrchestrator("offline-test", choice_cache=ResultCache("choices"))
+    player_states, agent_states, scene_ids, choice_indices = random_players(graph, 200, 11)
+    # Some history, so the recent actions get trimmed
+    for agent in agent_states:
+        agent["recent_actions"] = [f"earlier {number}" for number in range(5)]
+    expected_players, expected_agents = copy.deepcopy(player_states), copy.deepcopy(agent_states)
+
+    applied = orchestrator.update_player_states_batch(player_states, agent_states, scene_ids, choice_indices)
+    expected = apply_one_by_one(table, graph, expected_players, expected_agents, scene_ids, choice_indices)
+
+    assert applied == expected
+    assert player_states == expected_players
+    assert agent_states == expected_agents
@@ -0,0 +1,244 @@
+import json
+import os
+import random
+
+import pytest
+
+from api.game import ingest
+from api.game.embeddings import HashingEmbedder
+from api.game.ingest import Ingester
+from api.game.rag import RAGRetriever
+from api.game.segment import LIVE_SOURCE, manifest_segments, read_manifest, segment_path
+
+WORDS = ["castle", "river", "siege", "abbey", "harvest", "knight", "market", "plague", "forest", "crown",
+         "bridge", "monk", "tithe", "charter", "guild", "ferry", "mill", "banner", "oath", "relic"]
+
+
+def lore(count, seed=0):
+    rng = random.Random(seed)
+    return [{
+        "id": f"doc-{number}",
+        "title": f"Chronicle {number}",
+        # A word only this document has, so a query can single it out
+        "text": f"marker{number} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))),
+        "region": rng.choice(["north", "south"]),
+    } for number in range(count)]
+
+
+def write_lore(path, documents):
+    with open(path, "w") as f:
+        for doc in documents:
+            f.write(json.dumps(doc) + "\n")
+    return str(path)
+
+
+def ingester(index_path, **settings):
+    return Ingester(str(index_path), HashingEmbedder(dim=64), segment_passages=settings.pop("segment_passages", 8),
+                    **settings)
+
+
+def retriever(index_path, source):
+    return RAGRetriever(str(index_path), source, embedder=HashingEmbedder(dim=64), cache_size=0)
+
+
+def top_id(rag, number, **filters):
+    docs = rag.retrieve(f"marker{number}", k=1, filters=filters or None)
+    return docs[0]["id"] if docs else None
+
+
+@pytest.fixture
+def source(tmp_path):
+    return write_lore(tmp_path / "lore.jsonl", lore(40))
+
+
+def test_interrupted_ingest_resumes_from_its_checkpoint(tmp_path, source, monkeypatch):
+    write_segment = Ingester._write_segment
+    written = []
+
+    def crash_after_two(self, *args, **kwargs):
+        if len(written) == 2:
+            raise KeyboardInterrupt
+        write_segment(self, *args, **kwargs)
+        written.append(args[2])
+
+    monkeypatch.setattr(Ingester, "_write_segment", crash_after_two)
+    with pytest.raises(KeyboardInterrupt):
+        ingester(tmp_path / "index").ingest(source)
+    assert read_manifest(str(tmp_path / "index")) == {}
+    monkeypatch.setattr(Ingester, "_write_segment", write_segment)
+
+    resumed = ingester(tmp_path / "index").ingest(source)
+    assert resumed["resumed_from_record"] == written[-1] > 0
+    fresh = ingester(tmp_path / "fresh").ingest(source)
+    for key in ("records", "documents", "passages", "segments"):
+        assert resumed[key] == fresh[key]
+    assert not os.path.exists(os.path.join(str(tmp_path / "index"), "ingest", "lore-jsonl.json"))
+
+    rag, fresh_rag = retriever(tmp_path / "index", source), retriever(tmp_path / "fresh", source)
+    for number in range(40):
+        assert top_id(rag, number) == top_id(fresh_rag, number) == f"doc-{number}"
+
+
+def test_unchanged_source_is_skipped(tmp_path, source):
+    assert ingester(tmp_path / "index").ingest(source)["status"] == "ingested"
+    assert ingester(tmp_path / "index").ingest(source)["status"] == "unchanged"
+
+
+def test_duplicate_passages_are_indexed_once(tmp_path):
+    documents = lore(3)
+    documents.append(dict(documents[0], id="copy", title="Republished"))
+    result = ingester(tmp_path / "index").ingest(write_lore(tmp_path / "lore.jsonl", documents))
+    assert result["duplicate_passages"] == 1
+    assert result["documents"] == 3
+
+
+def test_deleted_documents_are_tombstoned_and_stay_deleted(tmp_path, source):
+    rag = retriever(tmp_path / "index", source)
+    assert rag.delete(["doc-3", "doc-404"]) == 1
+    assert top_id(rag, 3) != "doc-3"
+    assert sum(len(indexes) for indexes in read_manifest(str(tmp_path / "index"))["deleted"].values()) == 1
+
+    # Another worker sees the tombstone once it refreshes
+    assert top_id(retriever(tmp_path / "index", source), 3) != "doc-3"
+
+    # Re-ingesting the changed file doesn't bring it back
+    write_lore(source, lore(40) + lore(1, seed=1))
+    result = rag.ingester.ingest(source)
+    assert result["skipped_records"] == 1
+    rag.refresh()
+    assert top_id(rag, 3) != "doc-3"
+    assert top_id(rag, 4) == "doc-4"
+
+
+def test_upsert_replaces_the_document_everywhere(tmp_path, source):
+    rag = retriever(tmp_path / "index", source)
+    result = rag.upsert([{"id": "doc-5", "title": "Chronicle 5", "text": "marker5 rewritten by the abbey scribes",
+                          "region": "east"}])
+    assert result["replaced"] == 1
+    docs = rag.retrieve("marker5", k=3)
+    assert [doc["text"] for doc in docs if doc["id"] == "doc-5"] == ["marker5 rewritten by the abbey scribes"]
+    assert top_id(rag, 5, region="east") == "doc-5"
+    assert top_id(rag, 5, region="north") != "doc-5"
+
+
+def test_merge_folds_small_segments_and_drops_deleted_documents(tmp_path, source):
+    rag = retriever(tmp_path / "index", source)
+    rag.ingester.merge_factor = 3
+    for number in range(4):
+        rag.upsert([{"id": f"live-{number}", "title": "", "text": f"marker{100 + number} a new entry"}])
+    rag.delete(["doc-1", "doc-2", "live-0"])
+    before = {number: top_id(rag, number) for number in list(range(40)) + [100, 101, 102, 103]}
+
+    assert rag.merge() >= 1
+    manifest = read_manifest(str(tmp_path / "index"))
+    assert len(manifest["sources"][LIVE_SOURCE]["segments"]) == 1
+    # The merged segments' tombstones went with them
+    assert all(name in {n for entry in manifest["sources"].values() for n in entry["segments"]}
+               for name in manifest.get("deleted", {}))
+    assert {number: top_id(rag, number) for number in before} == before
+    # doc-1 and doc-2 stay tombstoned: 2 of 40 is under MERGE_DELETED_RATIO
+    assert rag.stats()["deleted_documents"] == 2
+
+    # Nothing left to merge
+    assert rag.merge() == 0
+
+
+def test_merge_rewrites_segments_with_many_deleted_documents(tmp_path, source):
+    rag = retriever(tmp_path / "index", source)
+    deleted = [f"doc-{number}" for number in range(0, 40, 4)]
+    assert rag.delete(deleted) == 10
+    before = {number: top_id(rag, number) for number in range(40)}
+
+    assert rag.merge() == 1
+    assert rag.stats()["deleted_documents"] == 0
+    assert rag.stats()["documents"] == 30
+    assert read_manifest(str(tmp_path / "index")).get("deleted") == {}
+    assert {number: top_id(rag, number) for number in range(40)} == before
+
+
+def test_merge_keeps_deletes_made_while_it_ran(tmp_path, source, monkeypatch):
+    rag = retriever(tmp_path / "index", source)
+    rag.ingester.merge_factor = 2
+    for number in range(2):
+        rag.upsert([{"id": f"live-{number}", "title": "", "text": f"marker{100 + number} a new entry"}])
+    merge = Ingester._merge
+
+    def delete_meanwhile(self, source_name, segments):
+        if source_name == LIVE_SOURCE:
+            Ingester.delete(self, ["live-1"])
+        return merge(self, source_name, segments)
+
+    monkeypatch.setattr(Ingester, "_merge", delete_meanwhile)
+    assert rag.merge() >= 1
+    assert top_id(rag, 101) != "live-1"
+    assert top_id(rag, 100) == "live-0"
+
+
+def test_merge_while_an_upsert_is_in_flight(tmp_path, source, monkeypatch):
+    index_path = str(tmp_path / "index")
+    rag = retriever(tmp_path / "index", source)
+    # Enough deletes for the merge to rewrite a segment and clean up after itself
+    rag.delete([f"doc-{number}" for number in range(0, 40, 4)])
+    stage = ingest.stage_segment
+
+    def merge_meanwhile(path, segment):
+        staged = stage(path, segment)
+        if segment.name.startswith(LIVE_SOURCE):
+            assert ingester(index_path).merge() == 1
+        return staged
+
+    monkeypatch.setattr(ingest, "stage_segment", merge_meanwhile)
+    rag.upsert([{"id": "live-0", "title": "", "text": "marker100 a new entry"}])
+    monkeypatch.undo()
+
+    manifest = read_manifest(index_path)
+    assert all(os.path.isdir(segment_path(index_path, name)) for name in manifest_segments(manifest))
+    assert top_id(rag, 100) == "live-0"
+    assert top_id(retriever(tmp_path / "index", source), 100) == "live-0"
+    rag.upsert([{"id": "live-1", "title": "", "text": "marker101 another entry"}])
+    assert top_id(rag, 101) == "live-1"
+
+
+def test_merge_while_an_ingest_is_in_flight(tmp_path, source, monkeypatch):
+    index_path = str(tmp_path / "index")
+    rag = retriever(tmp_path / "index", source)
+    rag.delete([f"doc-{number}" for number in range(0, 40, 4)])
+    other = write_lore(tmp_path / "other.jsonl", [{**doc, "id": f"other-{number}", "text": f"other {doc['text']}"}
+                                                  for number, doc in enumerate(lore(20, seed=3))])
+    stage = ingest.stage_segment
+    merges = []
+
+    def merge_meanwhile(path, segment):
+        staged = stage(path, segment)
+        if not segment.name.startswith("merged-"):
+            merges.append(ingester(index_path).merge())
+        return staged
+
+    monkeypatch.setattr(ingest, "stage_segment", merge_meanwhile)
+    result = ingester(index_path).ingest(other)
+    monkeypatch.undo()
+
+    assert merges[0] == 1 and result["segments"] > 1
+    manifest = read_manifest(index_path)
+    assert all(os.path.isdir(segment_path(index_path, name)) for name in manifest_segments(manifest))
+    assert len(manifest["sources"][os.path.normpath(other)]["segments"]) == result["segments"]
+    assert ingester(index_path).ingest(other)["status"] == "unchanged"
+
+
+def test_unused_segments_are_removed(tmp_path, source):
+    index_path = str(tmp_path / "index")
+    rag = retriever(tmp_path / "index", source)
+    with open(os.path.join(index_path, "notes.txt"), "w") as f:
+        f.write("not ours")
+    write_lore(source, lore(30, seed=2))
+    rag.ingester.ingest(source)
+    listed = {name for entry in read_manifest(index_path)["sources"].values() for name in entry["segments"]}
+    assert set(os.listdir(os.path.join(index_path, "segments"))) == listed
+    assert os.path.exists(os.path.join(index_path, "notes.txt"))
+
+
+def test_segment_passages_bound_segment_size(tmp_path, source):
+    result = ingester(tmp_path / "index", segment_passages=10).ingest(source)
+    assert result["segments"] == 4
+    result = ingester(tmp_path / "single", segment_passages=1000).ingest(source)
+    assert result["segments"] == 1
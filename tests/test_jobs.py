@@ -0,0 +1,74 @@
+import pytest
+
+from api.game import jobs
+from api.game.jobs import COMPLETED, FAILED, QUEUED, RUNNING, JobStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobs, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+
+def create(store, job_id, ttl=60.0):
+    return store.create(job_id, "image", {"prompt": job_id}, "worker-a", 30.0, ttl)
+
+
+def test_completed_results_are_reused_until_they_expire(store, clock):
+    assert create(store, "job")
+    store.update("job", COMPLETED, "https://replicate.delivery/old.png", owner="worker-a")
+    clock.now += 59
+    assert not create(store, "job")
+    assert store.get("job")["result"] == "https://replicate.delivery/old.png"
+
+    clock.now += 2
+    assert create(store, "job")
+    job = store.get("job")
+    assert (job["status"], job["result"]) == (QUEUED, None)
+
+
+def test_failed_jobs_rerun_at_once_and_unfinished_ones_never(store, clock):
+    assert create(store, "failed")
+    store.update("failed", FAILED, None, "vendor down", owner="worker-a")
+    assert create(store, "failed")
+
+    assert create(store, "running")
+    store.update("running", RUNNING, owner="worker-a")
+    clock.now += 3600
+    assert not create(store, "running")
+    assert store.get("running")["status"] == RUNNING
+
+
+def test_results_never_expire_without_a_ttl(store, clock):
+    assert create(store, "job", ttl=None)
+    store.update("job", COMPLETED, "/static/audio/line.mp3", owner="worker-a")
+    clock.now += 10 ** 6
+    assert not create(store, "job", ttl=None)
+
+
+def test_purge_only_deletes_old_finished_jobs(store, clock):
+    for job_id, status in (("old-done", COMPLETED), ("old-failed", FAILED), ("old-running", RUNNING)):
+        assert create(store, job_id)
+        store.update(job_id, status, owner="worker-a")
+    clock.now += 120
+    assert create(store, "new-done")
+    store.update("new-done", COMPLETED, "url", owner="worker-a")
+
+    assert store.purge(60) == 2
+    assert store.get("old-done") is None and store.get("old-failed") is None
+    assert store.get("old-running")["status"] == RUNNING
+    assert store.get("new-done")["status"] == COMPLETED
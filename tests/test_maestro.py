@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from api.game.executor import VendorExecutor
+from api.game.maestro import MaestroRunManager
+
+
+class FakeRuns:
+    """Runs finish on their second retrieve; retrieving a run in `hang` blocks until released"""
+
+    def __init__(self, hang=()):
+        self.hang = set(hang)
+        self.release = threading.Event()
+        self.retrieved = {}
+        self.created = 0
+
+    def create(self, input, requirements):
+        self.created += 1
+        return SimpleNamespace(id=f"run-{input}", status="in_progress")
+
+    def retrieve(self, run_id):
+        if run_id in self.hang:
+            self.release.wait()
+        self.retrieved[run_id] = self.retrieved.get(run_id, 0) + 1
+        return SimpleNamespace(id=run_id, status="completed" if self.retrieved[run_id] >= 2 else "in_progress")
+
+
+def client(runs):
+    return SimpleNamespace(beta=SimpleNamespace(maestro=SimpleNamespace(runs=runs)))
+
+
+def run_with(runs, scenario, **settings):
+    executor = VendorExecutor()
+    manager = MaestroRunManager(executor, min_interval=0.01, max_interval=0.05, **settings)
+
+    async def main():
+        try:
+            return await scenario(manager, client(runs))
+        finally:
+            manager.shutdown()
+
+    try:
+        return asyncio.run(main())
+    finally:
+        runs.release.set()
+        executor.shutdown()
+
+
+def test_a_hung_poll_doesnt_hold_up_other_runs():
+    runs = FakeRuns(hang={"run-stuck"})
+
+    async def scenario(manager, fake):
+        stuck = asyncio.ensure_future(manager.run(fake, "stuck", [], "test"))
+        await asyncio.sleep(0.05)
+        started_at = time.monotonic()
+        run = await manager.run(fake, "quick", [], "test")
+        elapsed = time.monotonic() - started_at
+        with pytest.raises(TimeoutError):
+            await stuck
+        return run, elapsed, manager.stats()
+
+    run, elapsed, stats = run_with(runs, scenario, poll_timeout=0.3, max_poll_errors=1)
+    assert run.status == "completed"
+    assert elapsed < 0.25
+    assert stats["poll_timeouts"] == 1 and stats["failed"] == 1
+
+
+def test_run_deadline_holds_while_its_poll_hangs():
+    runs = FakeRuns(hang={"run-stuck"})
+
+    async def scenario(manager, fake):
+        started_at = time.monotonic()
+        with pytest.raises(TimeoutError):
+            await manager.run(fake, "stuck", [], "test", timeout=0.2)
+        return time.monotonic() - started_at, manager.stats()
+
+    elapsed, stats = run_with(runs, scenario, poll_timeout=10)
+    assert elapsed < 1
+    assert stats["timed_out"] == 1 and stats["outstanding"] == 0
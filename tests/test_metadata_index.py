@@ -0,0 +1,91 @@
+import random
+
+import numpy as np
+import pytest
+
+from api.game.metadata_index import MetadataIndex, matches_filters, sorted_contains
+
+REGIONS = ["North", "south", "East", None]
+KINDS = ["battle", "treaty", "legend"]
+
+
+def random_documents(count, seed=0):
+    rng = random.Random(seed)
+    documents = []
+    for number in range(count):
+        doc = {"id": f"doc-{number}", "title": f"Document {number}", "text": "..."}
+        region = rng.choice(REGIONS)
+        if region is not None:
+            doc["region"] = region
+        if rng.random() < 0.7:
+            doc["metadata"] = {"kind": rng.sample(KINDS, rng.randint(1, 2)), "century": rng.randint(10, 14)}
+        documents.append(doc)
+    return documents
+
+
+@pytest.fixture(scope="module")
+def documents():
+    return random_documents(300)
+
+
+@pytest.fixture(scope="module")
+def passage_offsets(documents):
+    counts = [number % 3 for number in range(len(documents))]
+    return np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+
+@pytest.fixture(scope="module")
+def index(documents, passage_offsets):
+    return MetadataIndex.build(documents, passage_offsets)
+
+
+FILTERS = [
+    {"region": "north"},
+    {"region": ["NORTH", "east"]},
+    {"kind": "battle"},
+    {"region": "south", "kind": ["treaty", "legend"]},
+    {"region": "east", "century": 12, "kind": "legend"},
+    {"century": [10, 11], "kind": "battle"},
+    {"region": "nowhere"},
+    {"region": "north", "unknown": "value"},
+]
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_resolve_documents_matches_brute_force(index, documents, filters):
+    expected = [number for number, doc in enumerate(documents) if matches_filters(doc, filters)]
+    assert index.resolve_documents(filters).tolist() == expected
+
+
+@pytest.mark.parametrize("filters", [None, {}, {"region": None}, {"unknown": "value"}])
+def test_nothing_filtered(index, filters):
+    assert index.resolve_documents(filters) is None
+    assert index.resolve(filters) is None
+
+
+def test_documents_without_field_pass(index, documents):
+    allowed = set(index.resolve_documents({"kind": "battle"}).tolist())
+    without_kind = {number for number, doc in enumerate(documents) if "metadata" not in doc}
+    assert without_kind and without_kind <= allowed
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+def test_resolve_expands_to_passages(index, documents, passage_offsets, filters):
+    expected = [passage for number, doc in enumerate(documents) if matches_filters(doc, filters)
+                for passage in range(passage_offsets[number], passage_offsets[number + 1])]
+    passages = index.resolve(filters)
+    assert passages.tolist() == expected
+
+
+def test_saved_index_resolves_the_same(index, passage_offsets, tmp_path):
+    index.save(str(tmp_path / "metadata"))
+    loaded = MetadataIndex.load(str(tmp_path / "metadata"), passage_offsets)
+    for filters in FILTERS:
+        assert loaded.resolve(filters).tolist() == index.resolve(filters).tolist()
+
+
+def test_sorted_contains():
+    values = np.array([2, 5, 9], dtype=np.int32)
+    items = np.array([0, 2, 3, 5, 9, 10], dtype=np.int64)
+    assert sorted_contains(values, items).tolist() == [False, True, False, True, True, False]
+    assert not sorted_contains(values[:0], items).any()
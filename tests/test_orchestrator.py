@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from api.game.executor import VendorExecutor
+from api.game.maestro import MaestroRunManager
+from api.game.orchestrator import GameOrchestrator
+from api.game.result_cache import ResultCache
+
+CHOICES = ["A) Ride north", "B) Wait for dawn", "C) Bribe the guard", "D) Pray at the abbey"]
+
+
+class FakeRuns:
+    def __init__(self):
+        self.created = 0
+
+    def create(self, input, requirements):
+        self.created += 1
+        return SimpleNamespace(id=f"run-{self.created}", status="completed", result="\n".join(CHOICES))
+
+
+class RecordingCache(ResultCache):
+    """Records the thread each lookup and store runs on"""
+
+    def __init__(self):
+        super().__init__("choices")
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.get_ident())
+        return super().get(key)
+
+    def set(self, key, value):
+        self.threads.append(threading.get_ident())
+        super().set(key, value)
+
+
+def test_async_choices_use_the_cache_off_the_event_loop():
+    runs = FakeRuns()
+    cache = RecordingCache()
+    client = SimpleNamespace(beta=SimpleNamespace(maestro=SimpleNamespace(runs=runs)))
+    orchestrator = GameOrchestrator("offline-test", choice_cache=cache, client=client)
+    executor = VendorExecutor()
+    manager = MaestroRunManager(executor)
+
+    async def generate():
+        return await orchestrator.generate_scene_choices_async("A ford in the fog", [], manager)
+
+    try:
+        assert asyncio.run(generate()) == CHOICES
+        assert asyncio.run(generate()) == CHOICES
+    finally:
+        manager.shutdown()
+        executor.shutdown()
+
+    # One Maestro run; the second call was a cache hit
+    assert runs.created == 1
+    # get, set, get, all on the executor's threads
+    assert len(cache.threads) == 3
+    assert threading.get_ident() not in cache.threads
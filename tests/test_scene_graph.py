@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+from api.game.scene_graph import CHOICE_LETTERS, SceneGraph, SceneGraphError
+
+
+def scene(scene_id, *targets):
+    letters = CHOICE_LETTERS[:len(targets)]
+    return {
+        "scene_id": scene_id,
+        "description": f"Scene {scene_id}",
+        "rag_context_query": scene_id,
+        "actions": [f"{letter}) Go to {target}" for letter, target in zip(letters, targets)],
+        "next_scene_map": dict(zip(letters, targets)),
+    }
+
+
+def campaign(*scenes, start=None):
+    return {"campaign_id": "test", "start_scene": start, "scenes": list(scenes)}
+
+
+def test_bundled_campaign_loads():
+    graph = SceneGraph.load()
+    assert graph.start_scene in graph
+    assert graph.depth(graph.start_scene) == 0
+    for scene_id in graph.scene_ids:
+        for choice_index in range(len(graph.choices(scene_id))):
+            assert graph.next_scene(scene_id, choice_index) in graph
+
+
+def test_every_problem_is_reported_together():
+    broken = scene("b", "a")
+    del broken["description"]
+    bad_letter = scene("c", "a")
+    bad_letter["actions"] = ["B) Wrong letter"]
+    with pytest.raises(SceneGraphError) as error:
+        SceneGraph.from_dict(campaign(scene("a", "b", "missing"), broken, scene("a", "b"), bad_letter, start="nowhere"))
+    problems = "\n".join(error.value.problems)
+    assert "missing 'description'" in problems
+    assert "duplicate scene_id 'a'" in problems
+    assert "start scene 'nowhere' is not defined" in problems
+    assert "leads to undefined scene 'missing'" in problems
+    assert "choice A should start with 'A)'" in problems
+
+
+def test_invalid_impacts_are_rejected():
+    first = scene("a", "b", "b")
+    first["impacts"] = [{"trust": 1}]
+    with pytest.raises(SceneGraphError, match="one entry per choice"):
+        SceneGraph.from_dict(campaign(first, scene("b"), start="a"))
+    first["impacts"] = [{"trust": 1}, {"trust": 0.5}]
+    with pytest.raises(SceneGraphError, match="whole numbers"):
+        SceneGraph.from_dict(campaign(first, scene("b"), start="a"))
+
+
+def test_scenes_list_is_required():
+    with pytest.raises(SceneGraphError):
+        SceneGraph.from_dict({"scenes": {}})
+
+
+def test_lookups_and_transitions():
+    graph = SceneGraph.from_dict(campaign(scene("a", "b", "c", "b"), scene("b", "c"), scene("c"), start="a"))
+    assert graph.successors("a") == ("b", "c")
+    assert graph.predecessors("c") == ("a", "b")
+    assert graph.next_scene("a", 2) == "b"
+    assert graph.depth("c") == 1
+    assert graph.scenes_at_depth(1) == ("b", "c")
+    assert graph.within("a", 0) == {"a": 0}
+    with pytest.raises(ValueError):
+        graph.next_scene("a", 4)
+    with pytest.raises(ValueError):
+        graph.next_scene("a", -1)
+    with pytest.raises(ValueError):
+        graph.scene("nowhere")
+
+
+def test_unreachable_scenes_are_reported(capsys):
+    graph = SceneGraph.from_dict(campaign(scene("a", "b"), scene("b"), scene("island", "a"), start="a"))
+    assert graph.depth("island") is None
+    assert graph.stats()["reachable_from_start"] == 2
+    assert "1 scenes unreachable from a: island" in capsys.readouterr().out
+
+
+def reachable_by_search(graph, scene_id):
+    seen = {scene_id}
+    frontier = [scene_id]
+    while frontier:
+        for successor in graph.successors(frontier.pop()):
+            if successor not in seen:
+                seen.add(successor)
+                frontier.append(successor)
+    return seen
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_reachability_matches_graph_search(seed):
+    rng = random.Random(seed)
+    ids = [f"s{number}" for number in range(60)]
+    # Mostly forward edges with a few back edges, so there are cycles and dead ends
+    scenes = []
+    for position, scene_id in enumerate(ids):
+        targets = [rng.choice(ids[position + 1:] or ids) if rng.random() < 0.85 else rng.choice(ids)
+                   for _ in range(rng.randint(0, 3))]
+        scenes.append(scene(scene_id, *targets))
+    graph = SceneGraph.from_dict(campaign(*scenes, start="s0"))
+    for scene_id in ids:
+        expected = reachable_by_search(graph, scene_id)
+        assert graph.reachable(scene_id) == expected
+        for other in ids:
+            assert graph.can_reach(scene_id, other) == (other in expected)